@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Measure how long importing r1soft takes for a few typical uses, and check
+that the heavy dependencies stay unloaded when they aren't needed
+
+Each scenario runs in a fresh interpreter, exits non-zero if a scenario
+loaded a module it shouldn't have.
+"""
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, code to time, modules that must not be loaded afterwards)
+SCENARIOS = [
+    ('package', 'import r1soft', ('suds', 'xmlrpclib', 'ssl')),
+    ('cdp2', 'import r1soft; r1soft.cdp2.CDP2Client', ('suds',)),
+    ('util', 'import r1soft; r1soft.util.read_config', ('suds', 'xmlrpclib')),
+    ('cdp3', 'import r1soft; r1soft.cdp3.CDP3Client', ()),
+]
+
+CHILD_CODE = '''
+import json, sys, time
+start = time.time()
+%s
+elapsed = time.time() - start
+print json.dumps({'elapsed': elapsed, 'modules': sorted(sys.modules)})
+'''
+
+def run_scenario(code):
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='1')
+    output = subprocess.check_output([sys.executable, '-c', CHILD_CODE % code],
+        env=env)
+    return json.loads(output)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--repeat', type='int', default=10,
+        help='Runs per scenario')
+    options, args = parser.parse_args()
+
+    failed = False
+    print '%-10s %10s %10s  %s' % ('scenario', 'min ms', 'median ms', 'unwanted')
+    for name, code, forbidden in SCENARIOS:
+        times = []
+        unwanted = set()
+        for i in xrange(options.repeat):
+            result = run_scenario(code)
+            times.append(result['elapsed'] * 1000)
+            unwanted.update(m for m in forbidden if m in result['modules'])
+        times.sort()
+        print '%-10s %10.1f %10.1f  %s' % (name, times[0],
+            times[len(times) // 2], ', '.join(sorted(unwanted)) or '-')
+        failed = failed or bool(unwanted)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
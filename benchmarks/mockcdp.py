@@ -0,0 +1,751 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Local stand-ins for CDP3+ (SOAP) and CDP2 (XML-RPC) servers
+
+The SOAP server generates document/literal WSDLs for the Agent, DiskSafe,
+Policy2, TaskHistory, Volume and User namespaces covering the calls and
+fields this library uses, and answers them from a generated fleet of
+agents, disksafes, policies and task histories. Both servers can add a
+fixed (plus random jitter) latency to every request and count the requests
+and bytes they handle.
+
+Run it directly to start some servers and print a matching config file.
+"""
+
+import BaseHTTPServer
+import datetime
+import optparse
+import random
+import SimpleXMLRPCServer
+import SocketServer
+import sys
+import threading
+import time
+import xml.etree.cElementTree as ElementTree
+from xml.sax.saxutils import escape
+
+SOAP_ENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+CDP2_TIMESTAMP_FMT = '%a %b %d %Y %H:%M:%S UTC'
+
+POLICY_TASK_TYPE = 'DATA_PROTECTION_POLICY'
+
+# complex types: name -> [(field, type, repeated)], types not listed here are
+# XML schema types
+TYPES = {
+    'agent': [
+        ('id', 'string', False),
+        ('hostname', 'string', False),
+        ('description', 'string', False),
+        ('osType', 'string', False),
+        ('databaseAddOnEnabled', 'boolean', False),
+    ],
+    'attributeMapEntry': [
+        ('key', 'string', False),
+        ('value', 'string', False),
+    ],
+    'attributeMap': [
+        ('entry', 'attributeMapEntry', True),
+    ],
+    'diskSafe': [
+        ('id', 'string', False),
+        ('agentID', 'string', False),
+        ('description', 'string', False),
+        ('path', 'string', False),
+        ('volumeID', 'string', False),
+        ('diskSafeAttributeMap', 'attributeMap', False),
+    ],
+    'databaseInstance': [
+        ('name', 'string', False),
+        ('hostName', 'string', False),
+        ('username', 'string', False),
+        ('password', 'string', False),
+        ('portNumber', 'int', False),
+        ('enabled', 'boolean', False),
+        ('dataBaseType', 'string', False),
+    ],
+    'controlPanelInstance': [
+        ('name', 'string', False),
+        ('enabled', 'boolean', False),
+    ],
+    'policy': [
+        ('id', 'string', False),
+        ('name', 'string', False),
+        ('description', 'string', False),
+        ('enabled', 'boolean', False),
+        ('state', 'string', False),
+        ('diskSafeID', 'string', False),
+        ('recoveryPointLimit', 'int', False),
+        ('lastReplicationRunTime', 'dateTime', False),
+        ('databaseInstanceList', 'databaseInstance', True),
+        ('controlPanelInstanceList', 'controlPanelInstance', True),
+        ('exchangeSettings', 'exchangeSettings', False),
+        ('SQLServerSettings', 'sqlServerSettings', False),
+    ],
+    'exchangeSettings': [
+        ('enabled', 'boolean', False),
+    ],
+    'sqlServerSettings': [
+        ('enabled', 'boolean', False),
+    ],
+    'taskExecutionContext': [
+        ('id', 'string', False),
+        ('agentId', 'string', False),
+        ('taskType', 'string', False),
+        ('taskState', 'string', False),
+        ('executionTime', 'dateTime', False),
+    ],
+    'volume': [
+        ('id', 'string', False),
+        ('name', 'string', False),
+        ('path', 'string', False),
+    ],
+    'user': [
+        ('id', 'string', False),
+        ('username', 'string', False),
+        ('password', 'string', False),
+    ],
+}
+
+# namespace -> [(operation, [(param, type)], (return type, repeated) or None)]
+SERVICES = {
+    'Agent': [
+        ('getAgents', [], ('agent', True)),
+        ('getAgentByID', [('id', 'string')], ('agent', False)),
+        ('createAgentWithObject', [('agent', 'agent')], ('agent', False)),
+        ('updateAgent', [('agent', 'agent')], None),
+    ],
+    'DiskSafe': [
+        ('getDiskSafes', [], ('diskSafe', True)),
+        ('createDiskSafeWithObject', [('disksafe', 'diskSafe')], ('diskSafe', False)),
+    ],
+    'Policy2': [
+        ('getPolicies', [], ('policy', True)),
+        ('getPolicyById', [('id', 'string')], ('policy', False)),
+        ('createPolicy', [('policy', 'policy')], ('policy', False)),
+        ('updatePolicy', [('policy', 'policy')], None),
+        ('enablePolicy', [('policy', 'policy')], None),
+        ('disablePolicy', [('policy', 'policy')], None),
+    ],
+    'TaskHistory': [
+        ('getTaskExecutionContextIDsByAgent', [('agent', 'string')], ('string', True)),
+        ('getTaskExecutionContextByID', [('id', 'string')], ('taskExecutionContext', False)),
+    ],
+    'Volume': [
+        ('getVolumes', [], ('volume', True)),
+    ],
+    'User': [
+        ('getUsers', [], ('user', True)),
+        ('updateUser', [('user', 'user')], None),
+    ],
+}
+
+def service_namespace(service):
+    return 'http://%s.api.server.backup.r1soft.com/' % service.lower()
+
+def _xs_type(type_name):
+    return 'tns:%s' % type_name if type_name in TYPES else 'xs:%s' % type_name
+
+def build_wsdl(service, location):
+    """Generate the WSDL for a namespace, served from location
+    """
+
+    ns = service_namespace(service)
+    operations = SERVICES[service]
+    out = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" '
+            'xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" '
+            'xmlns:tns="%s" xmlns:xs="http://www.w3.org/2001/XMLSchema" '
+            'targetNamespace="%s" name="%s">' % (ns, ns, service),
+        '<types><xs:schema targetNamespace="%s" elementFormDefault="unqualified">' % ns,
+    ]
+    for name, params, returns in operations:
+        out.append('<xs:element name="%s" type="tns:%s"/>' % (name, name))
+        out.append('<xs:element name="%sResponse" type="tns:%sResponse"/>' % (name, name))
+        out.append('<xs:complexType name="%s"><xs:sequence>' % name)
+        for param, param_type in params:
+            out.append('<xs:element name="%s" type="%s" minOccurs="0"/>' % (
+                param, _xs_type(param_type)))
+        out.append('</xs:sequence></xs:complexType>')
+        out.append('<xs:complexType name="%sResponse"><xs:sequence>' % name)
+        if returns is not None:
+            out.append('<xs:element name="return" type="%s" minOccurs="0"%s/>' % (
+                _xs_type(returns[0]), ' maxOccurs="unbounded"' if returns[1] else ''))
+        out.append('</xs:sequence></xs:complexType>')
+    for type_name, fields in sorted(TYPES.iteritems()):
+        out.append('<xs:complexType name="%s"><xs:sequence>' % type_name)
+        for field, field_type, repeated in fields:
+            out.append('<xs:element name="%s" type="%s" minOccurs="0"%s/>' % (
+                field, _xs_type(field_type),
+                ' maxOccurs="unbounded"' if repeated else ''))
+        out.append('</xs:sequence></xs:complexType>')
+    out.append('</xs:schema></types>')
+    for name, params, returns in operations:
+        out.append('<message name="%s"><part name="parameters" element="tns:%s"/></message>' % (name, name))
+        out.append('<message name="%sResponse"><part name="parameters" element="tns:%sResponse"/></message>' % (name, name))
+    out.append('<portType name="%s">' % service)
+    for name, params, returns in operations:
+        out.append('<operation name="%s"><input message="tns:%s"/>'
+            '<output message="tns:%sResponse"/></operation>' % (name, name, name))
+    out.append('</portType>')
+    out.append('<binding name="%sPortBinding" type="tns:%s"><soap:binding '
+        'transport="http://schemas.xmlsoap.org/soap/http" style="document"/>' % (
+            service, service))
+    for name, params, returns in operations:
+        out.append('<operation name="%s"><soap:operation soapAction=""/>'
+            '<input><soap:body use="literal"/></input>'
+            '<output><soap:body use="literal"/></output></operation>' % name)
+    out.append('</binding>')
+    out.append('<service name="%s"><port name="%sPort" binding="tns:%sPortBinding">'
+        '<soap:address location="%s"/></port></service>' % (
+            service, service, service, location))
+    out.append('</definitions>')
+    return '\n'.join(out)
+
+def _to_xml(tag, value, type_name, out):
+    if value is None:
+        return
+    if type_name in TYPES:
+        out.append('<%s>' % tag)
+        for field, field_type, repeated in TYPES[type_name]:
+            field_value = value.get(field, None)
+            if repeated:
+                for item in field_value or []:
+                    _to_xml(field, item, field_type, out)
+            else:
+                _to_xml(field, field_value, field_type, out)
+        out.append('</%s>' % tag)
+        return
+    if isinstance(value, bool):
+        text = 'true' if value else 'false'
+    elif isinstance(value, datetime.datetime):
+        text = value.isoformat()
+    else:
+        text = escape(unicode(value)).encode('utf-8')
+    out.append('<%s>%s</%s>' % (tag, text, tag))
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def _from_xml(elem, type_name):
+    if type_name not in TYPES:
+        text = elem.text or ''
+        if type_name == 'boolean':
+            return text.strip() == 'true'
+        if type_name == 'int':
+            return int(text)
+        return text
+    fields = dict((field, (field_type, repeated)) \
+        for field, field_type, repeated in TYPES[type_name])
+    value = {}
+    for child in elem:
+        name = _local_name(child.tag)
+        if name not in fields:
+            continue
+        field_type, repeated = fields[name]
+        if repeated:
+            value.setdefault(name, []).append(_from_xml(child, field_type))
+        else:
+            value[name] = _from_xml(child, field_type)
+    return value
+
+class SoapFault(Exception):
+    pass
+
+def soap_envelope(body):
+    return ('<?xml version="1.0" encoding="UTF-8"?><S:Envelope xmlns:S="%s">'
+        '<S:Body>%s</S:Body></S:Envelope>' % (SOAP_ENV_NS, body))
+
+def soap_fault(message):
+    return soap_envelope('<S:Fault><faultcode>S:Server</faultcode>'
+        '<faultstring>%s</faultstring></S:Fault>' % escape(message))
+
+class MockCDP3Data(object):
+    """A generated CDP3+ server: one agent, disksafe and policy per host, and
+    a task history for each agent (oldest first, like the real thing)
+    """
+
+    POLICY_STATES = (('OK', 0.75), ('ERROR', 0.1), ('ALERT', 0.1), ('UNKNOWN', 0.05))
+
+    def __init__(self, hosts=50, tasks_per_agent=20, disabled_ratio=0.1,
+            running_ratio=0.1, seed=0, name='cdp'):
+        rand = random.Random(seed)
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.agents = {}
+        self.disksafes = {}
+        self.policies = {}
+        self.tasks = {}
+        self.tasks_by_agent = {}
+        self.volumes = {'volume-0': {'id': 'volume-0', 'name': 'Default',
+            'path': '/storage01/replication'}}
+        self.users = {'user-0': {'id': 'user-0', 'username': 'admin',
+            'password': 'secret'}}
+        for i in xrange(hosts):
+            agent_id = '%s-agent-%d' % (name, i)
+            disksafe_id = '%s-disksafe-%d' % (name, i)
+            policy_id = '%s-policy-%d' % (name, i)
+            self.agents[agent_id] = {
+                'id': agent_id,
+                'hostname': 'host%05d.%s.example.com' % (i, name),
+                'description': 'Host %d' % i,
+                'osType': rand.choice(('LINUX', 'LINUX', 'LINUX', 'WINDOWS')),
+                'databaseAddOnEnabled': rand.random() < 0.2,
+            }
+            self.disksafes[disksafe_id] = {
+                'id': disksafe_id,
+                'agentID': agent_id,
+                'description': 'Disk Safe %d' % i,
+                'path': '/storage01/replication/%s' % disksafe_id,
+                'volumeID': 'volume-0',
+                'diskSafeAttributeMap': {'entry': [
+                    {'key': 'DATABASE_BACKUPS_ENABLED', 'value': 'true'},
+                    {'key': 'CONTROLPANELS_ENABLED', 'value': 'false'},
+                ]},
+            }
+            state = self._pick_state(rand)
+            self.policies[policy_id] = {
+                'id': policy_id,
+                'name': 'Policy %d' % i,
+                'description': 'Policy for host %d' % i,
+                'enabled': rand.random() >= disabled_ratio,
+                'state': state,
+                'diskSafeID': disksafe_id,
+                'recoveryPointLimit': 30,
+                'lastReplicationRunTime': now - datetime.timedelta(
+                    hours=rand.randint(1, 24)),
+                'databaseInstanceList': [],
+                'controlPanelInstanceList': [],
+            }
+            task_ids = []
+            start = now - datetime.timedelta(days=tasks_per_agent)
+            for j in xrange(tasks_per_agent):
+                task_id = '%s-task-%d-%d' % (name, i, j)
+                if j == tasks_per_agent - 1 and rand.random() < running_ratio:
+                    task_state = 'RUNNING'
+                elif state == 'ERROR' and j >= tasks_per_agent - 2:
+                    task_state = 'ERROR'
+                else:
+                    task_state = 'FINISHED'
+                self.tasks[task_id] = {
+                    'id': task_id,
+                    'agentId': agent_id,
+                    'taskType': POLICY_TASK_TYPE if j % 4 else 'MERGE_RECOVERY_POINTS',
+                    'taskState': task_state,
+                    'executionTime': start + datetime.timedelta(days=j,
+                        minutes=rand.randint(0, 120)),
+                }
+                task_ids.append(task_id)
+            self.tasks_by_agent[agent_id] = task_ids
+
+    def _pick_state(self, rand):
+        point = rand.random()
+        for state, weight in self.POLICY_STATES:
+            point -= weight
+            if point < 0:
+                return state
+        return self.POLICY_STATES[0][0]
+
+    def _new_id(self, kind):
+        with self._lock:
+            self._next_id += 1
+            return 'new-%s-%d' % (kind, self._next_id)
+
+    def _get(self, collection, object_id, kind):
+        try:
+            return collection[object_id]
+        except KeyError:
+            raise SoapFault('No %s found with ID %s' % (kind, object_id))
+
+    def getAgents(self):
+        return self.agents.values()
+
+    def getAgentByID(self, id):
+        return self._get(self.agents, id, 'agent')
+
+    def createAgentWithObject(self, agent):
+        agent['id'] = self._new_id('agent')
+        self.agents[agent['id']] = agent
+        return agent
+
+    def updateAgent(self, agent):
+        self._get(self.agents, agent.get('id'), 'agent').update(agent)
+
+    def getDiskSafes(self):
+        return self.disksafes.values()
+
+    def createDiskSafeWithObject(self, disksafe):
+        disksafe['id'] = self._new_id('disksafe')
+        self.disksafes[disksafe['id']] = disksafe
+        return disksafe
+
+    def getPolicies(self):
+        return self.policies.values()
+
+    def getPolicyById(self, id):
+        return self._get(self.policies, id, 'policy')
+
+    def createPolicy(self, policy):
+        policy['id'] = self._new_id('policy')
+        policy.setdefault('state', 'UNKNOWN')
+        self.policies[policy['id']] = policy
+        return policy
+
+    def updatePolicy(self, policy):
+        self._get(self.policies, policy.get('id'), 'policy').update(policy)
+
+    def enablePolicy(self, policy):
+        self._get(self.policies, policy.get('id'), 'policy')['enabled'] = True
+
+    def disablePolicy(self, policy):
+        self._get(self.policies, policy.get('id'), 'policy')['enabled'] = False
+
+    def getTaskExecutionContextIDsByAgent(self, agent):
+        return self.tasks_by_agent.get(agent, [])
+
+    def getTaskExecutionContextByID(self, id):
+        return self._get(self.tasks, id, 'task')
+
+    def getVolumes(self):
+        return self.volumes.values()
+
+    def getUsers(self):
+        return self.users.values()
+
+    def updateUser(self, user):
+        self._get(self.users, user.get('id'), 'user').update(user)
+
+class MockCDP2Data(object):
+    """A generated CDP2 server: hosts with a few scheduled backup tasks each
+    """
+
+    def __init__(self, hosts=50, tasks_per_host=3, error_ratio=0.1, seed=0,
+            name='cdp2'):
+        rand = random.Random(seed)
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        self.hosts = {}
+        self.tasks = {}
+        self.tasks_by_host = {}
+        for i in xrange(hosts):
+            self.hosts[i] = {
+                'hostname': 'host%05d.%s.example.com' % (i, name),
+                'description': 'Host %d' % i,
+                'hostType': rand.choice((0, 0, 0, 1)),
+                'enabled': True,
+                'controlPanelModuleEnabled': False,
+                'cdpForMySqlAddonEnabled': rand.random() < 0.2,
+                'lastBackup': ['error' if rand.random() < error_ratio else 'ok',
+                    (now - datetime.timedelta(hours=rand.randint(1, 24))) \
+                        .strftime(CDP2_TIMESTAMP_FMT)],
+            }
+            task_ids = []
+            for j in xrange(tasks_per_host):
+                task_id = i * 1000 + j
+                self.tasks[task_id] = {
+                    'taskType': 'Backup' if j == 0 else 'Merge',
+                    'enabled': True,
+                }
+                task_ids.append(task_id)
+            self.tasks_by_host[i] = task_ids
+
+    def register(self, server):
+        server.register_function(lambda: sorted(self.hosts), 'host.getHostIds')
+        server.register_function(lambda host_id: dict((k, v) for k, v \
+                in self.hosts[host_id].iteritems() if k != 'lastBackup'),
+            'host.getHostAsMap')
+        server.register_function(lambda host_id: self.hosts[host_id]['hostname'],
+            'host.getHostname')
+        server.register_function(lambda host_id: self.hosts[host_id]['lastBackup'],
+            'host.getLastFinishedBackupTaskInfo')
+        server.register_function(lambda host_id: self.tasks_by_host[host_id],
+            'backupTask.getScheduledTaskIdsByHost')
+        server.register_function(lambda task_id: self.tasks[task_id],
+            'backupTask.getScheduledTaskSummary')
+        server.register_multicall_functions()
+
+class MockStats(object):
+    """Requests and bytes seen by a mock server
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.operations = {}
+
+    def record(self, operation, bytes_in, bytes_out):
+        with self._lock:
+            self.requests += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.operations[operation] = self.operations.get(operation, 0) + 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'operations': dict(self.operations),
+            }
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+class _MockRequestHandlerMixin:
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def delay(self):
+        mock = self.server.mock
+        if mock.latency or mock.jitter:
+            time.sleep(mock.latency + random.uniform(0, mock.jitter))
+
+    def send_body(self, status, body, content_type='text/xml; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class _SoapRequestHandler(_MockRequestHandlerMixin,
+        BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.delay()
+        service = self.path.split('?', 1)[0].strip('/')
+        if service not in SERVICES:
+            self.send_body(404, 'Not found', 'text/plain')
+            return
+        body = self.server.mock.wsdl(service, self.headers.get('Host'))
+        self.server.mock.stats.record('%s.wsdl' % service, 0, len(body))
+        self.send_body(200, body)
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.delay()
+        service = self.path.split('?', 1)[0].strip('/')
+        operation = None
+        try:
+            operation, status, body = self.server.mock.handle_soap(service, request)
+        except Exception as err:
+            status, body = 500, soap_fault('%s: %s' % (err.__class__.__name__, err))
+        self.server.mock.stats.record('%s.%s' % (service, operation),
+            len(request), len(body))
+        self.send_body(status, body)
+
+class _XmlRpcRequestHandler(_MockRequestHandlerMixin,
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    rpc_paths = ('/xmlrpc',)
+
+    def do_POST(self):
+        self.delay()
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def _dispatch(self, method, params):
+        return self.server._dispatch(method, params)
+
+class _MockXmlRpcServer(SocketServer.ThreadingMixIn,
+        SimpleXMLRPCServer.SimpleXMLRPCServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        response = SimpleXMLRPCServer.SimpleXMLRPCServer._marshaled_dispatch(
+            self, data, dispatch_method, path)
+        try:
+            method = ElementTree.fromstring(data).findtext('methodName')
+        except SyntaxError:
+            method = None
+        self.mock.stats.record(method, len(data), len(response))
+        return response
+
+class MockServer(object):
+    """Base for the mock servers, serving from a background thread
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.stats = MockStats()
+        self.server = self._build_server((host, port))
+        self.server.mock = self
+        self.host, self.port = self.server.server_address[:2]
+        self._thread = threading.Thread(target=self.server.serve_forever,
+            name='mock-%s:%d' % (self.host, self.port))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class MockCDP3Server(MockServer):
+    """Mock CDP3+ SOAP API (over plain HTTP)
+    """
+
+    version = 5
+
+    def __init__(self, data=None, **kwargs):
+        self.data = data if data is not None else MockCDP3Data()
+        self._wsdls = {}
+        super(MockCDP3Server, self).__init__(**kwargs)
+
+    def _build_server(self, address):
+        return _ThreadingHTTPServer(address, _SoapRequestHandler)
+
+    def wsdl(self, service, host=None):
+        location = 'http://%s/%s' % (host or '%s:%d' % (self.host, self.port),
+            service)
+        wsdl = self._wsdls.get(location, None)
+        if wsdl is None:
+            wsdl = self._wsdls[location] = build_wsdl(service, location)
+        return wsdl
+
+    def handle_soap(self, service, request):
+        """Answer a SOAP request, returns (operation, HTTP status, body)
+        """
+
+        envelope = ElementTree.fromstring(request)
+        call = envelope.find('{%s}Body' % SOAP_ENV_NS)[0]
+        operation = _local_name(call.tag)
+        spec = dict((name, (params, returns)) \
+            for name, params, returns in SERVICES.get(service, []))
+        if operation not in spec:
+            return (operation, 500, soap_fault('Unknown operation: %s' % operation))
+        params, returns = spec[operation]
+        param_types = dict(params)
+        args = dict((name, None) for name, param_type in params)
+        for child in call:
+            name = _local_name(child.tag)
+            if name in param_types:
+                args[name] = _from_xml(child, param_types[name])
+        try:
+            result = getattr(self.data, operation)(**args)
+        except SoapFault as err:
+            return (operation, 500, soap_fault(str(err)))
+        out = ['<ns2:%sResponse xmlns:ns2="%s">' % (operation,
+            service_namespace(service))]
+        if returns is not None:
+            return_type, repeated = returns
+            for item in (result or []) if repeated else [result]:
+                _to_xml('return', item, return_type, out)
+        out.append('</ns2:%sResponse>' % operation)
+        return (operation, 200, soap_envelope(''.join(out)))
+
+class MockCDP2Server(MockServer):
+    """Mock CDP2 XML-RPC API (over plain HTTP)
+    """
+
+    version = 2
+
+    def __init__(self, data=None, **kwargs):
+        self.data = data if data is not None else MockCDP2Data()
+        super(MockCDP2Server, self).__init__(**kwargs)
+
+    def _build_server(self, address):
+        server = _MockXmlRpcServer(address, _XmlRpcRequestHandler,
+            logRequests=False, allow_none=True)
+        self.data.register(server)
+        return server
+
+def start_fleet(cdp3=1, cdp2=0, hosts=50, tasks_per_agent=20, latency=0.0,
+        jitter=0.0, seed=0, first_address=2):
+    """Start cdp3 + cdp2 mock servers, each on its own loopback address so
+    they look like separate servers (127.0.0.2, 127.0.0.3, ...)
+    """
+
+    servers = []
+    for i in xrange(cdp3 + cdp2):
+        host = '127.0.0.%d' % (first_address + i)
+        name = 'cdp%d' % i
+        if i < cdp3:
+            data = MockCDP3Data(hosts, tasks_per_agent, seed=seed + i, name=name)
+            servers.append(MockCDP3Server(data, host=host, latency=latency,
+                jitter=jitter))
+        else:
+            data = MockCDP2Data(hosts, seed=seed + i, name=name)
+            servers.append(MockCDP2Server(data, host=host, latency=latency,
+                jitter=jitter))
+    return servers
+
+def fleet_config(servers, username='admin', password='secret', **settings):
+    """Server list for the fleet, like r1soft.util.read_config() returns,
+    settings are added to every server
+    """
+
+    return [dict(settings,
+        version=server.version,
+        hostname=server.host,
+        port=server.port,
+        ssl=0,
+        username=username,
+        password=password,
+    ) for server in servers]
+
+def fleet_stats(servers):
+    """Total requests and bytes over all the servers
+    """
+
+    totals = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0}
+    for server in servers:
+        stats = server.stats.as_dict()
+        for key in totals:
+            totals[key] += stats[key]
+    return totals
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--cdp3', type='int', default=1,
+        help='Number of CDP3+ servers')
+    parser.add_option('--cdp2', type='int', default=0,
+        help='Number of CDP2 servers')
+    parser.add_option('--hosts', type='int', default=50,
+        help='Hosts (agent, disksafe and policy) per server')
+    parser.add_option('--tasks', type='int', default=20,
+        help='Tasks in each agent\'s history')
+    parser.add_option('--latency', type='float', default=0.0,
+        help='Seconds added to every request')
+    parser.add_option('--jitter', type='float', default=0.0,
+        help='Up to this many more seconds added at random')
+    options, args = parser.parse_args()
+
+    servers = start_fleet(options.cdp3, options.cdp2, options.hosts,
+        options.tasks, options.latency, options.jitter)
+    for server in fleet_config(servers):
+        print '{version}:{hostname}:{port}:{ssl}:{username}:{password}'.format(**server)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Run the scripts' workloads against a local fleet of mock servers and
+report wall time, round trips, bytes transferred and peak memory
+
+Each scenario runs in a fresh interpreter (with its own empty cache dir)
+against servers started by this process, so round trips are counted on the
+server side. Save the results with --save and compare a later run with
+--baseline, which exits non-zero if anything got worse by more than the
+tolerance (or made any extra round trips).
+"""
+
+import imp
+import json
+import logging
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mockcdp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIN_DIR = os.path.join(ROOT, 'bin')
+
+# metrics compared against the baseline, round trips are exact
+METRICS = ('wall', 'requests', 'bytes', 'maxrss_kb')
+
+def load_script(name):
+    """Import one of the bin scripts (registering its handlers) without
+    running its main block
+    """
+
+    module_name = name.replace('-', '_').replace('.py', '')
+    return imp.load_source(module_name, os.path.join(BIN_DIR, name))
+
+def scenario_failed_backups(config):
+    import r1soft
+
+    script = load_script('cdp-get-failed-backups.py')
+    results = []
+    with r1soft.util.Scheduler(script.WORKERS, script.WORKERS_PER_SERVER) as scheduler:
+        for server, result in scheduler.dispatch(config,
+                r1soft.util.NamedHandler('failed-backups')):
+            results.append(result)
+    return results
+
+def scenario_server_locations(config):
+    import r1soft
+
+    script = load_script('cdp-server-locations.py')
+    return list(r1soft.util.dispatch_handlers_mp(config, 'server-locations',
+        namespaces=script.CDP3_NAMESPACES))
+
+def scenario_copy_host(config):
+    import r1soft
+
+    src, dest = [r1soft.cdp3.CDP3ClientFactory(server['hostname'],
+            server['username'], server['password'], server['port'],
+            bool(server['ssl'])) \
+        for server in config[:2]]
+    engine = r1soft.migrate.MigrationEngine(src, dest)
+    return engine.run()
+
+# name -> (function, CDP3+ servers, CDP2 servers, empty destination server)
+SCENARIOS = {
+    'failed_backups': (scenario_failed_backups, True, True, False),
+    'server_locations': (scenario_server_locations, True, True, False),
+    'copy_host': (scenario_copy_host, False, False, True),
+}
+
+def run_child(scenario, config):
+    """Body of the child process, runs the scenario and prints its results
+    """
+
+    logging.getLogger('r1soft').setLevel(logging.CRITICAL)
+    func = SCENARIOS[scenario][0]
+    start = time.time()
+    results = func(config)
+    wall = time.time() - start
+    errors = [r for r in results if isinstance(r, Exception) or \
+        (isinstance(r, tuple) and isinstance(r[-1], Exception))]
+    maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print json.dumps({'wall': wall, 'maxrss_kb': maxrss,
+        'errors': [repr(e) for e in errors]})
+
+def start_servers(scenario, options):
+    func, cdp3, cdp2, copy = SCENARIOS[scenario]
+    if copy:
+        src = mockcdp.MockCDP3Server(mockcdp.MockCDP3Data(options.agents,
+                options.tasks, name='src'),
+            host='127.0.0.2', latency=options.latency, jitter=options.jitter)
+        dest = mockcdp.MockCDP3Server(mockcdp.MockCDP3Data(0, name='dest'),
+            host='127.0.0.3', latency=options.latency, jitter=options.jitter)
+        return [src, dest]
+    return mockcdp.start_fleet(options.servers if cdp3 else 0,
+        options.cdp2_servers if cdp2 else 0, options.agents, options.tasks,
+        options.latency, options.jitter)
+
+def run_scenario(scenario, options):
+    """Run a scenario once against fresh servers, returns its metrics
+    """
+
+    servers = start_servers(scenario, options)
+    cache_dir = tempfile.mkdtemp(prefix='r1soft-bench-')
+    try:
+        env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='1',
+            R1SOFT_CACHE_DIR=cache_dir)
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                '--child', scenario],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        output = child.communicate(json.dumps(mockcdp.fleet_config(servers)))[0]
+        if child.returncode != 0:
+            raise RuntimeError('Scenario %s failed with exit code %d' % (
+                scenario, child.returncode))
+        stats = mockcdp.fleet_stats(servers)
+    finally:
+        for server in servers:
+            server.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    result = json.loads(output.strip().splitlines()[-1])
+    result['requests'] = stats['requests']
+    result['bytes'] = stats['bytes_in'] + stats['bytes_out']
+    return result
+
+def summarize(runs):
+    """Median of each metric over the runs (round trips should be the same
+    every time, but take the worst just in case)
+    """
+
+    summary = {}
+    for metric in METRICS:
+        values = sorted(run[metric] for run in runs)
+        summary[metric] = values[-1] if metric == 'requests' \
+            else values[len(values) // 2]
+    summary['errors'] = sum(len(run['errors']) for run in runs)
+    return summary
+
+def compare(results, baseline, tolerance):
+    """List the regressions of results against baseline
+    """
+
+    regressions = []
+    for scenario, summary in sorted(results.iteritems()):
+        if scenario not in baseline:
+            continue
+        for metric in METRICS:
+            old = baseline[scenario].get(metric, None)
+            new = summary[metric]
+            if old is None:
+                continue
+            limit = old if metric == 'requests' else old * (1 + tolerance)
+            if new > limit:
+                regressions.append('%s %s: %s -> %s' % (scenario, metric,
+                    old, new))
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+    parser.add_option('-s', '--scenario', action='append',
+        choices=sorted(SCENARIOS),
+        help='Scenario to run, can be given more than once (default: all)')
+    parser.add_option('--servers', type='int', default=2,
+        help='Number of CDP3+ servers')
+    parser.add_option('--cdp2-servers', type='int', default=1,
+        help='Number of CDP2 servers')
+    parser.add_option('--agents', type='int', default=100,
+        help='Agents (each with a disksafe and policy) per server')
+    parser.add_option('--tasks', type='int', default=20,
+        help='Tasks in each agent\'s history')
+    parser.add_option('--latency', type='float', default=0.01,
+        help='Seconds the servers add to every request')
+    parser.add_option('--jitter', type='float', default=0.0,
+        help='Up to this many more seconds added at random')
+    parser.add_option('-n', '--repeat', type='int', default=3,
+        help='Runs per scenario')
+    parser.add_option('--save', help='Write the results to this JSON file')
+    parser.add_option('--baseline',
+        help='Compare with results saved earlier with --save')
+    parser.add_option('--tolerance', type='float', default=0.2,
+        help='Allowed increase in wall time, bytes and memory over the ' \
+            'baseline (fraction)')
+    options, args = parser.parse_args()
+
+    if options.child:
+        run_child(options.child, json.load(sys.stdin))
+        return 0
+
+    results = {}
+    print '%-18s %10s %10s %12s %12s %7s' % ('scenario', 'wall s',
+        'requests', 'bytes', 'maxrss kB', 'errors')
+    for scenario in options.scenario or sorted(SCENARIOS):
+        summary = results[scenario] = summarize([run_scenario(scenario, options) \
+            for i in xrange(options.repeat)])
+        print '%-18s %10.2f %10d %12d %12d %7d' % (scenario, summary['wall'],
+            summary['requests'], summary['bytes'], summary['maxrss_kb'],
+            summary['errors'])
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for regression in regressions:
+            print 'REGRESSION %s' % regression
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
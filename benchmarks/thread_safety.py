@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Check that clients handed out by one CDP3ClientFactory can be used from
+many threads at once without getting each other's responses
+
+Hammers getAgentByID on a mock server from a pool of threads, each with its
+own factory client, and counts the calls that came back with a different
+agent than the one asked for. Exits non-zero on any mismatch.
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import mockcdp
+
+def run_thread(factory, agent_ids, calls, mismatches, lock):
+    client = factory.client()
+    try:
+        for i in xrange(calls):
+            agent_id = agent_ids[i % len(agent_ids)]
+            agent = client.Agent.service.getAgentByID(id=agent_id)
+            if agent is None or agent.id != agent_id:
+                with lock:
+                    mismatches.append((agent_id, getattr(agent, 'id', None)))
+    finally:
+        client.close()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-t', '--threads', type='int', default=16,
+        help='Threads calling at once')
+    parser.add_option('-n', '--calls', type='int', default=2000,
+        help='Calls in total')
+    options, args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix='r1soft-bench-')
+    os.environ['R1SOFT_CACHE_DIR'] = cache_dir
+    import r1soft
+
+    server = mockcdp.MockCDP3Server(mockcdp.MockCDP3Data(50, 1),
+        host='127.0.0.2')
+    try:
+        factory = r1soft.cdp3.CDP3ClientFactory(server.host, 'admin', 'secret',
+            server.port, False, circuit_breaker=False)
+        agent_ids = sorted(server.data.agents)
+        mismatches = []
+        lock = threading.Lock()
+        threads = [threading.Thread(target=run_thread, args=(factory,
+                agent_ids, options.calls // options.threads, mismatches, lock)) \
+            for i in xrange(options.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print '%d calls from %d threads, %d mismatched' % (
+        options.calls // options.threads * options.threads, options.threads,
+        len(mismatches))
+    for asked, got in mismatches[:10]:
+        print '  asked for %s, got %s' % (asked, got)
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,19 +27,24 @@ logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.INFO)
 logger.propagate = False
 
+@r1soft.util.register_handler('change-password', versions=(3, 5))
 def handle_cdp3_server(server, username, new_password):
     updated = False
-    client = r1soft.util.build_cdp3_client(server)
-    logger.info('Checking users on server: %s', server['hostname'])
-    users = client.User.service.getUsers()
+    client = r1soft.util.get_cdp3_factory(server).client()
+    try:
+        logger.info('Checking users on server: %s', server['hostname'])
+        users = client.User.service.getUsers()
 
-    for user in (u for u in users if u.username == username):
-        logger.info('Updating user: %s (%s)', user.username, user.id)
-        user.password = new_password
-        client.User.service.updateUser(user)
-        updated = True
-    return updated
+        for user in (u for u in users if u.username == username):
+            logger.info('Updating user: %s (%s)', user.username, user.id)
+            user.password = new_password
+            client.User.service.updateUser(user)
+            updated = True
+        return updated
+    finally:
+        client.close()
 
+@r1soft.util.register_handler('change-password', versions=(2,))
 def handle_cdp2_server(server, username, new_password):
     updated = False
     return updated
@@ -56,12 +61,6 @@ if __name__ == '__main__':
 
     config = r1soft.util.read_config(config_file)
 
-    handler_map = {
-        2: lambda server: handle_cdp2_server(server, username, new_password),
-        3: lambda server: handle_cdp3_server(server, username, new_password),
-        5: lambda server: handle_cdp3_server(server, username, new_password),
-    }
-
     for (server, results) in r1soft.util.dispatch_handlers(config,
-            lambda s: handler_map.get(s['version'])(s)):
+            r1soft.util.NamedHandler('change-password', username, new_password)):
         print '%s: %s' % (server['hostname'], results)
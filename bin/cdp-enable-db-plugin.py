@@ -31,78 +31,86 @@ logger.propagate = False
 DB_PLUGIN_CANDIDATES_RE = re.compile(
     r'(?:mce\d+|[\w\d]{2,3})-db|(?:obp|sip|eep)(?:uk|au)?[1-6]-\d+|sip4[a-z]-db')
 
+@r1soft.util.register_handler('enable-db-plugin', versions=(3,))
 def handle_cdp3_server(server, db_username, db_password):
     logger.info('Checking DB plugin for agents on server %s', server['hostname'])
-    client = r1soft.util.build_cdp3_client(server)
+    client = r1soft.util.get_cdp3_factory(server).client()
 
-    policies = client.Policy2.service.getPolicies()
-    disk_safes = client.DiskSafe.service.getDiskSafes()
-    for agent in client.Agent.service.getAgents():
-        if DB_PLUGIN_CANDIDATES_RE.match(agent.hostname) or \
-                DB_PLUGIN_CANDIDATES_RE.match(agent.description):
-            if not agent.databaseAddOnEnabled:
-                logger.info('Enabling DB plugin for agent: %s', agent.hostname)
-                agent.databaseAddOnEnabled = True
-                client.Agent.service.updateAgent(agent)
-            agent_disk_safes = [ds for ds in disk_safes if ds.agentID == agent.id]
-            agent_policies = [p for p in policies \
-                if p.enabled and hasattr(p, 'diskSafeID') and \
-                    p.diskSafeID in [ds.id for ds in agent_disk_safes]]
-            for policy in agent_policies:
-                if not (hasattr(policy, 'databaseInstanceList') and \
-                        len(policy.databaseInstanceList) > 0):
-                    logger.info('Adding DB to agent (%s) policy %s (%s)',
-                        agent.hostname, policy.name, policy.id)
-                    db_instance = client.Policy2.factory.create('databaseInstance')
-                    db_instance.dataBaseType = client.Policy2.factory.create('dataBaseType').MYSQL
-                    db_instance.enabled = True
-                    db_instance.hostName = '127.0.0.1'
-                    db_instance.name = 'default'
-                    db_instance.username = db_username
-                    db_instance.password = db_password
-                    db_instance.portNumber = 3306
-                    db_instance.useAlternateDataDirectory = False
-                    db_instance.useAlternateHostname = True
-                    db_instance.useAlternateInstallDirectory = False
-                    policy.databaseInstanceList = [db_instance]
-                    client.Policy2.service.updatePolicy(policy=policy)
+    try:
+        policies = client.Policy2.service.getPolicies()
+        disk_safes = client.DiskSafe.service.getDiskSafes()
+        for agent in client.Agent.service.getAgents():
+            if DB_PLUGIN_CANDIDATES_RE.match(agent.hostname) or \
+                    DB_PLUGIN_CANDIDATES_RE.match(agent.description):
+                if not agent.databaseAddOnEnabled:
+                    logger.info('Enabling DB plugin for agent: %s', agent.hostname)
+                    agent.databaseAddOnEnabled = True
+                    client.Agent.service.updateAgent(agent)
+                agent_disk_safes = [ds for ds in disk_safes if ds.agentID == agent.id]
+                agent_policies = [p for p in policies \
+                    if p.enabled and hasattr(p, 'diskSafeID') and \
+                        p.diskSafeID in [ds.id for ds in agent_disk_safes]]
+                for policy in agent_policies:
+                    if not (hasattr(policy, 'databaseInstanceList') and \
+                            len(policy.databaseInstanceList) > 0):
+                        logger.info('Adding DB to agent (%s) policy %s (%s)',
+                            agent.hostname, policy.name, policy.id)
+                        db_instance = client.Policy2.factory.create('databaseInstance')
+                        db_instance.dataBaseType = client.Policy2.factory.create('dataBaseType').MYSQL
+                        db_instance.enabled = True
+                        db_instance.hostName = '127.0.0.1'
+                        db_instance.name = 'default'
+                        db_instance.username = db_username
+                        db_instance.password = db_password
+                        db_instance.portNumber = 3306
+                        db_instance.useAlternateDataDirectory = False
+                        db_instance.useAlternateHostname = True
+                        db_instance.useAlternateInstallDirectory = False
+                        policy.databaseInstanceList = [db_instance]
+                        client.Policy2.service.updatePolicy(policy=policy)
+    finally:
+        client.close()
 
+@r1soft.util.register_handler('enable-db-plugin', versions=(5,))
 def handle_cdp5_server(server, db_username, db_password):
     logger.info('Checking DB plugin for agents on server %s', server['hostname'])
-    client = r1soft.util.build_cdp3_client(server)
+    client = r1soft.util.get_cdp3_factory(server).client()
 
-    policies = client.Policy2.service.getPolicies()
-    disk_safes = client.DiskSafe.service.getDiskSafes()
-    for agent in client.Agent.service.getAgents():
-        if DB_PLUGIN_CANDIDATES_RE.match(agent.hostname) or \
-                DB_PLUGIN_CANDIDATES_RE.match(agent.description):
-            if not agent.databaseAddOnEnabled:
-                logger.info('Enabling DB plugin for agent: %s', agent.hostname)
-                agent.databaseAddOnEnabled = True
-                client.Agent.service.updateAgent(agent)
-            agent_disk_safes = [ds for ds in disk_safes if ds.agentID == agent.id]
-            agent_policies = [p for p in policies \
-                if p.enabled and hasattr(p, 'diskSafeID') and \
-                    p.diskSafeID in [ds.id for ds in agent_disk_safes]]
-            for policy in agent_policies:
-                if not (hasattr(policy, 'databaseInstanceList') and \
-                        len(policy.databaseInstanceList) > 0):
-                    logger.info('Adding DB to agent (%s) policy %s (%s)',
-                        agent.hostname, policy.name, policy.id)
-                    db_instance = client.Policy2.factory.create('databaseInstance')
-                    db_instance.dataBaseType = client.Policy2.factory.create('dataBaseType').MYSQL
-                    db_instance.enabled = True
-                    db_instance.hostName = '127.0.0.1'
-                    db_instance.name = 'default'
-                    db_instance.username = db_username
-                    db_instance.password = db_password
-                    db_instance.portNumber = 3306
-                    db_instance.useAlternateDataDirectory = False
-                    db_instance.useAlternateHostname = True
-                    db_instance.useAlternateInstallDirectory = False
-                    policy.databaseInstanceList = [db_instance]
-                    del policy.exchangeSettings
-                    client.Policy2.service.updatePolicy(policy=policy)
+    try:
+        policies = client.Policy2.service.getPolicies()
+        disk_safes = client.DiskSafe.service.getDiskSafes()
+        for agent in client.Agent.service.getAgents():
+            if DB_PLUGIN_CANDIDATES_RE.match(agent.hostname) or \
+                    DB_PLUGIN_CANDIDATES_RE.match(agent.description):
+                if not agent.databaseAddOnEnabled:
+                    logger.info('Enabling DB plugin for agent: %s', agent.hostname)
+                    agent.databaseAddOnEnabled = True
+                    client.Agent.service.updateAgent(agent)
+                agent_disk_safes = [ds for ds in disk_safes if ds.agentID == agent.id]
+                agent_policies = [p for p in policies \
+                    if p.enabled and hasattr(p, 'diskSafeID') and \
+                        p.diskSafeID in [ds.id for ds in agent_disk_safes]]
+                for policy in agent_policies:
+                    if not (hasattr(policy, 'databaseInstanceList') and \
+                            len(policy.databaseInstanceList) > 0):
+                        logger.info('Adding DB to agent (%s) policy %s (%s)',
+                            agent.hostname, policy.name, policy.id)
+                        db_instance = client.Policy2.factory.create('databaseInstance')
+                        db_instance.dataBaseType = client.Policy2.factory.create('dataBaseType').MYSQL
+                        db_instance.enabled = True
+                        db_instance.hostName = '127.0.0.1'
+                        db_instance.name = 'default'
+                        db_instance.username = db_username
+                        db_instance.password = db_password
+                        db_instance.portNumber = 3306
+                        db_instance.useAlternateDataDirectory = False
+                        db_instance.useAlternateHostname = True
+                        db_instance.useAlternateInstallDirectory = False
+                        policy.databaseInstanceList = [db_instance]
+                        del policy.exchangeSettings
+                        client.Policy2.service.updatePolicy(policy=policy)
+    finally:
+        client.close()
 
 if __name__ == '__main__':
     import sys
@@ -116,15 +124,9 @@ if __name__ == '__main__':
 
     config = r1soft.util.read_config(config_file)
 
-    handler_map = {
-        3: lambda server: handle_cdp3_server(server, db_user, db_pass),
-        5: lambda server: handle_cdp5_server(server, db_user, db_pass),
-    }
-
-    dummy_func = lambda server: (server, lambda: None)
-    for (server, handler) in r1soft.util.dispatch_handlers(config,
-            lambda s: handler_map.get(s['version'])(s)):
-        try:
-            handler()
-        except Exception as err:
-            logger.exception(err)
+    # one server at a time, errors are handed back instead of stopping the run
+    for (server, result) in r1soft.util.dispatch_handlers_stream(config,
+            r1soft.util.NamedHandler('enable-db-plugin', db_user, db_pass),
+            workers=1):
+        if isinstance(result, Exception):
+            logger.error('Failed on server %s: %s', server['hostname'], result)
@@ -21,7 +21,6 @@
 import logging
 import datetime
 import time
-import multiprocessing.pool
 
 import r1soft
 
@@ -30,42 +29,44 @@ logger = logging.getLogger('cdp-get-failed-backups')
 DAY_IN_SECONDS      = 60 * 60 * 24
 CDP3_STUCK_DELTA    = DAY_IN_SECONDS
 CDP5_STUCK_DELTA    = DAY_IN_SECONDS
+POLICY_TASK_TYPES   = ('DATA_PROTECTION_POLICY',)
+WORKERS             = 16
+WORKERS_PER_SERVER  = 4
+# how far the adaptive limiter can raise a server's share of the workers
+MAX_WORKERS_PER_SERVER = 8
 
-def _get_server_time(client):
+def _get_server_time(client_factory):
     # we should check with the server to find out what time it thinks it is
     # and use that for correct time deltas but there doesn't seem to be an
     # API method to get it so we'll just fake it with this for now
     return datetime.datetime.now()
 
-def read_config(config_filename):
-    with open(config_filename) as f:
-        config_raw = f.read().strip()
-    keys = ['version', 'hostname', 'port', 'ssl', 'username', 'password']
-    config = [dict(zip(keys, (field.strip() for field in line.strip().split(':')))) \
-            for line in config_raw.split('\n') \
-        if line.strip() and not line.startswith('#')]
-    for key in ['version', 'port', 'ssl']:
-        for server in config:
-            server[key] = int(server[key])
-    return config
-
+@r1soft.util.register_handler('failed-backups', versions=(2,))
 def handle_cdp2_server(server):
     last_successful = None
     host_results = []
-    client = r1soft.cdp2.CDP2Client(server['hostname'], server['username'],
-        server['password'], server['port'], server['ssl'])
-
-    for host_id in client.host.getHostIds():
-        tasks = [client.backupTask.getScheduledTaskSummary(tid) \
-            for tid in client.backupTask.getScheduledTaskIdsByHost(host_id)]
-        if not [t for t in tasks if t['taskType'] == 'Backup' and t['enabled']]:
-            # no enabled backup tasks
-            continue
-        host = client.host.getHostAsMap(host_id)
-        last_backup_task = client.host.getLastFinishedBackupTaskInfo(host_id)
+    client = r1soft.util.get_cdp2_client(server)
+
+    host_ids = client.host.getHostIds()
+    with client.batch() as batch:
+        task_id_lists = [batch.backupTask.getScheduledTaskIdsByHost(host_id) \
+            for host_id in host_ids]
+    with client.batch() as batch:
+        task_lists = [[batch.backupTask.getScheduledTaskSummary(tid) \
+                for tid in task_ids.get()] \
+            for task_ids in task_id_lists]
+    with client.batch() as batch:
+        backup_hosts = [(batch.host.getHostname(host_id),
+                    batch.host.getLastFinishedBackupTaskInfo(host_id)) \
+                for host_id, tasks in zip(host_ids, task_lists) \
+            if [t for t in (t.get() for t in tasks) \
+                if t['taskType'] == 'Backup' and t['enabled']]]
+
+    # hosts with no enabled backup tasks have already been skipped
+    for hostname, last_backup_task in ((h.get(), t.get()) for h, t in backup_hosts):
         task_timestamp = datetime.datetime.strptime(last_backup_task[1],
             r1soft.cdp2.TIMESTAMP_FMT)
-        host_result = (client.host.getHostname(host_id), task_timestamp)
+        host_result = (hostname, task_timestamp)
         if last_successful is None:
             last_successful = task_timestamp
         elif last_successful < task_timestamp:
@@ -76,78 +77,88 @@ def handle_cdp2_server(server):
 
     return (last_successful, host_results)
 
+def _get_inventory(client_factory):
+    client = client_factory.client(fast_reads=True)
+    try:
+        return r1soft.inventory.Inventory.from_client(client, volumes=False,
+            compact=True)
+    finally:
+        client.close()
+
+def _build_task_reader(server, client_factory):
+    # fetch on the scheduler's threads instead of a pool per server
+    return r1soft.cdp3.TaskHistoryReader(client_factory,
+        cache=r1soft.cache.TaskCache.for_server(server),
+        map_func=lambda func, items: r1soft.util.scheduled_map(
+            server['hostname'], func, items),
+        compact=True)
+
+@r1soft.util.register_handler('failed-backups', versions=(3, 4))
 def handle_cdp3_server(server):
     last_successful = None
     host_results = []
-    client = r1soft.cdp3.CDP3Client(server['hostname'], server['username'],
-        server['password'], server['port'], server['ssl'])
+    client_factory = r1soft.util.get_cdp3_factory(server)
+    inventory = _get_inventory(client_factory)
+    task_reader = _build_task_reader(server, client_factory)
 
-    for policy in client.Policy2.service.getPolicies():
-        if not policy.enabled:
-            continue
-        disksafe = client.DiskSafe.service.getDiskSafeByID(policy.diskSafeID)
-        agent = client.Agent.service.getAgentByID(disksafe.agentID)
-        task_list = [task for task in (client.TaskHistory.service.getTaskExecutionContextByID(tid) \
-                for tid in client.TaskHistory.service.getTaskExecutionContextIDsByAgent(disksafe.agentID)) \
-            if task.taskType == 'DATA_PROTECTION_POLICY' and 'executionTime' in task]
-        task_list.sort(key=lambda t: t.executionTime)
-        if task_list:
-            latest_task = task_list[-1]
-            if last_successful is None:
-                last_successful = latest_task.executionTime.replace(microsecond=0)
-            elif last_successful < latest_task.executionTime:
-                last_successful = latest_task.executionTime.replace(microsecond=0)
-        if policy.state not in ('ERROR', 'UNKNOWN'):
-            continue
-        try:
-            success = [t.executionTime for t in task_list \
-                if t.taskState == 'FINISHED'][-1].replace(microsecond=0)
-        except IndexError:
-            success = None
-        host_result = (agent.hostname, agent.description, success)
-        host_results.append(host_result)
+    try:
+        for policy, disksafe, agent in inventory.iter_policies(include_disabled=False):
+            # newest first, up to and including the latest finished task
+            task_list = task_reader.get_tasks(disksafe.agentID,
+                task_types=POLICY_TASK_TYPES,
+                stop=lambda t: t.taskState == 'FINISHED')
+            if task_list:
+                latest_task = task_list[0]
+                if last_successful is None:
+                    last_successful = latest_task.executionTime.replace(microsecond=0)
+                elif last_successful < latest_task.executionTime:
+                    last_successful = latest_task.executionTime.replace(microsecond=0)
+            if policy.state not in ('ERROR', 'UNKNOWN'):
+                continue
+            if task_list and task_list[-1].taskState == 'FINISHED':
+                success = task_list[-1].executionTime.replace(microsecond=0)
+            else:
+                success = None
+            host_result = (agent.hostname, agent.description, success)
+            host_results.append(host_result)
+    finally:
+        task_reader.close()
     return (last_successful, host_results)
 
+@r1soft.util.register_handler('failed-backups', versions=(5,))
 def handle_cdp5_server(server):
-    main_client = r1soft.cdp3.CDP3Client(server['hostname'], server['username'],
-        server['password'], server['port'], server['ssl'])
-    exec_time_key = lambda task: task.executionTime
+    client_factory = r1soft.util.get_cdp3_factory(server)
+    inventory = _get_inventory(client_factory)
+    task_reader = _build_task_reader(server, client_factory)
 
-    def _handle_policy(policy):
-        t_client = r1soft.cdp3.CDP3Client(server['hostname'], server['username'],
-            server['password'], server['port'], server['ssl'])
+    def _handle_policy(policy_info):
+        policy, disk_safe, agent = policy_info
 
         last_successful = None
         result = None
         stuck = False
-        disk_safe = t_client.DiskSafe.service.getDiskSafeByID(policy.diskSafeID)
-        agent = t_client.Agent.service.getAgentByID(disk_safe.agentID)
-        task_list = sorted(
-            (task for task in \
-                (t_client.TaskHistory.service.getTaskExecutionContextByID(task_id) \
-                    for task_id in t_client.TaskHistory.service.getTaskExecutionContextIDsByAgent(disk_safe.agentID)) \
-                if task.taskType == 'DATA_PROTECTION_POLICY' and \
-                    'executionTime' in task),
-            key=exec_time_key)
         if not policy.enabled:
             result = (agent.hostname, agent.description, '** DISABLED **')
         elif policy.state in ('OK', 'ALERT'):
-            # policy's last run was successful (possibly with alerts)
-            running_tasks = sorted(filter(lambda task: task.taskState == 'RUNNING', task_list), key=exec_time_key)
+            # policy's last run was successful (possibly with alerts), but
+            # a task that's been running for too long is stuck (however old)
+            running_tasks = task_reader.get_tasks(disk_safe.agentID,
+                task_types=POLICY_TASK_TYPES, states=('RUNNING',), limit=1)
             if running_tasks:
-                run_time = _get_server_time(t_client) - running_tasks[-1].executionTime.replace(microsecond=0)
+                run_time = _get_server_time(client_factory) - running_tasks[0].executionTime.replace(microsecond=0)
                 if (abs(run_time.days * DAY_IN_SECONDS) + run_time.seconds) > CDP5_STUCK_DELTA:
                     stuck = True
                     result = (agent.hostname, agent.description, '**STUCK** since %s' % \
-                        running_tasks[-1].executionTime.replace(microsecond=0))
+                        running_tasks[0].executionTime.replace(microsecond=0))
             if not stuck and (last_successful is None or \
                     last_successful < policy.lastReplicationRunTime):
                 last_successful = policy.lastReplicationRunTime.replace(microsecond=0)
         elif policy.state == 'ERROR':
             # policy's last run had an error
-            finished_tasks = sorted(filter(lambda task: task.taskState == 'FINISHED', task_list), key=exec_time_key)
+            finished_tasks = task_reader.get_tasks(disk_safe.agentID,
+                task_types=POLICY_TASK_TYPES, states=('FINISHED',), limit=1)
             if finished_tasks:
-                latest_error_time = finished_tasks[-1].executionTime.replace(microsecond=0)
+                latest_error_time = finished_tasks[0].executionTime.replace(microsecond=0)
                 result = (agent.hostname, agent.description, latest_error_time)
             else:
                 result = (agent.hostname, agent.description, '> 30 days')
@@ -156,10 +167,14 @@ def handle_cdp5_server(server):
             pass
         return (last_successful, result)
 
-    pool = multiprocessing.pool.ThreadPool(4)
-    results = pool.map(_handle_policy,
-        (p for p in main_client.Policy2.service.getPolicies() \
-            if 'diskSafeID' in p))
+    try:
+        results = r1soft.util.scheduled_map(server['hostname'], _handle_policy,
+            inventory.iter_policies(),
+            r1soft.util.get_adaptive_limiter(server['hostname'],
+                host=server['hostname'], initial=WORKERS_PER_SERVER,
+                max_limit=MAX_WORKERS_PER_SERVER))
+    finally:
+        task_reader.close()
     try:
         last_successful = max(r[0] for r in results if r[0] is not None)
     except ValueError:
@@ -167,36 +182,25 @@ def handle_cdp5_server(server):
     host_results = [r[1] for r in results if r[1] is not None]
     return (last_successful, host_results)
 
-def handle_server(server):
-    handle_func = {
-        2:  handle_cdp2_server,
-        3:  handle_cdp3_server,
-        4:  handle_cdp3_server,
-        5:  handle_cdp5_server,
-    }.get(server['version'])
-    try:
-        results = (server, False, handle_func(server))
-    except Exception as err:
-        results = (server, True, err)
-    return results
-
 if __name__ == '__main__':
     import sys
 
     try:
-        config = read_config(sys.argv[1])
+        config = r1soft.util.read_config(sys.argv[1])
     except IndexError:
         logger.error('Config file must be the first CLI argument')
         sys.exit(1)
 
-    for (server, has_err, result) in r1soft.util.dispatch_handlers_t(config, handle_server, 4):
-        if has_err:
-            print '^ %s ^ CDP%d ^ ERROR! ^' % (server['hostname'], server['version'])
-            print '| N/A | %s | %s |' % (result.__class__.__name__, result)
-        else:
-            print '^ %s ^ CDP%d ^ %s ^' % (server['hostname'], server['version'], result[0])
-            for host in result[1]:
-                try:
-                    print '| %s | %s | %s |' % host
-                except TypeError as e:
-                    print '| TypeError | %s | %s |' % (e, repr(host))
+    with r1soft.util.Scheduler(WORKERS, WORKERS_PER_SERVER) as scheduler:
+        for (server, result) in scheduler.dispatch(config,
+                r1soft.util.NamedHandler('failed-backups')):
+            if isinstance(result, Exception):
+                print '^ %s ^ CDP%d ^ ERROR! ^' % (server['hostname'], server['version'])
+                print '| N/A | %s | %s |' % (result.__class__.__name__, result)
+            else:
+                print '^ %s ^ CDP%d ^ %s ^' % (server['hostname'], server['version'], result[0])
+                for host in result[1]:
+                    try:
+                        print '| %s | %s | %s |' % host
+                    except TypeError as e:
+                        print '| TypeError | %s | %s |' % (e, repr(host))
@@ -24,61 +24,43 @@ import r1soft
 
 logger = logging.getLogger('cdp-server-locations')
 
+@r1soft.util.register_handler('server-locations', versions=(2,))
 def handle_cdp2_server(server):
-    agent_status = []
-    client = r1soft.cdp2.CDP2Client(server['hostname'], server['username'],
-        server['password'], server['port'], server['ssl'])
-
-    for host in (client.host.getHostAsMap(host_id) \
-            for host_id in client.host.getHostIds()):
-        # check if the agent is enabled and if it has any enabled backup tasks
-        active = host['enabled'] and any(task['taskType'] == 'Backup' and task['enabled'] \
-            for task in (client.backupTask.getScheduledTaskSummary(tid) \
-                for tid in client.backupTask.getScheduledTaskIdsByHost(host['hostID'])))
-        agent_status.append({
-            'hostname': host['hostname'],
-            'description': host['description'],
-            'type': r1soft.cdp2.HOST_TYPES[host['hostType']].upper(),
-            'active': active,
-            'cp_module': host['controlPanelModuleEnabled'],
-            'mysql_module': host['cdpForMySqlAddonEnabled'],
-        })
-    return agent_status
-
+    client = r1soft.util.get_cdp2_client(server)
+
+    host_ids = client.host.getHostIds()
+    with client.batch() as batch:
+        hosts = [batch.host.getHostAsMap(host_id) for host_id in host_ids]
+        task_id_lists = [batch.backupTask.getScheduledTaskIdsByHost(host_id) \
+            for host_id in host_ids]
+    with client.batch() as batch:
+        task_lists = [[batch.backupTask.getScheduledTaskSummary(tid) \
+                for tid in task_ids.get()] \
+            for task_ids in task_id_lists]
+
+    return [r1soft.model.Host.from_cdp2(host.get(), [t.get() for t in tasks]) \
+        for host, tasks in zip(hosts, task_lists)]
+
+@r1soft.util.register_handler('server-locations', versions=(3, 5))
 def handle_cdp3_server(server):
-    agent_status = []
-    client = r1soft.cdp3.CDP3Client(server['hostname'], server['username'],
-        server['password'], server['port'], server['ssl'])
-
-    pol2agent = lambda policy: client.Agent.service.getAgentByID( \
-        client.DiskSafe.service.getDiskSafeByID(policy.diskSafeID).agentID)
-
-    for agent, policy in ((pol2agent(p), p) \
-            for p in client.Policy2.service.getPolicies() if hasattr(p, 'diskSafeID')):
-        agent_status.append({
-            'hostname': agent.hostname,
-            'description': agent.description,
-            'type': agent.osType.upper(),
-            'active' :policy.enabled,
-            'recovery_point_limit': policy.recoveryPointLimit,
-            'cp_module': False, # we'll just leave this out for now
-            'mysql_module': bool(agent.databaseAddOnEnabled and \
-                (hasattr(policy, 'databaseInstanceList') and policy.databaseInstanceList)),
-        })
-    return agent_status
-
-handler_map = {
-    2: handle_cdp2_server,
-    3: handle_cdp3_server,
-    5: handle_cdp3_server,
-}
+    client = r1soft.util.get_cdp3_factory(server).client(fast_reads=True)
+
+    try:
+        inventory = r1soft.inventory.Inventory.from_client(client,
+            volumes=False, compact=True)
+    finally:
+        client.close()
+    return list(inventory.iter_hosts())
+
+# WSDLs each worker process loads up front
+CDP3_NAMESPACES = ('Agent', 'DiskSafe', 'Policy2')
 
 
 if __name__ == '__main__':
     import sys
 
     HOST_LIST_HEADER = '^ Hostname ^ Description ^ Backup Server ^ Host Type ^ Enabled ^ Recovery Point Limit ^ MySQL Module ^'
-    HOST_LIST_LINE = '| {hostname} | {description} | [[{server_link}|{server_hostname}]] | {type} | {active} | {recovery_point_limit} | {mysql_module} |'
+    HOST_LIST_LINE = '| {hostname} | {description} | [[{server_link}|{server_hostname}]] | {os_type} | {active} | {recovery_point_limit} | {mysql_module} |'
 
     SERVER_LIST_HEADER = '^ Backup Server ^ Polling Status ^'
     SERVER_LIST_LINE = '| {server_hostname} | {status} |'
@@ -92,25 +74,18 @@ if __name__ == '__main__':
     server_results = {}
     agent_lines = []
 
-    def handle_server(server):
-        handle_func = handler_map.get(server['version'])
-        try:
-            results = handle_func(server)
-        except Exception as err:
-            results = False
-        return (server, results)
-
     print HOST_LIST_HEADER
-    for server, results in r1soft.util.dispatch_handlers_t(config, handle_server):
-        if results is False:
+    for server, results in r1soft.util.dispatch_handlers_mp(config,
+            'server-locations', namespaces=CDP3_NAMESPACES):
+        if isinstance(results, Exception):
             server_results[server['hostname']] = False
             continue
         server_results[server['hostname']] = True
-        for agent in results:
+        for host in results:
             agent_lines.append(HOST_LIST_LINE.format(
                 server_hostname=server['hostname'],
                 server_link=r1soft.util.build_link(server),
-                **agent
+                **host.as_dict()
             ))
     print '\n'.join(sorted(agent_lines))
     print ''
@@ -18,23 +18,31 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import multiprocessing.pool
+
 import r1soft
 
+# calls in flight at once over the whole fleet
+WORKERS = 16
 
-def get_clients(config):
-    return dict((server['hostname'], r1soft.util.build_cdp3_client(server)) \
+def get_clients(config, pool):
+    return dict((server['hostname'],
+            r1soft.util.build_async_cdp3_client(server, pool)) \
         for server in config if server['version'] > 2)
 
 def get_policies(clients):
     print 'Loading policy lists, this may take a while...'
-    def get_policies_helper(hostname, client):
+    # every server's list is loaded at once
+    pending = [(hostname, client.Policy2.service.getPolicies()) \
+        for hostname, client in clients.iteritems()]
+    policies = {}
+    for hostname, result in pending:
         try:
-            return client.Policy2.service.getPolicies()
+            policies[hostname] = result.get()
         except Exception as err:
             print 'Error loading policies (%s): %s' % (hostname, err)
-            return []
-    return dict((hostname, get_policies_helper(hostname, client)) \
-        for hostname, client in clients.iteritems())
+            policies[hostname] = []
+    return policies
 
 def filter_policies(server, policies):
     return dict((hostname, [p for p in policy_list \
@@ -42,24 +50,35 @@ def filter_policies(server, policies):
         for hostname, policy_list in policies.iteritems())
 
 def toggle_policy_list(clients, selected_policies, enable):
+    pending = []
     for hostname, policy_list in selected_policies.iteritems():
         for policy in [p for p in policy_list if p.enabled != enable]:
-            try:
-                if enable:
-                    print 'Enabling policy (%s) on server: %s' % (policy.name, hostname)
-                    clients[hostname].Policy2.service.enablePolicy(policy)
-                else:
-                    print 'Disabling policy (%s) on server: %s' % (policy.name, hostname)
-                    clients[hostname].Policy2.service.disablePolicy(policy)
-            except Exception as err:
-                print 'Error on policy: %s' % policy.name
+            if enable:
+                print 'Enabling policy (%s) on server: %s' % (policy.name, hostname)
+                result = clients[hostname].Policy2.service.enablePolicy(policy)
+            else:
+                print 'Disabling policy (%s) on server: %s' % (policy.name, hostname)
+                result = clients[hostname].Policy2.service.disablePolicy(policy)
+            pending.append((policy, result))
+    for policy, result in pending:
+        try:
+            result.get()
+        except Exception as err:
+            print 'Error on policy: %s' % policy.name
 
 def toggle_policies(config, server_list, enable):
-    clients = get_clients(config)
-    policies = get_policies(clients)
+    pool = multiprocessing.pool.ThreadPool(WORKERS)
+    clients = get_clients(config, pool)
+    try:
+        policies = get_policies(clients)
 
-    for server in server_list:
-        toggle_policy_list(clients, filter_policies(server, policies), enable)
+        for server in server_list:
+            toggle_policy_list(clients, filter_policies(server, policies), enable)
+    finally:
+        pool.close()
+        pool.join()
+        for client in clients.itervalues():
+            client.close()
 
 if __name__ == '__main__':
     import sys
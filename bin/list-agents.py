@@ -32,5 +32,8 @@ if __name__ == '__main__':
         client = r1soft.cdp3.CDP3Client(host, opts.username, opts.password)
         if opts.decoration:
             print opts.decoration + host + opts.decoration[::-1]
-        for agent in client.Agent.service.getAgents():
-            print agent.hostname
+        try:
+            for agent in client.Agent.service.getAgents():
+                print agent.hostname
+        finally:
+            client.close()
@@ -17,13 +17,41 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import importlib
 import logging
 import os
+import sys
+import types
 
 # __all__ = ['cdp2', 'cdp3', 'util']
-from . import cdp2
-from . import cdp3
-from . import util
+# submodules are imported on first use (r1soft.cdp3.CDP3Client etc.) so
+# importing the package stays cheap and only pulls in suds, xmlrpclib and
+# friends when they're actually needed
+SUBMODULES = frozenset([
+    'breaker',
+    'cache',
+    'cdp2',
+    'cdp3',
+    'instrument',
+    'inventory',
+    'migrate',
+    'model',
+    'ratelimit',
+    'replay',
+    'sslcontext',
+    'timeouts',
+    'transport',
+    'util',
+])
+
+class _LazyPackage(types.ModuleType):
+    def __getattr__(self, name):
+        if name in SUBMODULES:
+            return importlib.import_module('.' + name, self.__name__)
+        raise AttributeError('\'module\' object has no attribute \'%s\'' % name)
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | SUBMODULES)
 
 _logger = logging.getLogger('r1soft')
 _logger.addHandler(logging.StreamHandler())
@@ -31,3 +59,9 @@ if os.environ.get('R1SOFT_DEBUG', False):
     _logger.setLevel(logging.DEBUG)
 else:
     _logger.setLevel(logging.WARNING)
+
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+# keep the original module alive, its globals get wiped if it's collected
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import httplib
+import logging
+import socket
+import threading
+import time
+
+logger = logging.getLogger('r1soft.breaker')
+
+DEFAULT_FAILURE_THRESHOLD   = 3
+DEFAULT_RESET_TIMEOUT       = 30
+DEFAULT_PROBE_TIMEOUT       = 5
+
+class CircuitOpenError(Exception):
+    """The server's circuit breaker is open, the call wasn't attempted
+    """
+
+def is_connection_failure(err):
+    """Default check for errors that count against a breaker: failing to
+    reach the server at all, as opposed to the server rejecting a call
+    """
+
+    # socket.error and urllib2.URLError are both IOErrors
+    return isinstance(err, (IOError, httplib.HTTPException))
+
+def tcp_probe(host, port, timeout=DEFAULT_PROBE_TIMEOUT):
+    """Build a probe that checks if host:port accepts connections
+    """
+
+    def probe():
+        sock = socket.create_connection((host, port), timeout)
+        sock.close()
+    return probe
+
+class CircuitBreaker(object):
+    """Per-server circuit breaker
+
+    Closed: calls go through, consecutive failures are counted. After
+    failure_threshold of them the breaker opens and calls fail right away
+    with CircuitOpenError. While open, a background thread runs the probe
+    every reset_timeout seconds (without a probe the breaker just waits
+    reset_timeout) and once it succeeds the breaker goes half-open: a single
+    trial call is let through, closing the breaker if it works and opening
+    it again if it doesn't.
+    """
+
+    CLOSED      = 'closed'
+    OPEN        = 'open'
+    HALF_OPEN   = 'half-open'
+
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+            reset_timeout=DEFAULT_RESET_TIMEOUT, probe=None,
+            is_failure=is_connection_failure):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure
+        self._probe = probe
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._prober = None
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and self._probe is None and \
+                    time.time() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """Check if a call may go through right now
+        """
+
+        state = self.state
+        with self._lock:
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info('Circuit for %s closed', self.name)
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == self.HALF_OPEN or \
+                    self._failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        if self._state != self.OPEN:
+            logger.warn('Circuit for %s opened after %d failures', self.name,
+                self._failures)
+        self._state = self.OPEN
+        self._opened_at = time.time()
+        if self._probe is not None and self._prober is None:
+            self._prober = threading.Thread(target=self._run_probe,
+                name='breaker-probe-%s' % self.name)
+            self._prober.daemon = True
+            self._prober.start()
+
+    def _run_probe(self):
+        while True:
+            time.sleep(self.reset_timeout)
+            try:
+                self._probe()
+            except Exception as err:
+                logger.debug('Probe for %s failed: %s', self.name, err)
+                continue
+            with self._lock:
+                if self._state == self.OPEN:
+                    logger.info('Probe for %s succeeded, circuit half-open', self.name)
+                    self._state = self.HALF_OPEN
+                self._prober = None
+                return
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError('Circuit for %s is %s' % (self.name, self.state))
+        try:
+            result = func(*args, **kwargs)
+        except Exception as err:
+            if self.is_failure(err):
+                self.record_failure()
+            else:
+                # the server answered, so it's up
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(host, port, **kwargs):
+    """Get the shared CircuitBreaker for a server, probing recovery with a
+    TCP connect unless another probe is given
+    """
+
+    with _breakers_lock:
+        breaker = _breakers.get((host, port), None)
+        if breaker is None:
+            kwargs.setdefault('probe', tcp_probe(host, port))
+            breaker = _breakers[(host, port)] = CircuitBreaker(
+                '%s:%s' % (host, port), **kwargs)
+        return breaker
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import cPickle as pickle
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import suds
+import suds.cache
+import suds.sudsobject
+
+from .model import Record
+
+logger = logging.getLogger('r1soft.cache')
+
+# bump this whenever the layout of the cache changes so that stale entries
+# from an older version of the library are thrown away
+CACHE_FORMAT_VERSION = 1
+
+# parsed WSDLs only change when the CDP server is upgraded (the major version
+# is part of the cache key, and clients reload the WSDL when a method or type
+# is missing from it) so we can hold on to them for quite a while
+DEFAULT_TTL = 60 * 60 * 24 * 7
+
+def default_cache_dir():
+    """Get the base directory for the on-disk caches
+
+    Can be overridden with the R1SOFT_CACHE_DIR environment variable.
+    """
+
+    return os.environ.get('R1SOFT_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'r1soft'))
+
+def build_wsdl_cache_dir(host, port, version=None, base_dir=None):
+    """Build the cache directory for a single CDP server
+    """
+
+    if base_dir is None:
+        base_dir = os.path.join(default_cache_dir(), 'wsdl')
+    return os.path.join(base_dir, '{host}_{port}_v{version}'.format(
+        host=host.replace(os.sep, '_'),
+        port=port,
+        version='x' if version is None else version))
+
+class WsdlCache(suds.cache.ObjectCache):
+    """On-disk cache of parsed (pickled) WSDL definitions for one CDP server
+
+    Use with suds' cachingpolicy=1 so the entire parsed definitions object
+    (including imported schemas) is cached, meaning a warm cache does no
+    WSDL fetches and no parsing at all.
+    """
+
+    fnprefix = 'r1soft-wsdl'
+
+    def __init__(self, host, port, version=None, base_dir=None, ttl=DEFAULT_TTL):
+        self.host = host
+        self.port = port
+        self.version = version
+        # a ttl of 0 means the entries never expire
+        suds.cache.ObjectCache.__init__(self,
+            build_wsdl_cache_dir(host, port, version, base_dir),
+            seconds=int(ttl))
+
+    def checkversion(self):
+        version = '{0}:{1}'.format(CACHE_FORMAT_VERSION, suds.__version__)
+        path = os.path.join(self.location, 'version')
+        try:
+            with self.open(path) as f:
+                if f.read() == version:
+                    return
+        except IOError:
+            pass
+        logger.debug('Cache version mismatch, clearing: %s', self.location)
+        self.clear()
+        with self.open(path, 'w') as f:
+            f.write(version)
+
+    def clear(self):
+        if not os.path.isdir(self.location):
+            return
+        for fn in os.listdir(self.location):
+            if fn.startswith(self.fnprefix):
+                logger.debug('Removing cached WSDL: %s', fn)
+                os.remove(os.path.join(self.location, fn))
+
+    def invalidate(self):
+        """Drop every cached WSDL for this server
+        """
+
+        logger.info('Invalidating WSDL cache for %s:%s', self.host, self.port)
+        self.clear()
+
+def clear_wsdl_cache(base_dir=None):
+    """Drop the cached WSDLs for every server
+    """
+
+    if base_dir is None:
+        base_dir = os.path.join(default_cache_dir(), 'wsdl')
+    if os.path.isdir(base_dir):
+        logger.info('Clearing WSDL cache: %s', base_dir)
+        shutil.rmtree(base_dir)
+
+# task states that can't change any more, contexts in any other state (even
+# ones not known about here) are never cached so they get fetched again on
+# the next run
+TERMINAL_TASK_STATES = ('FINISHED', 'ERROR', 'CANCELLED')
+
+DEFAULT_TASK_CACHE_SIZE = 500000
+
+# task cache files already evicted from by this process
+_evicted = set()
+_evicted_lock = threading.Lock()
+
+def to_plain(obj):
+    """Convert a suds object or model record (and anything nested in it) into
+    plain dicts and lists that can be pickled
+    """
+
+    if isinstance(obj, (suds.sudsobject.Object, Record)):
+        return dict((key, to_plain(value)) for key, value in obj)
+    elif isinstance(obj, (list, tuple)):
+        return [to_plain(value) for value in obj]
+    elif isinstance(obj, basestring):
+        return unicode(obj)
+    return obj
+
+class CachedTaskContext(dict):
+    """Plain stand-in for a suds task execution context loaded from the cache
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+class TaskCache(object):
+    """Persistent cache of task execution contexts that reached a terminal
+    state, keyed on server and context ID
+
+    The cache is a single SQLite database that can be shared between servers
+    (and processes). Once it holds more than max_size contexts, the ones
+    with the oldest executionTime are evicted, checked when a cache that
+    added contexts is closed (at most once per file per process).
+    """
+
+    def __init__(self, server, filename=None, max_size=DEFAULT_TASK_CACHE_SIZE):
+        if filename is None:
+            filename = os.path.join(default_cache_dir(), 'tasks.sqlite')
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.server = server
+        self.max_size = max_size
+        self._filename = os.path.abspath(filename)
+        self._inserted = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS task_contexts (
+                server TEXT NOT NULL,
+                id TEXT NOT NULL,
+                execution_time REAL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (server, id))''')
+            self._db.execute('''CREATE INDEX IF NOT EXISTS
+                task_contexts_execution_time ON task_contexts (execution_time)''')
+
+    @classmethod
+    def for_server(cls, server, **kwargs):
+        """Build the cache for a server entry from the config file
+        """
+
+        return cls('{0}:{1}'.format(server['hostname'], server['port']), **kwargs)
+
+    def get_many(self, task_ids):
+        """Get the cached contexts for task_ids as a dict, IDs that aren't
+        cached are left out
+        """
+
+        keys = [unicode(task_id) for task_id in task_ids]
+        found = {}
+        with self._lock:
+            # stay under SQLite's limit on query parameters
+            for offset in xrange(0, len(keys), 500):
+                chunk = keys[offset:offset + 500]
+                rows = self._db.execute(
+                    'SELECT id, data FROM task_contexts WHERE server = ? AND id IN ({0})' \
+                        .format(', '.join('?' * len(chunk))),
+                    [self.server] + chunk)
+                for task_id, data in rows:
+                    found[task_id] = CachedTaskContext(pickle.loads(str(data)))
+        return dict((task_id, found[key]) for task_id, key in zip(task_ids, keys) \
+            if key in found)
+
+    def put_many(self, tasks):
+        """Cache the tasks (a dict of ID -> context) that are in a terminal
+        state
+        """
+
+        rows = []
+        for task_id, task in tasks.iteritems():
+            if task is None or task.taskState not in TERMINAL_TASK_STATES:
+                continue
+            execution_time = getattr(task, 'executionTime', None)
+            if execution_time is not None:
+                execution_time = time.mktime(execution_time.timetuple())
+            rows.append((self.server, unicode(task_id), execution_time,
+                sqlite3.Binary(pickle.dumps(to_plain(task), pickle.HIGHEST_PROTOCOL))))
+        if rows:
+            with self._lock:
+                with self._db:
+                    self._db.executemany('INSERT OR REPLACE INTO task_contexts ' \
+                        '(server, id, execution_time, data) VALUES (?, ?, ?, ?)', rows)
+                self._inserted += len(rows)
+        return len(rows)
+
+    def evict(self):
+        """Drop the contexts with the oldest executionTime until the cache is
+        down to max_size
+        """
+
+        with self._lock:
+            with self._db:
+                count = self._db.execute('SELECT COUNT(*) FROM task_contexts').fetchone()[0]
+                if count > self.max_size:
+                    logger.debug('Evicting %d cached task contexts', count - self.max_size)
+                    self._db.execute('DELETE FROM task_contexts WHERE rowid IN ' \
+                        '(SELECT rowid FROM task_contexts ORDER BY execution_time LIMIT ?)',
+                        (count - self.max_size,))
+
+    def clear(self):
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM task_contexts WHERE server = ?',
+                    (self.server,))
+
+    def close(self):
+        if self._inserted:
+            with _evicted_lock:
+                evict = self._filename not in _evicted
+                _evicted.add(self._filename)
+            if evict:
+                self.evict()
+        with self._lock:
+            self._db.close()
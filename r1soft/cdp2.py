@@ -17,9 +17,20 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import httplib
 import logging
+import socket
+import threading
+import time
 import xmlrpclib
 
+from .breaker import get_circuit_breaker, is_connection_failure
+from . import instrument
+from . import replay
+from .sslcontext import create_ssl_context
+from . import timeouts
+from .timeouts import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+
 logger = logging.getLogger('r1soft.cdp2')
 
 # example: Thu Jun 27 2013 02:03:33 EDT
@@ -31,6 +42,18 @@ HOST_TYPES = {
     1: 'WINDOWS',
 }
 
+# max number of calls sent in a single system.multicall request
+DEFAULT_BATCH_SIZE = 100
+
+def is_server_failure(err):
+    """Check if an error means the server is unreachable or failing, for the
+    circuit breaker (Faults are the server answering, so they don't count)
+    """
+
+    if isinstance(err, xmlrpclib.ProtocolError):
+        return err.errcode >= 500
+    return is_connection_failure(err)
+
 def build_xmlrpc_url(host, username, password, port=None, ssl=True):
     """
     """
@@ -49,6 +72,280 @@ def build_xmlrpc_url(host, username, password, port=None, ssl=True):
     logger.debug('Built XMLRPC URL: %s', url)
     return url
 
+class _CountingResponse(object):
+    """Wrap an HTTPResponse counting the bytes read from it
+    """
+
+    def __init__(self, response):
+        self._response = response
+        self.bytes_read = 0
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        self.bytes_read += len(data)
+        return data
+
+class _CountingTransportMixin:
+    """Record the payload sizes of XML-RPC requests with r1soft.instrument,
+    mixed in ahead of an xmlrpclib transport
+    """
+
+    def send_content(self, connection, request_body):
+        instrument.record_bytes(sent=len(request_body))
+        xmlrpclib.Transport.send_content(self, connection, request_body)
+
+    def parse_response(self, response):
+        if not instrument.enabled():
+            return xmlrpclib.Transport.parse_response(self, response)
+        response = _CountingResponse(response)
+        try:
+            return xmlrpclib.Transport.parse_response(self, response)
+        finally:
+            instrument.record_bytes(received=response.bytes_read)
+
+class CountingTransport(_CountingTransportMixin, xmlrpclib.Transport):
+    """Plain HTTP XML-RPC transport recording payload sizes
+    """
+
+class CountingSafeTransport(_CountingTransportMixin, xmlrpclib.SafeTransport):
+    """Plain HTTPS XML-RPC transport recording payload sizes
+    """
+
+class PersistentTransport(_CountingTransportMixin, xmlrpclib.SafeTransport):
+    """XML-RPC transport keeping one persistent HTTP/1.1 connection per thread
+
+    Dropped connections are re-opened transparently (xmlrpclib retries a
+    request once when the kept-alive connection turns out to be closed).
+    Connecting gives up after connect_timeout and waiting on a response after
+    read_timeout, raising a timeouts.CDPTimeoutError.
+    """
+
+    def __init__(self, use_https=True, context=None, use_datetime=0,
+            connect_timeout=None, read_timeout=None):
+        xmlrpclib.SafeTransport.__init__(self, use_datetime, context)
+        self.use_https = use_https
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._local = threading.local()
+
+    def single_request(self, host, handler, request_body, verbose=0):
+        try:
+            return xmlrpclib.SafeTransport.single_request(self, host, handler,
+                request_body, verbose)
+        except socket.timeout as err:
+            self.close()
+            raise timeouts.read_timeout_error(err, self.get_host_info(host)[0],
+                self.read_timeout)
+
+    def make_connection(self, host):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and connection[0] == host:
+            conn = connection[1]
+            if conn.sock is None:
+                timeouts.connect(conn, self.connect_timeout, self.read_timeout)
+            else:
+                timeouts.set_read_timeout(conn, self.read_timeout)
+            return conn
+        if connection is not None:
+            connection[1].close()
+
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        logger.debug('Opening new connection to %s', chost)
+        if self.use_https:
+            conn = httplib.HTTPSConnection(chost, None, context=self.context,
+                **(x509 or {}))
+        else:
+            conn = httplib.HTTPConnection(chost)
+        self._local.connection = (host, conn)
+        timeouts.connect(conn, self.connect_timeout, self.read_timeout)
+        return conn
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self._local.connection = None
+            connection[1].close()
+
+def _replay_url(host, handler):
+    # leave the credentials out of the recording
+    return 'xmlrpc://%s%s' % (host.rpartition('@')[2], handler)
+
+class RecordingXmlRpcTransport:
+    """XML-RPC transport passing requests on to another transport and
+    recording them with a replay.Recorder
+
+    Responses are recorded re-encoded from what the transport returned,
+    which is equivalent to but not byte for byte what the server sent.
+    """
+
+    def __init__(self, transport, recorder):
+        self.transport = transport
+        self.recorder = recorder
+
+    def request(self, host, handler, request_body, verbose=0):
+        url = _replay_url(host, handler)
+        start = time.time()
+        try:
+            result = self.transport.request(host, handler, request_body, verbose)
+        except xmlrpclib.Fault as err:
+            self.recorder.record('POST', url, request_body, start,
+                time.time() - start, status=200,
+                body=xmlrpclib.dumps(err, methodresponse=True))
+            raise
+        except xmlrpclib.ProtocolError as err:
+            self.recorder.record('POST', url, request_body, start,
+                time.time() - start, status=err.errcode, body=err.errmsg)
+            raise
+        except Exception as err:
+            self.recorder.record('POST', url, request_body, start,
+                time.time() - start, error=err)
+            raise
+        self.recorder.record('POST', url, request_body, start,
+            time.time() - start, status=200,
+            body=xmlrpclib.dumps(result, methodresponse=True, allow_none=True))
+        return result
+
+    def close(self):
+        self.transport.close()
+
+class ReplayXmlRpcTransport:
+    """XML-RPC transport answering requests from a replay.Player
+    """
+
+    def __init__(self, player, use_datetime=0):
+        self.player = player
+        self._use_datetime = use_datetime
+
+    def request(self, host, handler, request_body, verbose=0):
+        url = _replay_url(host, handler)
+        status, data = self.player.lookup('POST', url, request_body)
+        instrument.record_bytes(len(request_body), len(data or ''))
+        if status != 200:
+            raise xmlrpclib.ProtocolError(url, status, data, {})
+        return xmlrpclib.loads(data, self._use_datetime)[0]
+
+    def close(self):
+        pass
+
+class BatchResult(object):
+    """Result of a single call in a CDP2Batch, available after the batch has
+    been executed
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._done = False
+        self._value = None
+        self._error = None
+
+    def _set(self, value=None, error=None):
+        self._value = value
+        self._error = error
+        self._done = True
+
+    def ready(self):
+        return self._done
+
+    def get(self):
+        """Get the call's return value, raises the call's Fault if it failed
+        """
+
+        if not self._done:
+            raise RuntimeError('Batch has not been executed yet: %s' % self.name)
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+class _BatchMethod(object):
+    def __init__(self, batch, name):
+        self._batch = batch
+        self._name = name
+
+    def __getattr__(self, name):
+        return _BatchMethod(self._batch, '%s.%s' % (self._name, name))
+
+    def __call__(self, *args):
+        return self._batch._queue(self._name, args)
+
+class CDP2Batch(object):
+    """Queue up XML-RPC calls and send them with as few system.multicall
+    requests as possible
+
+    Calls return a BatchResult right away, the calls are sent by send() or
+    execute() (or when leaving the with block). If the server doesn't support
+    system.multicall the calls are sent one at a time instead.
+    """
+
+    def __init__(self, client, size=DEFAULT_BATCH_SIZE):
+        self._client = client
+        self._size = size
+        self._calls = []
+
+    def __getattr__(self, name):
+        return _BatchMethod(self, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _queue(self, name, args):
+        result = BatchResult(name)
+        self._calls.append((name, args, result))
+        return result
+
+    def _send_multicall(self, calls):
+        multicall = xmlrpclib.MultiCall(self._client)
+        for name, args, result in calls:
+            getattr(multicall, name)(*args)
+        responses = multicall()
+        for i, (name, args, result) in enumerate(calls):
+            try:
+                result._set(value=responses[i])
+            except xmlrpclib.Fault as err:
+                result._set(error=err)
+
+    def _send_each(self, calls):
+        for name, args, result in calls:
+            try:
+                result._set(value=getattr(self._client, name)(*args))
+            except xmlrpclib.Fault as err:
+                result._set(error=err)
+
+    def send(self):
+        """Send all the queued calls, returns their BatchResults in order
+
+        Faults from single calls are raised by their BatchResult's get().
+        """
+
+        calls, self._calls = self._calls, []
+        for offset in xrange(0, len(calls), self._size):
+            chunk = calls[offset:offset + self._size]
+            if self._client._supports_multicall:
+                try:
+                    self._send_multicall(chunk)
+                    continue
+                except xmlrpclib.Fault as err:
+                    logger.info('system.multicall failed, falling back to ' \
+                        'single calls: %s', err)
+                    self._client._supports_multicall = False
+            self._send_each(chunk)
+        return [result for name, args, result in calls]
+
+    def execute(self):
+        """Send all the queued calls, returns their values in order
+        """
+
+        return [result.get() for result in self.send()]
+
 class CDP2Client(xmlrpclib.ServerProxy):
     """
     """
@@ -56,7 +353,54 @@ class CDP2Client(xmlrpclib.ServerProxy):
     PORT_HTTP   = 8084
     PORT_HTTPS  = 8085
 
-    def __init__(self, host, username, password, port=None, ssl=True):
+    def __init__(self, host, username, password, port=None, ssl=True,
+            verify_ssl=True, persistent=True, circuit_breaker=True,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+            read_timeout=DEFAULT_READ_TIMEOUT, call_deadline=None):
+        self._supports_multicall = True
+        self._call_deadline = call_deadline
+        if port is None:
+            port = self.PORT_HTTPS if ssl else self.PORT_HTTP
+        self._server_name = '%s:%s' % (host, port)
+        if circuit_breaker:
+            self._breaker = get_circuit_breaker(host, port,
+                is_failure=is_server_failure)
+        else:
+            self._breaker = None
+        if persistent:
+            transport = PersistentTransport(ssl,
+                create_ssl_context(verify=verify_ssl) if ssl else None,
+                connect_timeout=connect_timeout, read_timeout=read_timeout)
+        elif ssl:
+            transport = CountingSafeTransport()
+        else:
+            transport = CountingTransport()
         # looks like ServerProxy is an oldstyle class, can't use super()
         xmlrpclib.ServerProxy.__init__(self, build_xmlrpc_url(
-            host, username, password, port, ssl))
+            host, username, password, port, ssl), transport=transport)
+        session = replay.active()
+        if session is not None:
+            # record or replay every request (see r1soft.replay)
+            self._ServerProxy__transport = session.xmlrpc_transport(
+                self._ServerProxy__transport)
+
+    def _ServerProxy__request(self, methodname, params):
+        # every call (including multicalls) ends up here
+        namespace, _, method = methodname.rpartition('.')
+        call = instrument.CallInfo('xmlrpc', self._server_name,
+            namespace or None, method)
+        with timeouts.deadline(self._call_deadline):
+            return instrument.call(call, self._breaker_request,
+                (methodname, params), faults=(xmlrpclib.Fault,))
+
+    def _breaker_request(self, methodname, params):
+        request = xmlrpclib.ServerProxy._ServerProxy__request
+        if self._breaker is None:
+            return request(self, methodname, params)
+        return self._breaker.call(request, self, methodname, params)
+
+    def batch(self, size=DEFAULT_BATCH_SIZE):
+        """Get a CDP2Batch for sending many calls in a few requests
+        """
+
+        return CDP2Batch(self, size)
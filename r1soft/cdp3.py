@@ -17,15 +17,54 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import cPickle as pickle
+import httplib
+import itertools
 import logging
+import random
+import socket
 import suds
+import suds.client
+import suds.options
+import suds.transport.https
+import threading
 import time
 import urllib2
 import ssl
-from .sslcontext import create_ssl_context, HTTPSTransport
+import weakref
+
+try:
+    import multiprocessing.pool
+except ImportError:
+    multiprocessing = None
+
+from .sslcontext import create_ssl_context
+from .cache import WsdlCache
+from .ratelimit import TokenBucket, get_rate_limiter, get_retry_budget
+from .breaker import get_circuit_breaker
+from . import instrument
+from . import model
+from . import replay
+from . import timeouts
+from .timeouts import CallTimeout, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from .transport import ConnectionPool, CountingHttpTransport, HTTPSTransport, \
+    OfflineTransport, PooledHTTPTransport, DEFAULT_POOL_SIZE, \
+    DEFAULT_IDLE_TIMEOUT
 
 logger = logging.getLogger('r1soft.cdp3')
 
+DEFAULT_ASYNC_WORKERS = 16
+
+DEFAULT_RETRIES         = 3
+DEFAULT_BACKOFF         = 0.5
+DEFAULT_BACKOFF_MAX     = 30.0
+RETRY_HTTP_CODES        = (502, 503, 504)
+# SOAP faults only get retried if their faultstring says the server was too
+# busy, anything else (bad IDs, validation errors) fails the same way again
+RETRY_FAULT_PATTERNS    = ('busy', 'try again', 'temporarily unavailable',
+    'too many', 'overloaded')
+IDEMPOTENT_METHOD_PREFIXES = ('get',)
+
 def build_wsdl_url(host, namespace, port=None, ssl=True):
     """Build WSDL URL for CDP3+ API
     """
@@ -55,17 +94,138 @@ ssl.SSLSocket = PoodleSSLSocket
 
 UNSAFE_HttpsNoVerifyTransport = lambda **kwargs: HTTPSTransport(context=create_ssl_context(verify=False), **kwargs)
 
+def copy_definitions(data, options):
+    """Unpickle a private copy of parsed WSDL definitions (pickled by
+    CDP3ClientFactory) for a client with the given suds options
+    """
+
+    wsdl = pickle.loads(data)
+    # restored the same way suds does when loading them from its cache
+    wsdl.options = options
+    for imp in wsdl.imports:
+        imp.imported.options = options
+    return wsdl
+
+def clone_soap_client(template, definitions=None, **kwargs):
+    """Get a copy of a suds Client that shares the parsed WSDL of the template
+
+    Unlike suds.client.Client.clone() the options aren't deep-copied from the
+    template but set fresh from kwargs, so each clone gets its own transport
+    (and cookies) instead of a copy of the template's.
+
+    suds keeps the state of the reply being unmarshalled on the definitions'
+    bindings, so clones sharing them must not be used from separate threads.
+    Given pickled definitions (see CDP3ClientFactory.template()) the clone
+    gets its own copy of them instead.
+    """
+
+    clone = suds.client.Client.__new__(suds.client.Client)
+    clone.options = suds.options.Options()
+    clone.options.transport = suds.transport.https.HttpAuthenticated()
+    clone.set_options(**kwargs)
+    if definitions is None:
+        clone.wsdl = template.wsdl
+        clone.factory = template.factory
+        clone.sd = template.sd
+    else:
+        clone.wsdl = copy_definitions(definitions, clone.options)
+        clone.factory = suds.client.Factory(clone.wsdl)
+        clone.sd = [suds.client.ServiceDefinition(clone.wsdl, service) \
+            for service in clone.wsdl.services]
+    clone.service = suds.client.ServiceSelector(clone, clone.wsdl.services)
+    clone.messages = dict(tx=None, rx=None)
+    return clone
+
+# hot read calls the fast_reads option parses straight into r1soft.model
+# records, (namespace, method) -> (record type, returns a list)
+FAST_READ_METHODS = {
+    ('Agent', 'getAgents'): (model.Agent, True),
+    ('Agent', 'getAgentByID'): (model.Agent, False),
+    ('DiskSafe', 'getDiskSafes'): (model.DiskSafe, True),
+    ('DiskSafe', 'getDiskSafeByID'): (model.DiskSafe, False),
+    ('Policy2', 'getPolicies'): (model.Policy, True),
+    ('Policy2', 'getPolicyById'): (model.Policy, False),
+    ('TaskHistory', 'getTaskExecutionContextByID'): (model.TaskContext, False),
+}
+
+def has_fast_reads(namespace):
+    return any(ns == namespace for ns, method in FAST_READ_METHODS)
+
 class SoapClientWrapper(object):
     def __init__(self, real_client, **kwargs):
         self._options = kwargs
         self._real_client = real_client
         self._post_init()
 
+    def _reload_wsdl(self, err):
+        # a method or type missing from the WSDL most likely means the cached
+        # copy is from before a server upgrade, reload it (once)
+        reload_clients = self._options.pop('reload_clients', None)
+        if reload_clients is None:
+            return False
+        logger.warn('%s, reloading WSDL for namespace: %s', err,
+            self._options.get('namespace', None))
+        self._real_client, self._options['fast_client'] = reload_clients()
+        return True
+
+    def _service_method(self, name):
+        try:
+            return self._lookup_method(name)
+        except suds.MethodNotFound as err:
+            if not self._reload_wsdl(err):
+                raise
+            return self._lookup_method(name)
+
+    def _lookup_method(self, name):
+        fast_read = FAST_READ_METHODS.get(
+            (self._options.get('namespace', None), name), None)
+        if fast_read is None:
+            return self._check_records(name,
+                getattr(self._real_client.service, name))
+        fast_client = self._options.get('fast_client', None)
+        if fast_client is None:
+            return getattr(self._real_client.service, name)
+        # the fast client returns the raw response instead of unmarshalling
+        # it into suds objects
+        raw_func = getattr(fast_client.service, name)
+        record_type, many = fast_read
+        def fast_read_wrapper(*args, **kwargs):
+            records = model.parse_response(raw_func(*args, **kwargs), record_type)
+            if many:
+                return records
+            return records[0] if records else None
+        return fast_read_wrapper
+
+    def _check_records(self, name, func):
+        # suds would happily marshal a record into an empty element
+        def record_check_wrapper(*args, **kwargs):
+            for value in itertools.chain(args, kwargs.itervalues()):
+                if isinstance(value, model.Record):
+                    raise TypeError('%s.%s() can\'t be passed a %s record, '
+                        'only suds objects (get it without fast_reads)' % (
+                            self._options.get('namespace', None), name,
+                            type(value).__name__))
+            return func(*args, **kwargs)
+        return record_check_wrapper
+
     def __getattr__(self, name):
-        return getattr(self._real_client.service, name)
+        func = self._service_method(name)
+        if not instrument.enabled():
+            return func
+        def instrument_wrapper(*args, **kwargs):
+            call = instrument.CallInfo('soap', self._options.get('server', None),
+                self._options.get('namespace', None), name)
+            return instrument.call(call, func, args, kwargs,
+                faults=(suds.WebFault,))
+        return instrument_wrapper
 
     def __call__(self, *args, **kwargs):
-        return self._real_client.factory.create(*args, **kwargs)
+        try:
+            return self._real_client.factory.create(*args, **kwargs)
+        except suds.TypeNotFound as err:
+            if not self._reload_wsdl(err):
+                raise
+            return self._real_client.factory.create(*args, **kwargs)
 
     def _post_init(self):
         if self._options.get('backwards_compat', True):
@@ -76,63 +236,205 @@ class SoapClientWrapper(object):
 class SoapRateLimiter(SoapClientWrapper):
     def _post_init(self):
         super(SoapRateLimiter, self)._post_init()
+        # a limiter can be shared with other wrappers (and threads) talking to
+        # the same server, otherwise build one just for this wrapper
+        self._rate_limiter = self._options.get('rate_limiter', None)
         rate_limit = self._options.get('rate_limit', None)
-        if rate_limit is None:
-            self._rl_hz = 0
-        else:
-            self._rl_hz = 1.0 / (rate_limit * 1.0)
-        self._rl_prev = time.time()
+        if self._rate_limiter is None and rate_limit is not None:
+            self._rate_limiter = TokenBucket(rate_limit,
+                self._options.get('rate_burst', None))
 
     def __getattr__(self, name):
         func = super(SoapRateLimiter, self).__getattr__(name)
+        if self._rate_limiter is None:
+            return func
         def rate_limit_wrapper(*args, **kwargs):
-            now = time.time()
-            delta = max(0, now - self._rl_prev)
-            if delta < self._rl_hz:
-                sleep_time = self._rl_hz - delta
-                logger.debug('Sleeping for %0.8d seconds for rate limiting', sleep_time)
-                time.sleep(sleep_time)
-            self._rl_prev = time.time()
+            self._rate_limiter.acquire()
             return func(*args, **kwargs)
         return rate_limit_wrapper
 
+class DeadlineExceeded(CallTimeout):
+    """A call couldn't be (re)tried before its deadline
+    """
+
+def is_idempotent(method_name):
+    return method_name.startswith(IDEMPOTENT_METHOD_PREFIXES)
+
+def is_retryable_error(err):
+    """Check if an error from a SOAP call is (probably) transient, SOAP
+    faults only are if they say the server is busy (see RETRY_FAULT_PATTERNS)
+    """
+
+    # out of time, trying again can't help
+    if isinstance(err, CallTimeout):
+        return False
+    if isinstance(err, suds.transport.TransportError):
+        return err.httpcode in RETRY_HTTP_CODES
+    if isinstance(err, urllib2.HTTPError):
+        return err.code in RETRY_HTTP_CODES
+    if isinstance(err, suds.WebFault):
+        fault_string = getattr(getattr(err, 'fault', None), 'faultstring', '')
+        fault_string = unicode(fault_string or '').lower()
+        return any(pattern in fault_string for pattern in RETRY_FAULT_PATTERNS)
+    if isinstance(err, (urllib2.URLError, socket.error, httplib.HTTPException)):
+        return True
+    # suds reports non-500 HTTP errors as a bare Exception((status, reason))
+    if type(err) is Exception and err.args and isinstance(err.args[0], tuple):
+        return err.args[0][0] in RETRY_HTTP_CODES
+    return False
+
+def backoff_delay(attempt, base, maximum):
+    """Exponential backoff with full jitter
+    """
+
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
 class SoapRetrier(SoapRateLimiter):
+    def _post_init(self):
+        super(SoapRetrier, self)._post_init()
+        self._retry_budget = self._options.get('retry_budget', None)
+
+    def _deadline(self):
+        deadlines = [self._options.get('run_deadline', None),
+            timeouts.get_deadline()]
+        call_deadline = self._options.get('call_deadline', None)
+        if call_deadline is not None:
+            deadlines.append(time.time() + call_deadline)
+        deadlines = [d for d in deadlines if d is not None]
+        return min(deadlines) if deadlines else None
+
     def __getattr__(self, name):
         func = super(SoapRetrier, self).__getattr__(name)
+        # only calls that are safe to repeat get retried
+        retries = self._options.get('retries', 1) if is_idempotent(name) else 1
+        backoff = self._options.get('backoff', DEFAULT_BACKOFF)
+        backoff_max = self._options.get('backoff_max', DEFAULT_BACKOFF_MAX)
         def retrier_wrapper(*args, **kwargs):
-            final_error = None
-            for i in xrange(self._options.get('retries', 1)):
+            deadline = self._deadline()
+            for attempt in xrange(retries):
+                if deadline is not None and time.time() >= deadline:
+                    raise DeadlineExceeded('Deadline passed before calling %s' % name)
                 try:
-                    result = func(*args, **kwargs)
-                except urllib2.URLError as err:
-                    logger.warn('Got error response')
-                    logger.exception(err)
-                    final_error = err
-                    continue
+                    # lets the transport cut the attempt short at the deadline
+                    with timeouts.deadline_at(deadline):
+                        result = func(*args, **kwargs)
+                except Exception as err:
+                    if not is_retryable_error(err):
+                        raise
+                    logger.warn('Got error response from %s: %s', name, err)
+                    if attempt + 1 >= retries:
+                        logger.error('No more retries')
+                        raise
+                    delay = backoff_delay(attempt, backoff, backoff_max)
+                    if deadline is not None and time.time() + delay >= deadline:
+                        logger.error('No time left to retry before the deadline')
+                        raise
+                    if self._retry_budget is not None and \
+                            not self._retry_budget.withdraw():
+                        logger.error('Retry budget exhausted')
+                        raise
+                    logger.debug('Retrying %s in %0.2f seconds', name, delay)
+                    time.sleep(delay)
                 else:
+                    if self._retry_budget is not None:
+                        self._retry_budget.deposit()
                     return result
-            else:
-                logger.error('No more retries')
-                raise final_error
         return retrier_wrapper
 
+def is_server_failure(err):
+    """Check if an error means the server is unreachable or failing, for the
+    circuit breaker
+    """
+
+    # timeouts aren't retried, but a server that's hanging is failing all
+    # the same (and counts for CDP2Clients, see breaker.is_connection_failure())
+    if isinstance(err, socket.timeout):
+        return True
+    return is_retryable_error(err) and not isinstance(err, suds.WebFault)
+
+class SoapCircuitBreaker(SoapRetrier):
+    def _post_init(self):
+        super(SoapCircuitBreaker, self)._post_init()
+        self._breaker = self._options.get('breaker', None)
+
+    def __getattr__(self, name):
+        func = super(SoapCircuitBreaker, self).__getattr__(name)
+        if self._breaker is None:
+            return func
+        def breaker_wrapper(*args, **kwargs):
+            return self._breaker.call(func, *args, **kwargs)
+        return breaker_wrapper
+
 class CDP3Client(object):
     """SOAP client for CDP3+ API
+
+    With fast_reads the calls in FAST_READ_METHODS return r1soft.model
+    records instead of suds objects, which are much quicker to build and
+    smaller but can't be passed back to write calls (they raise a TypeError
+    if one is), so only turn it on for clients that don't write.
     """
 
     PORT_HTTP   = 9080
     PORT_HTTPS  = 9443
 
-    def __init__(self, host, username, password, port=None, ssl=True, verify_ssl=False, **kwargs):
+    def __init__(self, host, username, password, port=None, ssl=True, verify_ssl=False,
+            version=None, cache_ttl=None, factory=None, pooled=True,
+            pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+            rate_limit=None, rate_burst=None, retries=DEFAULT_RETRIES,
+            backoff=DEFAULT_BACKOFF, backoff_max=DEFAULT_BACKOFF_MAX,
+            call_deadline=None, run_deadline=None, circuit_breaker=True,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+            read_timeout=DEFAULT_READ_TIMEOUT, fast_reads=False, **kwargs):
         # in a perfect world, verify_ssl would default to True but we'll leave
         # it at False for now to make life easier
         self.__namespaces = {}
+        # the factory's pickled definitions each namespace was built from
+        self.__definitions = {}
         self._host = host
         self._username = username
         self._password = password
         self._port = port
         self._ssl = ssl
         self._verify_ssl = verify_ssl
+        self._version = version
+        self._factory = factory
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._fast_reads = fast_reads
+        if rate_limit:
+            # shared by every namespace, client and thread talking to this server
+            self._rate_limiter = get_rate_limiter((host, self.port),
+                rate_limit, rate_burst)
+        else:
+            self._rate_limiter = None
+        self._retry_options = dict(
+            retries=retries,
+            backoff=backoff,
+            backoff_max=backoff_max,
+            call_deadline=call_deadline,
+            run_deadline=run_deadline,
+            # shared so retries to a failing server can't multiply the load
+            retry_budget=get_retry_budget((host, self.port)),
+        )
+        if circuit_breaker:
+            # shared with every other client for this server so once it's
+            # known to be down everything talking to it fails fast
+            self._breaker = get_circuit_breaker(host, self.port,
+                is_failure=is_server_failure)
+        else:
+            self._breaker = None
+        if pooled:
+            # keep-alive connections shared by all of this client's namespaces
+            self._pool = ConnectionPool(pool_size, idle_timeout,
+                create_ssl_context(verify=verify_ssl) if ssl else None)
+        else:
+            self._pool = None
+        if 'cache' not in kwargs:
+            # cache the parsed WSDLs on disk, keyed on the server so a warm
+            # run doesn't have to fetch or parse them again
+            cache_args = {} if cache_ttl is None else {'ttl': cache_ttl}
+            kwargs['cache'] = WsdlCache(host, self.port, version, **cache_args)
+            kwargs.setdefault('cachingpolicy', 1)
         self._init_args = kwargs
 
     def __getattr__(self, name):
@@ -141,22 +443,117 @@ class CDP3Client(object):
         if ns is None:
             logger.debug('Client doesn\'t exist, creating client for ' \
                 'namespace: %s', name)
-            ns = SoapRetrier(
-                suds.client.Client(
-                    build_wsdl_url(self._host, name, self._port, self._ssl),
-                    username=self._username,
-                    password=self._password,
-                    transport=UNSAFE_HttpsNoVerifyTransport(
-                            username=self._username, password=self._password) \
-                        if (self._ssl and not self._verify_ssl) else None,
-                    **self._init_args),
-                rate_limit=None,
-                retries=3,
-                backwards_compat=True
+            soap_client, fast_client = self._build_namespace_clients(name,
+                self._build_soap_client)
+            ns = SoapCircuitBreaker(soap_client,
+                server='%s:%s' % (self._host, self.port),
+                namespace=name,
+                fast_client=fast_client,
+                reload_clients=lambda: self._build_namespace_clients(name,
+                    self._reload_soap_client),
+                breaker=self._breaker,
+                rate_limiter=self._rate_limiter,
+                backwards_compat=True,
+                **self._retry_options
                 )
             self.__namespaces[name] = ns
         return ns
 
+    def _build_namespace_clients(self, name, build):
+        if self._breaker is None:
+            soap_client = build(name)
+        else:
+            soap_client = self._breaker.call(build, name)
+        if self._fast_reads and has_fast_reads(name):
+            # shares the parsed WSDL, only the raw responses of the hot read
+            # calls go through it
+            fast_client = clone_soap_client(soap_client, retxml=True,
+                **self._soap_client_args())
+        else:
+            fast_client = None
+        return (soap_client, fast_client)
+
+    def _soap_client_args(self):
+        init_args = self._transport_args()
+        session = replay.active()
+        if session is not None:
+            # record or replay every request (see r1soft.replay)
+            init_args['transport'] = session.soap_transport(
+                init_args.get('transport', None), self._username, self._password)
+        return init_args
+
+    def _transport_args(self):
+        init_args = dict(self._init_args,
+            username=self._username,
+            password=self._password)
+        if self._pool is not None:
+            init_args.setdefault('transport', PooledHTTPTransport(self._pool,
+                connect_timeout=self._connect_timeout,
+                read_timeout=self._read_timeout,
+                username=self._username, password=self._password))
+            return init_args
+        # urllib2 only has the one timeout for both connecting and reading
+        if self._read_timeout is not None:
+            init_args.setdefault('timeout', self._read_timeout)
+        if self._ssl and not self._verify_ssl:
+            init_args.setdefault('transport', UNSAFE_HttpsNoVerifyTransport(
+                username=self._username, password=self._password))
+        else:
+            init_args.setdefault('transport', CountingHttpTransport(
+                username=self._username, password=self._password))
+        return init_args
+
+    def _load_soap_client(self, namespace):
+        return suds.client.Client(
+            build_wsdl_url(self._host, namespace, self._port, self._ssl),
+            **self._soap_client_args())
+
+    def _build_soap_client(self, namespace):
+        if self._factory is None:
+            return self._load_soap_client(namespace)
+        template, definitions = self._factory.template(self, namespace)
+        self.__definitions[namespace] = definitions
+        return clone_soap_client(template, definitions,
+            **self._soap_client_args())
+
+    def _reload_soap_client(self, namespace):
+        if self._factory is None:
+            self._clear_wsdl_cache()
+            return self._load_soap_client(namespace)
+        template, definitions = self._factory.reload_template(self, namespace,
+            self.__definitions.get(namespace, None))
+        self.__definitions[namespace] = definitions
+        return clone_soap_client(template, definitions,
+            **self._soap_client_args())
+
+    def _clear_wsdl_cache(self):
+        cache = self._init_args.get('cache', None)
+        if cache is not None:
+            cache.clear()
+
+    @property
+    def port(self):
+        if self._port is None:
+            return self.PORT_HTTPS if self._ssl else self.PORT_HTTP
+        return self._port
+
+    def close(self):
+        """Close any kept-alive connections
+        """
+
+        if self._pool is not None:
+            self._pool.close()
+
+    def invalidate_cache(self):
+        """Drop the cached WSDLs for this server, forcing a re-fetch
+        """
+
+        self._clear_wsdl_cache()
+        if self._factory is not None:
+            self._factory.invalidate()
+        self.__namespaces.clear()
+        self.__definitions.clear()
+
     def build_object(self, namespace, object_type, attributes):
         object_instance = getattr(self, namespace).factory.create(object_type)
 
@@ -169,3 +566,377 @@ class CDP3Client(object):
                 setattr(object_instance, key, value)
 
         return object_instance
+
+class CDP3ClientFactory(object):
+    """Thread-safe source of CDP3Clients for a single server
+
+    Each namespace's WSDL is loaded and parsed once per factory, the clients
+    handed out get clones of those templates with their own transport and
+    their own (unpickled) copy of the parsed WSDL, since suds keeps
+    per-reply state on it. Use one client per thread, thread_client()
+    reuses them so each thread only pays for the copy once. close() closes
+    the kept-alive connections of all of those thread clients.
+    """
+
+    def __init__(self, host, username, password, port=None, ssl=True, verify_ssl=False, **kwargs):
+        self._client_args = (host, username, password, port, ssl, verify_ssl)
+        self._client_kwargs = kwargs
+        self._templates = {}
+        # namespaces whose templates were reloaded after going stale
+        self._reloaded = set()
+        self._lock = threading.Lock()
+        # held while loading a namespace's template, so loading one
+        # namespace doesn't hold up clients using (or loading) any other
+        self._namespace_locks = {}
+        self._local = threading.local()
+        # weak so the clients of threads that have gone away can still be
+        # collected
+        self._thread_clients = weakref.WeakSet()
+
+    def client(self, **kwargs):
+        """Get a new client sharing this factory's parsed WSDLs, kwargs
+        override the factory's client options (e.g. fast_reads=True for
+        read-only callers)
+        """
+
+        client_kwargs = dict(self._client_kwargs, **kwargs)
+        return CDP3Client(*self._client_args, factory=self, **client_kwargs)
+
+    def thread_client(self, **kwargs):
+        """Get the client for the current thread (with the given options),
+        creating it if needed
+        """
+
+        clients = getattr(self._local, 'clients', None)
+        if clients is None:
+            clients = self._local.clients = {}
+        key = tuple(sorted(kwargs.iteritems()))
+        client = clients.get(key, None)
+        if client is None:
+            client = clients[key] = self.client(**kwargs)
+            with self._lock:
+                self._thread_clients.add(client)
+        return client
+
+    def close(self):
+        """Close the kept-alive connections of every client handed out by
+        thread_client(), they can still be used after (and reconnect)
+        """
+
+        with self._lock:
+            clients = list(self._thread_clients)
+        for client in clients:
+            client.close()
+
+    @property
+    def host(self):
+        return self._client_args[0]
+
+    def _namespace_lock(self, namespace):
+        with self._lock:
+            lock = self._namespace_locks.get(namespace, None)
+            if lock is None:
+                lock = self._namespace_locks[namespace] = threading.Lock()
+            return lock
+
+    def template(self, client, namespace):
+        """Get the template suds client for a namespace and its pickled
+        definitions, loading them with client if needed
+        """
+
+        template = self._templates.get(namespace, None)
+        if template is not None:
+            return template
+        with self._namespace_lock(namespace):
+            template = self._templates.get(namespace, None)
+            if template is None:
+                logger.debug('Loading template SOAP client for namespace: %s',
+                    namespace)
+                soap_client = client._load_soap_client(namespace)
+                template = self._templates[namespace] = (soap_client,
+                    pickle.dumps(soap_client.wsdl, pickle.HIGHEST_PROTOCOL))
+        return template
+
+    def preload(self, namespaces):
+        """Load the templates for any of namespaces whose WSDLs are in the
+        on-disk cache, without making any requests, returns the namespaces
+        that were loaded
+        """
+
+        loaded = []
+        for namespace in namespaces:
+            # suds won't share a transport between clients
+            client = self.client(pooled=False, transport=OfflineTransport())
+            try:
+                self.template(client, namespace)
+            except suds.transport.TransportError:
+                logger.debug('WSDL for namespace %s not cached for %s',
+                    namespace, self.host)
+            else:
+                loaded.append(namespace)
+        return loaded
+
+    def reload_template(self, client, namespace, stale):
+        """Reload a namespace's template after a client built from the
+        stale definitions found it out of date, unless that already happened
+        """
+
+        with self._namespace_lock(namespace):
+            template = self._templates.get(namespace, None)
+            if template is None or (template[1] is stale and \
+                    namespace not in self._reloaded):
+                self._reloaded.add(namespace)
+                client._clear_wsdl_cache()
+                soap_client = client._load_soap_client(namespace)
+                template = self._templates[namespace] = (soap_client,
+                    pickle.dumps(soap_client.wsdl, pickle.HIGHEST_PROTOCOL))
+        return template
+
+    def invalidate(self):
+        with self._lock:
+            self._templates.clear()
+
+class _AsyncNamespace(object):
+    def __init__(self, client, namespace):
+        self._client = client
+        self._namespace = namespace
+        # match SoapClientWrapper's backwards_compat
+        self.service = self
+
+    def __getattr__(self, name):
+        def async_call(*args, **kwargs):
+            return self._client._submit(self._namespace, name, args, kwargs)
+        return async_call
+
+class AsyncCDP3Client(object):
+    """Non-blocking CDP3 client where every call returns right away with an
+    AsyncResult (same as ThreadPool.apply_async)
+
+    Namespaces work like on CDP3Client (client.Policy2.getPolicies()), the
+    calls are run on a thread pool that can be shared between clients so a
+    whole fleet can be queried at once from a single process, each worker
+    thread using its own clone of the shared WSDL templates over keep-alive
+    connections.
+    """
+
+    def __init__(self, host, username, password, port=None, ssl=True, verify_ssl=False,
+            pool=None, workers=DEFAULT_ASYNC_WORKERS, **kwargs):
+        self._factory = CDP3ClientFactory(host, username, password, port,
+            ssl, verify_ssl, **kwargs)
+        self._own_pool = pool is None
+        if pool is None:
+            pool = multiprocessing.pool.ThreadPool(workers)
+        self._pool = pool
+        self._namespaces = {}
+
+    def __getattr__(self, name):
+        ns = self._namespaces.get(name, None)
+        if ns is None:
+            ns = self._namespaces[name] = _AsyncNamespace(self, name)
+        return ns
+
+    def _call(self, namespace, method, args, kwargs):
+        client = self._factory.thread_client()
+        return getattr(getattr(client, namespace), method)(*args, **kwargs)
+
+    def _submit(self, namespace, method, args, kwargs):
+        call = timeouts.with_deadline(self._call, timeouts.get_deadline())
+        return self._pool.apply_async(call, (namespace, method, args, kwargs))
+
+    def close(self):
+        """Wait for outstanding calls and stop the pool if this client owns
+        it, then close the worker threads' connections
+        """
+
+        if self._own_pool:
+            self._pool.close()
+            self._pool.join()
+        self._factory.close()
+
+def gather(async_results, timeout=None):
+    """Wait for a list of AsyncResults, returns their values in order
+    """
+
+    return [result.get(timeout) for result in async_results]
+
+def _in_order(batch, oldest):
+    # newest first, and no newer than the previous batch's oldest task
+    times = [task.executionTime for task in batch]
+    return times == sorted(times, reverse=True) and \
+        (oldest is None or times[0] <= oldest)
+
+class TaskHistoryReader(object):
+    """Fetch task execution contexts for agents, newest first
+
+    Contexts are fetched in batches (concurrently when given a
+    CDP3ClientFactory) and filtered as they come in, so callers that only
+    need the newest few tasks don't pay for the whole history. That needs
+    getTaskExecutionContextIDsByAgent to return the IDs in execution order:
+    the tasks at both ends of the list are fetched first to tell which way
+    round it is, and every batch is checked to follow that order before
+    anything in it is yielded. If the order can't be told the whole
+    history is fetched instead. A batch out of order has the rest of the
+    history merged into it (tasks yielded from earlier batches can't be
+    taken back, but the first batch is always checked before any are) and
+    the reader fetches whole histories up front from then on. Tasks that
+    haven't started yet (no executionTime) are always skipped.
+
+    With a TaskCache, contexts that already reached a terminal state are
+    loaded from the cache instead of the server. Given a map_func(func, items)
+    (e.g. a Scheduler's map()) contexts are fetched with that instead of a
+    pool of the reader's own. With compact, tasks are returned as
+    r1soft.model.TaskContext records whether they came from the server or
+    the cache, and clients from a factory are asked for with fast_reads.
+    """
+
+    def __init__(self, client, workers=4, batch_size=None, cache=None,
+            map_func=None, compact=False):
+        self._client = client
+        self._cache = cache
+        self._compact = compact
+        self._workers = workers
+        self._batch_size = batch_size or max(1, workers * 2)
+        self._map_func = map_func
+        # cleared once the server is seen returning task IDs out of order
+        self._ids_ordered = True
+        if map_func is None and isinstance(client, CDP3ClientFactory) \
+                and workers > 1 and multiprocessing is not None:
+            self._pool = multiprocessing.pool.ThreadPool(workers)
+        else:
+            self._pool = None
+
+    def _thread_client(self):
+        if isinstance(self._client, CDP3ClientFactory):
+            if self._compact:
+                return self._client.thread_client(fast_reads=True)
+            return self._client.thread_client()
+        return self._client
+
+    def _get_task(self, task_id):
+        task = self._thread_client().TaskHistory.service \
+            .getTaskExecutionContextByID(task_id)
+        if self._compact:
+            return model.TaskContext.convert(task)
+        return task
+
+    def _fetch_tasks(self, task_ids):
+        if self._map_func is not None:
+            return self._map_func(self._get_task, task_ids)
+        if self._pool is None:
+            return [self._get_task(task_id) for task_id in task_ids]
+        get_task = timeouts.with_deadline(self._get_task, timeouts.get_deadline())
+        return self._pool.map(get_task, task_ids, chunksize=1)
+
+    def _get_tasks(self, task_ids):
+        if self._cache is None:
+            return self._fetch_tasks(task_ids)
+        tasks = self._cache.get_many(task_ids)
+        missing = [task_id for task_id in task_ids if task_id not in tasks]
+        if missing:
+            logger.debug('Fetching %d of %d task contexts', len(missing),
+                len(task_ids))
+            fetched = dict(zip(missing, self._fetch_tasks(missing)))
+            self._cache.put_many(fetched)
+            tasks.update(fetched)
+        if self._compact:
+            return [model.TaskContext.convert(tasks[task_id]) for task_id in task_ids]
+        return [tasks[task_id] for task_id in task_ids]
+
+    def get_task_ids(self, agent_id):
+        return self._thread_client().TaskHistory.service \
+            .getTaskExecutionContextIDsByAgent(agent_id) or []
+
+    def iter_tasks(self, agent_id, task_types=None, states=None, since=None,
+            until=None):
+        """Iterate over an agent's tasks newest first, only fetching more
+        batches as the iteration goes on
+
+        task_types and states are collections of allowed values, since and
+        until are datetimes bounding the task's executionTime. Once a task
+        older than since is seen nothing more is fetched.
+        """
+
+        task_ids = self.get_task_ids(agent_id)
+        # tasks fetched so far, so none of them is fetched twice
+        known = {}
+        batch_size = len(task_ids)
+        if self._ids_ordered and len(task_ids) > self._batch_size:
+            ordered_ids = self._newest_first(agent_id, task_ids, known)
+            if ordered_ids is not None:
+                task_ids = ordered_ids
+                batch_size = self._batch_size
+        oldest = None
+        for offset in xrange(0, len(task_ids), max(1, batch_size)):
+            batch = [task for task in self._get_known_tasks(
+                    task_ids[offset:offset + batch_size], known) \
+                if 'executionTime' in task]
+            if not batch:
+                continue
+            if batch_size < len(task_ids) and not _in_order(batch, oldest):
+                logger.warn('Task IDs for agent %s aren\'t in execution ' \
+                    'order, fetching the rest of the history', agent_id)
+                self._ids_ordered = False
+                batch.extend(task for task in self._get_known_tasks(
+                        task_ids[offset + batch_size:], known) \
+                    if 'executionTime' in task)
+                batch_size = len(task_ids)
+            batch.sort(key=lambda task: task.executionTime, reverse=True)
+            for task in batch:
+                if since is not None and task.executionTime < since:
+                    return
+                if until is not None and task.executionTime > until:
+                    continue
+                if task_types is not None and task.taskType not in task_types:
+                    continue
+                if states is not None and task.taskState not in states:
+                    continue
+                yield task
+            if batch_size >= len(task_ids):
+                return
+            oldest = batch[-1].executionTime
+
+    def _get_known_tasks(self, task_ids, known):
+        missing = [task_id for task_id in task_ids if task_id not in known]
+        if missing:
+            known.update(zip(missing, self._get_tasks(missing)))
+        return [known[task_id] for task_id in task_ids]
+
+    def _newest_first(self, agent_id, task_ids, known):
+        """Put an agent's task IDs newest first going by the tasks at both
+        ends of the list, or None if that can't be told
+        """
+
+        first, last = self._get_known_tasks([task_ids[0], task_ids[-1]], known)
+        if 'executionTime' in first and 'executionTime' in last:
+            if first.executionTime > last.executionTime:
+                return list(task_ids)
+            if first.executionTime < last.executionTime:
+                return list(reversed(task_ids))
+        logger.warn('Can\'t tell the order of the task IDs for agent %s, ' \
+            'fetching the whole history', agent_id)
+        return None
+
+    def get_tasks(self, agent_id, limit=None, stop=None, **filters):
+        """Get a list of an agent's tasks newest first
+
+        Fetching stops after limit matching tasks or after the first task
+        for which stop(task) is true (that task is included).
+        """
+
+        tasks = []
+        for task in self.iter_tasks(agent_id, **filters):
+            tasks.append(task)
+            if limit is not None and len(tasks) >= limit:
+                break
+            if stop is not None and stop(task):
+                break
+        return tasks
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
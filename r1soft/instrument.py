@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger('r1soft.instrument')
+
+# seconds, same as the Prometheus client's defaults plus a few longer ones
+# since some CDP calls are slow
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0)
+
+OUTCOME_OK      = 'ok'
+OUTCOME_FAULT   = 'fault'
+OUTCOME_TIMEOUT = 'timeout'
+OUTCOME_ERROR   = 'error'
+
+# label for calls without a namespace (e.g. top level CDP2 methods)
+NO_NAMESPACE = '-'
+
+class CallInfo(object):
+    """Details of a single API call as seen by the hooks
+
+    duration, outcome and error are only set for post_call(), the byte counts
+    are filled in by the transport while the call runs.
+    """
+
+    __slots__ = ('protocol', 'server', 'namespace', 'method', 'start',
+        'duration', 'request_bytes', 'response_bytes', 'outcome', 'error')
+
+    def __init__(self, protocol, server, namespace, method):
+        self.protocol = protocol
+        self.server = server
+        self.namespace = namespace
+        self.method = method
+        self.start = None
+        self.duration = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.outcome = None
+        self.error = None
+
+    @property
+    def labels(self):
+        namespace = NO_NAMESPACE if self.namespace is None else self.namespace
+        return (self.protocol, self.server, namespace, self.method,
+            self.outcome)
+
+class Hook(object):
+    """Base for instrumentation hooks, override either or both methods
+    """
+
+    def pre_call(self, call):
+        pass
+
+    def post_call(self, call):
+        pass
+
+# replaced rather than changed in place so calls can iterate it without a lock
+_hooks = ()
+_hooks_lock = threading.Lock()
+_local = threading.local()
+
+def add_hook(hook):
+    global _hooks
+    with _hooks_lock:
+        if hook not in _hooks:
+            _hooks = _hooks + (hook,)
+    return hook
+
+def remove_hook(hook):
+    global _hooks
+    with _hooks_lock:
+        _hooks = tuple(h for h in _hooks if h is not hook)
+
+def enabled():
+    return bool(_hooks)
+
+def record_bytes(sent=0, received=0):
+    """Add to the payload sizes of the call running on this thread, if any
+    """
+
+    call = getattr(_local, 'call', None)
+    if call is not None:
+        call.request_bytes += sent
+        call.response_bytes += received
+
+def _run_hooks(hooks, method, call):
+    for hook in hooks:
+        try:
+            getattr(hook, method)(call)
+        except Exception as err:
+            # a broken hook shouldn't break the API call
+            logger.exception(err)
+
+def classify_error(err, faults=()):
+    if isinstance(err, faults):
+        return OUTCOME_FAULT
+    if isinstance(err, socket.timeout):
+        return OUTCOME_TIMEOUT
+    return OUTCOME_ERROR
+
+def call(call_info, func, args=(), kwargs={}, faults=()):
+    """Run func(*args, **kwargs) as the API call described by call_info,
+    running the hooks around it
+
+    Exceptions of the faults types (the server rejecting the call) are
+    counted as faults rather than errors.
+    """
+
+    hooks = _hooks
+    if not hooks:
+        return func(*args, **kwargs)
+    _run_hooks(hooks, 'pre_call', call_info)
+    previous = getattr(_local, 'call', None)
+    _local.call = call_info
+    call_info.start = time.time()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as err:
+        call_info.outcome = classify_error(err, faults)
+        call_info.error = err
+        raise
+    else:
+        call_info.outcome = OUTCOME_OK
+        return result
+    finally:
+        call_info.duration = time.time() - call_info.start
+        _local.call = previous
+        _run_hooks(hooks, 'post_call', call_info)
+
+class Histogram(object):
+    """Cumulative histogram of durations with fixed buckets
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate a quantile (the upper bound of its bucket)
+        """
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return float('inf')
+
+class MetricsAggregator(Hook):
+    """In-memory call metrics per (protocol, server, namespace, method,
+    outcome): a duration histogram plus request/response byte totals
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def post_call(self, call):
+        with self._lock:
+            metric = self._metrics.get(call.labels, None)
+            if metric is None:
+                metric = self._metrics[call.labels] = [
+                    Histogram(self.buckets), 0, 0]
+            metric[0].observe(call.duration)
+            metric[1] += call.request_bytes
+            metric[2] += call.response_bytes
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def snapshot(self):
+        """Get {labels: (histogram, request_bytes, response_bytes)}, labels
+        being (protocol, server, namespace, method, outcome)
+        """
+
+        with self._lock:
+            return dict((labels, (metric[0], metric[1], metric[2])) \
+                for labels, metric in self._metrics.iteritems())
+
+    def top(self, n=10, key='sum'):
+        """Get the n (labels, histogram) pairs with the most total time (or
+        calls with key='count')
+        """
+
+        metrics = [(labels, metric[0]) for labels, metric \
+            in self.snapshot().iteritems()]
+        metrics.sort(key=lambda m: getattr(m[1], key), reverse=True)
+        return metrics[:n]
+
+    def to_prometheus(self, prefix='r1soft'):
+        """Render the metrics in the Prometheus text exposition format
+        """
+
+        lines = []
+        metrics = sorted(self.snapshot().iteritems())
+        name = '%s_call_duration_seconds' % prefix
+        lines.append('# HELP %s Duration of CDP API calls.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for labels, (histogram, sent, received) in metrics:
+            label_str = _prometheus_labels(labels)
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, label_str,
+                    _prometheus_float(bound), count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, label_str,
+                histogram.count))
+            lines.append('%s_sum{%s} %s' % (name, label_str,
+                _prometheus_float(histogram.sum)))
+            lines.append('%s_count{%s} %d' % (name, label_str, histogram.count))
+        for suffix, index, help_text in (
+                ('request_bytes_total', 1, 'Bytes sent in CDP API requests.'),
+                ('response_bytes_total', 2, 'Bytes received in CDP API responses.')):
+            name = '%s_call_%s' % (prefix, suffix)
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s counter' % name)
+            for labels, metric in metrics:
+                lines.append('%s{%s} %d' % (name, _prometheus_labels(labels),
+                    metric[index]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename, prefix='r1soft'):
+        """Write the metrics to a file atomically, e.g. for node_exporter's
+        textfile collector
+        """
+
+        tmp_filename = '%s.tmp' % filename
+        with open(tmp_filename, 'w') as f:
+            f.write(self.to_prometheus(prefix))
+        os.rename(tmp_filename, filename)
+
+LABEL_NAMES = ('protocol', 'server', 'namespace', 'method', 'outcome')
+
+def _prometheus_labels(labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\') \
+            .replace('"', '\\"').replace('\n', '\\n')) \
+        for name, value in zip(LABEL_NAMES, labels))
+
+def _prometheus_float(value):
+    return repr(float(value))
+
+class StatsdExporter(Hook):
+    """Send a timer and byte counters to StatsD (over UDP) for every call
+
+    Metric names are prefix.protocol.server.namespace.method.outcome with
+    dots in the server name replaced.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='r1soft'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, call):
+        parts = [self.prefix] + [str(label).replace('.', '_').replace(':', '_') \
+            for label in call.labels]
+        return '.'.join(parts)
+
+    def post_call(self, call):
+        name = self._name(call)
+        payload = '\n'.join([
+            '%s.duration:%d|ms' % (name, call.duration * 1000),
+            '%s.request_bytes:%d|c' % (name, call.request_bytes),
+            '%s.response_bytes:%d|c' % (name, call.response_bytes),
+        ])
+        try:
+            self._sock.sendto(payload, self.address)
+        except socket.error as err:
+            logger.debug('Failed sending metrics to StatsD: %s', err)
+
+    def close(self):
+        self._sock.close()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import logging
+
+from . import model
+
+logger = logging.getLogger('r1soft.inventory')
+
+def index_by(objects, attr_name):
+    """Build a dict of objects keyed on an attribute, objects without the
+    attribute are left out
+    """
+
+    index = {}
+    for obj in objects:
+        key = getattr(obj, attr_name, None)
+        if key is not None:
+            index[key] = obj
+    return index
+
+def group_by(objects, attr_name):
+    """Build a dict of lists of objects sharing the same attribute value
+    """
+
+    groups = {}
+    for obj in objects:
+        key = getattr(obj, attr_name, None)
+        if key is not None:
+            groups.setdefault(key, []).append(obj)
+    return groups
+
+class Inventory(object):
+    """Indexed snapshot of the agents, disksafes, policies and volumes on a
+    CDP3+ server
+
+    Everything is fetched with one list call per type so joining policies to
+    their disksafes and agents is a dict lookup instead of a round trip.
+    """
+
+    def __init__(self, agents=(), disksafes=(), policies=(), volumes=()):
+        self.agents = index_by(agents, 'id')
+        self.disksafes = index_by(disksafes, 'id')
+        self.policies = index_by(policies, 'id')
+        self.volumes = index_by(volumes, 'id')
+        self.agents_by_hostname = index_by(agents, 'hostname')
+        self.disksafes_by_agent = group_by(disksafes, 'agentID')
+        self.policies_by_disksafe = group_by(policies, 'diskSafeID')
+
+    @classmethod
+    def from_client(cls, client, volumes=True, compact=False):
+        """Take a snapshot of a server with a CDP3Client
+
+        With compact the agents, disksafes and policies are kept as
+        r1soft.model records instead of suds objects (so they can't be sent
+        back to the server).
+        """
+
+        logger.debug('Fetching inventory from: %s', client._host)
+        agents = client.Agent.service.getAgents() or []
+        disksafes = client.DiskSafe.service.getDiskSafes() or []
+        policies = client.Policy2.service.getPolicies() or []
+        if compact:
+            agents = [model.Agent.convert(agent) for agent in agents]
+            disksafes = [model.DiskSafe.convert(ds) for ds in disksafes]
+            policies = [model.Policy.convert(policy) for policy in policies]
+        return cls(
+            agents=agents,
+            disksafes=disksafes,
+            policies=policies,
+            volumes=(client.Volume.service.getVolumes() or []) if volumes else [],
+        )
+
+    def iter_hosts(self, include_disabled=True):
+        """Iterate over a model.Host for every policy (see iter_policies())
+        """
+
+        for policy, disksafe, agent in self.iter_policies(include_disabled):
+            yield model.Host.from_cdp3(policy, disksafe, agent)
+
+    def policy_disksafe(self, policy):
+        return self.disksafes.get(getattr(policy, 'diskSafeID', None), None)
+
+    def policy_agent(self, policy):
+        disksafe = self.policy_disksafe(policy)
+        if disksafe is None:
+            return None
+        return self.agents.get(disksafe.agentID, None)
+
+    def agent_by_hostname(self, hostname):
+        return self.agents_by_hostname.get(hostname, None)
+
+    def iter_policies(self, include_disabled=True):
+        """Iterate over (policy, disksafe, agent) for every policy attached to
+        a disksafe and agent on this server
+        """
+
+        for policy in self.policies.itervalues():
+            if not include_disabled and not policy.enabled:
+                continue
+            disksafe = self.policy_disksafe(policy)
+            if disksafe is None:
+                continue
+            agent = self.agents.get(disksafe.agentID, None)
+            if agent is None:
+                logger.debug('No agent found for disksafe: %s', disksafe.id)
+                continue
+            yield (policy, disksafe, agent)
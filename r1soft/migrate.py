@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import collections
+import json
+import logging
+import os
+import threading
+
+try:
+    import multiprocessing.pool
+except ImportError:
+    multiprocessing = None
+
+from .inventory import Inventory
+
+logger = logging.getLogger('r1soft.migrate')
+
+# existing maps the steps already done on the destination to the ids of
+# what they created (see find_existing())
+HostCopy = collections.namedtuple('HostCopy',
+    ['policy', 'disksafe', 'agent', 'existing'])
+
+# the steps each host goes through, in order
+STEPS = ('agent', 'disksafe', 'policy', 'disable')
+
+def set_obj_attr(attr_map, key, value, cond=lambda v: True):
+    for entry in attr_map.entry:
+        if entry.key == key:
+            if cond(value):
+                entry.value = value
+                return True
+    else:
+        return False
+
+def find_existing(dest_inventory, policy, disksafe, agent, steps=None):
+    """Find what a host copy already created on the destination: the agent
+    (by hostname), then its disksafe (by description), then the disksafe's
+    policy (by name), going by any ids already in steps instead
+
+    Returns a dict of the steps that are done to the id of what they created,
+    like MigrationJournal.steps().
+    """
+
+    steps = steps or {}
+    existing = {}
+    dest_agent = dest_inventory.agents.get(steps.get('agent', None), None) or \
+        dest_inventory.agent_by_hostname(agent.hostname)
+    if dest_agent is None:
+        return existing
+    existing['agent'] = dest_agent.id
+    dest_disksafe = dest_inventory.disksafes.get(steps.get('disksafe', None),
+        None)
+    if dest_disksafe is None:
+        # only one copied from this disksafe will do
+        dest_disksafes = [ds for ds in \
+                dest_inventory.disksafes_by_agent.get(dest_agent.id, []) \
+            if ds.description == disksafe.description]
+        if len(dest_disksafes) > 1:
+            logger.warn('Found %d disksafes "%s" for agent [%s], using: %s',
+                len(dest_disksafes), disksafe.description, agent.hostname,
+                dest_disksafes[0].id)
+        if not dest_disksafes:
+            return existing
+        dest_disksafe = dest_disksafes[0]
+    existing['disksafe'] = dest_disksafe.id
+    dest_policies = [p for p in \
+            dest_inventory.policies_by_disksafe.get(dest_disksafe.id, []) \
+        if p.name == policy.name]
+    if dest_policies:
+        existing['policy'] = dest_policies[0].id
+    return existing
+
+def plan_copy(src_inventory, dest_inventory, include_disabled=False,
+        journal=None, adopt_existing=False):
+    """Work out which hosts need to be copied from one server to another
+
+    Hosts are matched on hostname, anything already on the destination (or
+    already planned to be copied by an earlier policy) is skipped. With a
+    journal, hosts that were finished by an earlier run are skipped and
+    hosts that were started are picked back up, reconciled against the
+    destination (see find_existing()) since a step can finish there without
+    making it into the journal. With adopt_existing, hosts that aren't in
+    the journal but are on the destination without a policy are reconciled
+    and finished the same way instead of skipped (only use it when
+    everything on the destination with those hostnames is from the source).
+    """
+
+    plan = []
+    planned_hostnames = set()
+    for policy, disksafe, agent in src_inventory.iter_policies():
+        resumed = journal is not None and journal.is_started(policy.id)
+        if resumed and journal.is_finished(policy.id):
+            logger.debug('Skipping finished policy: %s', policy.id)
+            continue
+        if not resumed and not include_disabled and not policy.enabled:
+            logger.debug('Skipping disabled policy: %s', policy.name)
+            continue
+        if agent.hostname in planned_hostnames:
+            logger.warn('Skipping already copied agent [%s]: %s',
+                agent.hostname, agent.id)
+            continue
+        if resumed:
+            logger.info('Resuming policy: %s', policy.id)
+            existing = find_existing(dest_inventory, policy, disksafe, agent,
+                journal.steps(policy.id))
+        elif agent.hostname in dest_inventory.agents_by_hostname:
+            if adopt_existing:
+                existing = find_existing(dest_inventory, policy, disksafe,
+                    agent)
+            if not adopt_existing or 'policy' in existing:
+                logger.warn('Skipping already copied agent [%s]: %s',
+                    agent.hostname, agent.id)
+                continue
+            logger.info('Finishing partly copied agent [%s]: %s',
+                agent.hostname, agent.id)
+        else:
+            existing = {}
+        planned_hostnames.add(agent.hostname)
+        plan.append(HostCopy(policy, disksafe, agent, existing))
+    return plan
+
+def copy_agent(dest, src_agent, include_db_plugin=False):
+    src_agent.id = None
+    if not include_db_plugin and src_agent.databaseAddOnEnabled:
+        logger.info('Disabling db plugin for agent...')
+        src_agent.databaseAddOnEnabled = False
+    dest_agent = dest.Agent.createAgentWithObject(agent=src_agent)
+    logger.info('Copied agent: "%s" -> %s', dest_agent.hostname, dest_agent.id)
+    return dest_agent
+
+def copy_disksafe(dest, src_disksafe, dest_agent_id, dest_volume_id,
+        include_db_plugin=False, include_cp_plugin=False):
+    src_disksafe.id = None
+    src_disksafe.path = None
+    src_disksafe.volumeID = dest_volume_id
+    src_disksafe.agentID = dest_agent_id
+    if not include_db_plugin:
+        set_obj_attr(src_disksafe.diskSafeAttributeMap, 'DATABASE_BACKUPS_ENABLED', 'false')
+    if not include_cp_plugin:
+        set_obj_attr(src_disksafe.diskSafeAttributeMap, 'CONTROLPANELS_ENABLED', 'false')
+    dest_disksafe = dest.DiskSafe.createDiskSafeWithObject(disksafe=src_disksafe)
+    logger.info('Copied disksafe: "%s" -> %s', dest_disksafe.description, dest_disksafe.id)
+    return dest_disksafe
+
+def copy_policy(dest, src_policy, dest_disksafe_id,
+        include_db_plugin=False, include_cp_plugin=False):
+    src_policy.id = None
+    src_policy.diskSafeID = dest_disksafe_id
+    src_policy.exchangeSettings = None
+    src_policy.SQLServerSettings = None
+    if not include_db_plugin:
+        src_policy.databaseInstanceList = []
+    if not include_cp_plugin:
+        src_policy.controlPanelInstanceList = []
+    dest_policy = dest.Policy2.createPolicy(policy=src_policy)
+    logger.info('Copied policy: "%s" -> %s', dest_policy.description, dest_policy.id)
+    return dest_policy
+
+def disable_policy(client, policy_id):
+    client.Policy2.disablePolicy(policy=client.Policy2.getPolicyById(id=policy_id))
+    logger.info('Disabled source policy: %s', policy_id)
+
+def copy_host(src, dest, host_copy, dest_volume_id, journal=None, limits=None,
+        include_db_plugin=False, include_cp_plugin=False):
+    """Copy a single host's agent, disksafe and policy to the destination
+    server and disable the source policy
+
+    Each step is recorded in the journal (if given) as it finishes and steps
+    already in the journal or found on the destination by plan_copy() are
+    skipped. limits maps a server's hostname to a semaphore held while
+    talking to that server.
+    """
+
+    policy, disksafe, agent, existing = host_copy
+    src_policy_id = policy.id
+    src_policy_enabled = policy.enabled
+    done = journal.steps(src_policy_id) if journal is not None else {}
+    if journal is not None and not done:
+        # mark the host as started before anything is created for it, so
+        # a crash before the first step is recorded still gets it resumed
+        # (and reconciled) instead of skipped as already copied
+        journal.record(src_policy_id, 'start', True)
+    for step, result in (existing or {}).iteritems():
+        if done.get(step, None) != result:
+            logger.info('Found %s on destination for policy %s: %s', step,
+                src_policy_id, result)
+            if journal is not None:
+                journal.record(src_policy_id, step, result)
+            done[step] = result
+    if limits is None:
+        limits = {}
+    logger.info('Copying policy:%s disksafe:%s agent:%s', policy.id,
+        disksafe.id, agent.id)
+
+    def run_step(step, client, func):
+        if step in done:
+            logger.debug('Step already done for policy %s: %s', src_policy_id, step)
+            return done[step]
+        slot = limits.get(client._host, None)
+        if slot is None:
+            result = func()
+        else:
+            with slot:
+                result = func()
+        if journal is not None:
+            journal.record(src_policy_id, step, result)
+        done[step] = result
+        return result
+
+    dest_agent_id = run_step('agent', dest,
+        lambda: copy_agent(dest, agent, include_db_plugin).id)
+    dest_disksafe_id = run_step('disksafe', dest,
+        lambda: copy_disksafe(dest, disksafe, dest_agent_id, dest_volume_id,
+            include_db_plugin, include_cp_plugin).id)
+    dest_policy_id = run_step('policy', dest,
+        lambda: copy_policy(dest, policy, dest_disksafe_id,
+            include_db_plugin, include_cp_plugin).id)
+    if src_policy_enabled:
+        run_step('disable', src, lambda: disable_policy(src, src_policy_id) or True)
+    else:
+        run_step('disable', src, lambda: False)
+    return (dest_agent_id, dest_disksafe_id, dest_policy_id)
+
+def cdp_copy_host(src, dest, include_disabled=False, include_db_plugin=False,
+        include_cp_plugin=False, journal=None, adopt_existing=False):
+    """Copy every host from the src server to the dest server
+    """
+
+    logger.info('Copying from %s to %s', src._host, dest._host)
+    src_inventory = Inventory.from_client(src, volumes=False)
+    dest_inventory = Inventory.from_client(dest, volumes=False)
+
+    dest_volume = dest.Volume.getVolumes()[0]
+    logger.debug('Using volume: %s', dest_volume.id)
+
+    plan = plan_copy(src_inventory, dest_inventory, include_disabled, journal,
+        adopt_existing)
+    logger.info('Copying %d hosts', len(plan))
+    return [copy_host(src, dest, host_copy, dest_volume.id, journal,
+                include_db_plugin=include_db_plugin,
+                include_cp_plugin=include_cp_plugin) \
+            for host_copy in plan]
+
+class MigrationJournal(object):
+    """Append-only record of the finished steps of a migration
+
+    Each line is a JSON object with the source policy id, the step name and
+    the step's result (the id of the created object), written and flushed as
+    soon as the step finishes so a crashed migration can be resumed.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._steps = {}
+        if os.path.exists(filename):
+            self._load()
+        self._file = open(filename, 'a')
+
+    def _load(self):
+        with open(self._filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # most likely a partial line from a crash mid-write
+                    logger.warn('Ignoring bad journal line: %r', line)
+                    continue
+                self._steps.setdefault(entry['policy'], {})[entry['step']] = \
+                    entry['result']
+        logger.debug('Loaded journal entries for %d policies', len(self._steps))
+
+    def steps(self, policy_id):
+        with self._lock:
+            return dict(self._steps.get(unicode(policy_id), {}))
+
+    def is_started(self, policy_id):
+        with self._lock:
+            return unicode(policy_id) in self._steps
+
+    def is_finished(self, policy_id):
+        with self._lock:
+            return STEPS[-1] in self._steps.get(unicode(policy_id), {})
+
+    def record(self, policy_id, step, result):
+        if isinstance(result, basestring):
+            result = unicode(result)
+        with self._lock:
+            self._steps.setdefault(unicode(policy_id), {})[step] = result
+            self._file.write(json.dumps({
+                'policy': unicode(policy_id),
+                'step': step,
+                'result': result,
+            }) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class MigrationEngine(object):
+    """Copy hosts between two servers with a bounded pool of workers
+
+    Each host's steps run in order on one worker while different hosts are
+    copied concurrently, with at most max_per_server requests in flight to
+    either server at once.
+    """
+
+    def __init__(self, src_factory, dest_factory, workers=4, max_per_server=4,
+            journal=None, include_db_plugin=False, include_cp_plugin=False):
+        self._src_factory = src_factory
+        self._dest_factory = dest_factory
+        self._workers = workers
+        self._max_per_server = max_per_server
+        self._journal = journal
+        self._copy_options = {
+            'include_db_plugin': include_db_plugin,
+            'include_cp_plugin': include_cp_plugin,
+        }
+
+    def plan(self, include_disabled=False, adopt_existing=False):
+        """Get the plan and destination volume id for the migration
+        """
+
+        src = self._src_factory.thread_client()
+        dest = self._dest_factory.thread_client()
+        src_inventory = Inventory.from_client(src, volumes=False)
+        dest_inventory = Inventory.from_client(dest, volumes=False)
+        dest_volume = dest.Volume.getVolumes()[0]
+        logger.debug('Using volume: %s', dest_volume.id)
+        return (plan_copy(src_inventory, dest_inventory, include_disabled,
+            self._journal, adopt_existing), dest_volume.id)
+
+    def _copy_host(self, host_copy, dest_volume_id, limits):
+        src_policy_id = host_copy.policy.id
+        try:
+            result = copy_host(self._src_factory.thread_client(),
+                self._dest_factory.thread_client(), host_copy, dest_volume_id,
+                self._journal, limits, **self._copy_options)
+        except Exception as err:
+            logger.error('Failed to copy policy: %s', src_policy_id)
+            logger.exception(err)
+            result = err
+        return (src_policy_id, result)
+
+    def run(self, include_disabled=False, adopt_existing=False):
+        """Run the migration, returns a list of (source policy id, result)
+        where result is either the (agent, disksafe, policy) ids on the
+        destination or the exception that stopped that host
+        """
+
+        try:
+            return self._run(include_disabled, adopt_existing)
+        finally:
+            # the worker threads' clients would otherwise keep their
+            # connections open
+            self._src_factory.close()
+            self._dest_factory.close()
+
+    def _run(self, include_disabled, adopt_existing):
+        plan, dest_volume_id = self.plan(include_disabled, adopt_existing)
+        logger.info('Copying %d hosts with %d workers', len(plan), self._workers)
+        limits = {}
+        for factory in (self._src_factory, self._dest_factory):
+            limits.setdefault(factory.host,
+                threading.BoundedSemaphore(self._max_per_server))
+        copy_func = lambda host_copy: self._copy_host(host_copy, dest_volume_id, limits)
+
+        if multiprocessing is None or self._workers < 2:
+            return [copy_func(host_copy) for host_copy in plan]
+        pool = multiprocessing.pool.ThreadPool(self._workers)
+        try:
+            return pool.map(copy_func, plan, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
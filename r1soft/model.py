@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Compact records for agents, disksafes, policies and task contexts, and
+a normalized Host view over CDP2 and CDP3+ servers
+
+The fast_reads option of cdp3.CDP3Client parses getAgents, getDiskSafes,
+getPolicies and getTaskExecutionContextByID responses straight into these
+instead of suds objects, and convert() turns suds objects (or dicts, like
+cached contexts or CDP2 maps) into them. They're read-only stand-ins:
+attribute access, `name in record` and iterating over (name, value) pairs
+work like they do on suds objects, but they can't be sent back to the
+server.
+"""
+
+import logging
+import xml.etree.cElementTree as ElementTree
+from cStringIO import StringIO
+
+logger = logging.getLogger('r1soft.model')
+
+XSI_NIL = '{http://www.w3.org/2001/XMLSchema-instance}nil'
+
+def _local_name(tag):
+    return tag[tag.rfind('}') + 1:]
+
+def _bool(text):
+    return text.strip() in ('true', '1')
+
+def _enum(text):
+    # a handful of values repeated on every record, share one copy of each
+    return intern(text) if isinstance(text, str) else text
+
+def _compact(value):
+    # suds hands back its own unicode subclass, plain ASCII strings are
+    # about a quarter of the size
+    if isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError:
+            return unicode(value)
+    return value
+
+def _datetime(text):
+    # same conversion (and timezone handling) as the suds path
+    from suds.sax.date import DateTime
+    return DateTime(text).datetime
+
+class Record(object):
+    """Base for the records, subclasses list their fields in __slots__
+
+    _types maps fields to a converter for their text (or a Record subclass
+    for nested objects), anything else is kept as a string. Fields in
+    _lists can repeat and are always lists. Fields missing from the
+    response are None.
+    """
+
+    __slots__ = ()
+    _types = {}
+    _lists = frozenset()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            value = fields.get(name, None)
+            if value is None and name in self._lists:
+                value = []
+            setattr(self, name, value)
+
+    @classmethod
+    def from_element(cls, elem):
+        """Build a record from a parsed XML element
+        """
+
+        record = cls()
+        fields = cls.__slots__
+        types = cls._types
+        for child in elem:
+            name = _local_name(child.tag)
+            if name not in fields or child.get(XSI_NIL) == 'true':
+                continue
+            convert = types.get(name, None)
+            if isinstance(convert, type) and issubclass(convert, Record):
+                value = convert.from_element(child)
+            elif child.text is None:
+                continue
+            elif convert is None:
+                value = child.text
+            else:
+                value = convert(child.text)
+            if name in cls._lists:
+                getattr(record, name).append(value)
+            else:
+                setattr(record, name, value)
+        return record
+
+    @classmethod
+    def convert(cls, obj):
+        """Build a record from a suds object, a dict with the same keys (a
+        cached context, a CDP2 map) or a record (returned as is)
+        """
+
+        if obj is None or type(obj) is cls:
+            return obj
+        if isinstance(obj, dict):
+            get = obj.get
+        else:
+            get = lambda name, default: getattr(obj, name, default)
+        record = cls()
+        types = cls._types
+        for name in cls.__slots__:
+            value = get(name, None)
+            if value is None:
+                continue
+            convert = types.get(name, None)
+            if isinstance(convert, type) and issubclass(convert, Record):
+                if name in cls._lists:
+                    if not isinstance(value, (list, tuple)):
+                        value = [value]
+                    value = [convert.convert(item) for item in value]
+                else:
+                    value = convert.convert(value)
+            elif convert is _enum:
+                value = _enum(_compact(value))
+            elif isinstance(value, basestring):
+                value = _compact(value)
+            setattr(record, name, value)
+        return record
+
+    def as_dict(self):
+        """Every field (including the unset ones) as a dict
+        """
+
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __contains__(self, name):
+        return getattr(self, name, None) is not None
+
+    def __iter__(self):
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                yield (name, value)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+            ', '.join('%s=%r' % item for item in self))
+
+class AttributeMapEntry(Record):
+    __slots__ = ('key', 'value')
+
+class AttributeMap(Record):
+    __slots__ = ('entry',)
+    _types = {'entry': AttributeMapEntry}
+    _lists = frozenset(['entry'])
+
+class Agent(Record):
+    __slots__ = ('id', 'hostname', 'portNumber', 'description', 'osType',
+        'agentType', 'databaseAddOnEnabled')
+    _types = {
+        'portNumber': int,
+        'osType': _enum,
+        'agentType': _enum,
+        'databaseAddOnEnabled': _bool,
+    }
+
+class DiskSafe(Record):
+    __slots__ = ('id', 'agentID', 'description', 'path', 'volumeID',
+        'diskSafeAttributeMap')
+    _types = {'diskSafeAttributeMap': AttributeMap}
+
+class DatabaseInstance(Record):
+    # credentials are left out on purpose
+    __slots__ = ('name', 'dataBaseType', 'hostName', 'portNumber', 'username',
+        'enabled')
+    _types = {
+        'dataBaseType': _enum,
+        'portNumber': int,
+        'enabled': _bool,
+    }
+
+class ControlPanelInstance(Record):
+    __slots__ = ('name', 'enabled')
+    _types = {'enabled': _bool}
+
+class Policy(Record):
+    __slots__ = ('id', 'name', 'description', 'enabled', 'state',
+        'diskSafeID', 'recoveryPointLimit', 'lastReplicationRunTime',
+        'replicationScheduleFrequencyType', 'mergeScheduleFrequencyType',
+        'forceFullBlockScan', 'databaseInstanceList',
+        'controlPanelInstanceList')
+    _types = {
+        'enabled': _bool,
+        'state': _enum,
+        'recoveryPointLimit': int,
+        'lastReplicationRunTime': _datetime,
+        'replicationScheduleFrequencyType': _enum,
+        'mergeScheduleFrequencyType': _enum,
+        'forceFullBlockScan': _bool,
+        'databaseInstanceList': DatabaseInstance,
+        'controlPanelInstanceList': ControlPanelInstance,
+    }
+    _lists = frozenset(['databaseInstanceList', 'controlPanelInstanceList'])
+
+class TaskContext(Record):
+    __slots__ = ('id', 'agentId', 'diskSafeId', 'policyId', 'taskType',
+        'taskState', 'executionTime')
+    _types = {
+        'taskType': _enum,
+        'taskState': _enum,
+        'executionTime': _datetime,
+    }
+
+class Host(Record):
+    """Normalized view of a protected host, the same for CDP2 hosts and
+    CDP3+ agents (with their policy)
+    """
+
+    __slots__ = ('hostname', 'description', 'os_type', 'active',
+        'recovery_point_limit', 'mysql_module', 'cp_module')
+    _types = {'os_type': _enum}
+
+    @classmethod
+    def from_cdp2(cls, host, tasks=()):
+        """Build from a CDP2 host map (host.getHostAsMap) and the host's
+        scheduled task summaries, it's active if it's enabled and has an
+        enabled backup task
+        """
+
+        from .cdp2 import HOST_TYPES
+        return cls(
+            hostname=_compact(host['hostname']),
+            description=_compact(host['description']),
+            os_type=_enum(HOST_TYPES[host['hostType']].upper()),
+            active=bool(host['enabled'] and any(task['taskType'] == 'Backup' \
+                and task['enabled'] for task in tasks)),
+            mysql_module=bool(host['cdpForMySqlAddonEnabled']),
+            cp_module=bool(host['controlPanelModuleEnabled']),
+        )
+
+    @classmethod
+    def from_cdp3(cls, policy, disksafe, agent):
+        """Build from a CDP3+ policy and its disksafe and agent (records or
+        suds objects)
+        """
+
+        return cls(
+            hostname=_compact(agent.hostname),
+            description=_compact(agent.description),
+            os_type=_enum(str(agent.osType).upper()),
+            active=bool(policy.enabled),
+            recovery_point_limit=policy.recoveryPointLimit,
+            mysql_module=bool(agent.databaseAddOnEnabled and \
+                getattr(policy, 'databaseInstanceList', None)),
+            # not exposed in a way we can check yet
+            cp_module=False,
+        )
+
+def parse_response(data, record_type):
+    """Parse the returned objects out of a raw SOAP response as record_type
+    records
+
+    The response is parsed incrementally and each object's elements are
+    dropped once it's converted, so the whole document is never held as a
+    tree.
+    """
+
+    records = []
+    depth = 0
+    # Envelope > Body > xxxResponse > return
+    for event, elem in ElementTree.iterparse(StringIO(data),
+            events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 3:
+            if _local_name(elem.tag) == 'return':
+                records.append(record_type.from_element(elem))
+            elem.clear()
+    return records
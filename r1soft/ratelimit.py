@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger('r1soft.ratelimit')
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter
+
+    Tokens are added at rate per second up to burst, each request takes one
+    token and waits for one to become available if the bucket is empty.
+    """
+
+    def __init__(self, rate, burst=None):
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+        self._tokens = self.burst
+        self._last = time.time()
+
+    def configure(self, rate, burst=None):
+        with self._lock:
+            self.rate = float(rate)
+            self.burst = float(max(1, rate if burst is None else burst))
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if they're available right now, returns whether they
+        were taken
+        """
+
+        with self._lock:
+            self._refill(time.time())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """Take tokens, waiting for them if needed. Returns the time spent
+        waiting
+        """
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.time())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait_time = (tokens - self._tokens) / self.rate
+            logger.debug('Sleeping for %0.4f seconds for rate limiting', wait_time)
+            time.sleep(wait_time)
+            waited += wait_time
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(key, rate, burst=None):
+    """Get the shared TokenBucket for key (usually (host, port) of a CDP
+    server), creating it or updating its rate and burst as needed
+    """
+
+    with _limiters_lock:
+        limiter = _limiters.get(key, None)
+        if limiter is None:
+            limiter = _limiters[key] = TokenBucket(rate, burst)
+        elif limiter.rate != rate or (burst is not None and limiter.burst != burst):
+            limiter.configure(rate, burst)
+        return limiter
+
+class RetryBudget(object):
+    """Limit retries to a fraction of successful calls
+
+    Every success deposits ratio tokens (up to max_tokens) and every retry
+    withdraws a whole one, so while a server is failing most calls the
+    retries dry up instead of multiplying the load on it.
+    """
+
+    def __init__(self, ratio=0.2, max_tokens=10, initial=None):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = float(max_tokens if initial is None else initial)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """Take a token for a retry, returns False if the budget is spent
+        """
+
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+_retry_budgets = {}
+
+def get_retry_budget(key, **kwargs):
+    """Get the shared RetryBudget for key (usually (host, port) of a CDP
+    server)
+    """
+
+    with _limiters_lock:
+        budget = _retry_budgets.get(key, None)
+        if budget is None:
+            budget = _retry_budgets[key] = RetryBudget(**kwargs)
+        return budget
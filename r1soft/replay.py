@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Record the requests a run makes to the CDP servers and replay them later
+without the servers
+
+While recording, every SOAP and XML-RPC request is passed on to the server
+as usual and its response (or error) is written to a gzipped file of JSON
+lines along with how long the server took. Replaying answers the same
+requests from the file, taking the recorded time divided by speed (speed=0
+answers right away), so a run can be profiled against production traffic
+shapes as often as needed.
+
+Turn it on for a whole run without changing any code with the
+R1SOFT_RECORD=filename or R1SOFT_REPLAY=filename (and R1SOFT_REPLAY_SPEED)
+environment variables, or call record() / replay() before creating any
+clients. Record with an empty cache dir (R1SOFT_CACHE_DIR) so the WSDL
+fetches end up in the recording too. Worker processes forked while
+recording write to their own filename.<pid> files, which are replayed along
+with the main file.
+"""
+
+import atexit
+import errno
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+
+from . import timeouts
+
+logger = logging.getLogger('r1soft.replay')
+
+FORMAT_VERSION = 1
+
+ERROR_TIMEOUT   = 'timeout'
+ERROR_SOCKET    = 'error'
+
+class ReplayMissError(LookupError):
+    """Raised when replaying a request that isn't in the recording
+    """
+
+def request_key(method, url, body=None):
+    """Key matching a replayed request to the recorded one
+    """
+
+    digest = hashlib.sha1('%s %s\n' % (method, url))
+    if body:
+        digest.update(body)
+    return digest.hexdigest()[:20]
+
+def _body_key(body):
+    return hashlib.sha1(body).hexdigest()[:20]
+
+class Recorder(object):
+    """Writes requests and their responses to a recording file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._bodies = set()
+        self._start = time.time()
+        self._owner_pid = os.getpid()
+        # files opened by a parent process, kept so a forked child never
+        # closes (and finishes off) the parent's file
+        self._inherited = []
+
+    def _open(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._file
+        if self._file is not None:
+            self._inherited.append(self._file)
+        if pid == self._owner_pid:
+            filename = self.filename
+        else:
+            filename = '%s.%d' % (self.filename, pid)
+        logger.info('Recording requests to: %s', filename)
+        self._file = gzip.GzipFile(filename, 'wb')
+        self._pid = pid
+        self._bodies = set()
+        self._write({'format': 'r1soft-replay', 'version': FORMAT_VERSION,
+            'started': self._start})
+        return self._file
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def record(self, method, url, request_body, start, duration, status=None,
+            body=None, error=None):
+        """Record one request, either the HTTP status and response body or
+        the error that stopped it
+        """
+
+        entry = {
+            'k': request_key(method, url, request_body),
+            'u': url,
+            't': round(start - self._start, 6),
+            'd': round(duration, 6),
+        }
+        if error is not None:
+            kind = ERROR_TIMEOUT if isinstance(error, socket.timeout) \
+                else ERROR_SOCKET
+            entry['e'] = [kind, str(error)]
+        else:
+            entry['s'] = status
+        with self._lock:
+            self._open()
+            if body is not None:
+                # the same response often comes back many times (WSDLs, the
+                # same objects), only keep one copy of each
+                body_key = _body_key(body)
+                if body_key not in self._bodies:
+                    self._bodies.add(body_key)
+                    self._write({'b': body_key, 'data': body.decode('latin-1')})
+                entry['r'] = body_key
+            self._write(entry)
+            # keep the file readable even if the process never gets to close
+            # it (forked workers exit without running atexit handlers)
+            self._file.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+                self._file = None
+                self._pid = None
+
+    def soap_transport(self, transport, username=None, password=None):
+        from .transport import RecordingTransport
+        if transport is None:
+            import suds.transport.https
+            transport = suds.transport.https.HttpAuthenticated(
+                username=username, password=password)
+        return RecordingTransport(transport, self)
+
+    def xmlrpc_transport(self, transport):
+        from .cdp2 import RecordingXmlRpcTransport
+        return RecordingXmlRpcTransport(transport, self)
+
+def _read_entries(filename):
+    with open(filename, 'rb') as f:
+        # decompressed by hand since gzip chokes on files that were never
+        # closed, which still hold everything up to the last flush
+        data = zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(f.read())
+    for line in data.splitlines():
+        if line.strip():
+            yield json.loads(line)
+
+class Player(object):
+    """Answers requests from a recording
+
+    Requests repeated more times than they were recorded get the last
+    recorded response again.
+    """
+
+    def __init__(self, filename, speed=1.0):
+        self.filename = filename
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._exchanges = {}
+        self._positions = {}
+        bodies = {}
+        # with a process pool the main process may not have made any
+        # requests itself, leaving only the workers' files
+        filenames = [f for f in [filename] if os.path.exists(f)] + \
+            sorted(f for f in glob.glob(filename + '.*') \
+                if f.rpartition('.')[2].isdigit())
+        if not filenames:
+            raise IOError(errno.ENOENT, 'No recording found', filename)
+        for recording in filenames:
+            for entry in _read_entries(recording):
+                if 'b' in entry:
+                    bodies[entry['b']] = entry['data'].encode('latin-1')
+                elif 'k' in entry:
+                    body = bodies[entry['r']] if 'r' in entry else None
+                    self._exchanges.setdefault(entry['k'], []).append(
+                        (entry['d'], entry.get('s', None), body, entry.get('e', None)))
+        logger.info('Replaying %d requests from: %s',
+            sum(len(e) for e in self._exchanges.itervalues()), filename)
+
+    def lookup(self, method, url, request_body=None):
+        """Get the recorded (HTTP status, response body) of a request after
+        waiting as long as the server took, raises the recorded error if the
+        request failed
+        """
+
+        key = request_key(method, url, request_body)
+        with self._lock:
+            exchanges = self._exchanges.get(key, None)
+            if not exchanges:
+                raise ReplayMissError('Request not in recording: %s %s' % (
+                    method, url))
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+        duration, status, body, error = exchanges[min(position, len(exchanges) - 1)]
+        if self.speed:
+            time.sleep(duration / self.speed)
+        if error is not None:
+            kind, message = error
+            if kind == ERROR_TIMEOUT:
+                raise timeouts.ReadTimeout(message)
+            raise socket.error(message)
+        return (status, body)
+
+    def close(self):
+        pass
+
+    def soap_transport(self, transport, username=None, password=None):
+        from .transport import ReplayTransport
+        return ReplayTransport(self)
+
+    def xmlrpc_transport(self, transport):
+        from .cdp2 import ReplayXmlRpcTransport
+        return ReplayXmlRpcTransport(self,
+            getattr(transport, '_use_datetime', 0))
+
+_session = None
+_session_lock = threading.RLock()
+_env_checked = False
+
+def install(session):
+    """Make clients created from now on record to / replay from session
+    """
+
+    global _session, _env_checked
+    with _session_lock:
+        _session = session
+        _env_checked = True
+    return session
+
+def uninstall():
+    """Stop recording / replaying, returns the session that was installed
+    """
+
+    global _session
+    with _session_lock:
+        session, _session = _session, None
+    if session is not None:
+        session.close()
+    return session
+
+def record(filename):
+    recorder = install(Recorder(filename))
+    atexit.register(recorder.close)
+    return recorder
+
+def replay(filename, speed=1.0):
+    return install(Player(filename, speed))
+
+def active():
+    """Get the installed Recorder or Player (set up from the environment the
+    first time if record() / replay() weren't called), or None
+    """
+
+    if not _env_checked:
+        _install_from_env()
+    return _session
+
+def _install_from_env():
+    global _env_checked
+    with _session_lock:
+        if _env_checked:
+            return
+        _env_checked = True
+        if os.environ.get('R1SOFT_REPLAY'):
+            replay(os.environ['R1SOFT_REPLAY'],
+                float(os.environ.get('R1SOFT_REPLAY_SPEED', 1.0)))
+        elif os.environ.get('R1SOFT_RECORD'):
+            record(os.environ['R1SOFT_RECORD'])
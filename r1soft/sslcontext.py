@@ -7,8 +7,8 @@
 """
 
 import ssl
-from urllib2 import HTTPSHandler
-import suds.transport.http
+import sys
+import types
 
 
 def create_ssl_context(verify=True, cafile=None, capath=None):
@@ -45,38 +45,17 @@ def create_ssl_context(verify=True, cafile=None, capath=None):
     return context
 
 
-class HTTPSTransport(suds.transport.https.HttpAuthenticated):
-    """A modified HttpTransport using an explicit SSL context.
-    """
-
-    def __init__(self, context, **kwargs):
-        """Initialize the HTTPSTransport instance.
-
-        :param context: The SSL context to use.
-        :type context: :class:`ssl.SSLContext`
-        :param kwargs: keyword arguments.
-        :see: :class:`suds.transport.http.HttpTransport` for the
-            keyword arguments.
-        """
-        suds.transport.https.HttpAuthenticated.__init__(self, **kwargs)
-        self.ssl_context = context
-        self.verify = (context and context.verify_mode != ssl.CERT_NONE)
-
-    def u2handlers(self):
-        """Get a collection of urllib handlers.
-        """
-        handlers = suds.transport.https.HttpAuthenticated.u2handlers(self)
-        if self.ssl_context:
-            try:
-                handlers.append(HTTPSHandler(context=self.ssl_context,
-                                             check_hostname=self.verify))
-            except TypeError:
-                # Python 2.7.9 HTTPSHandler does not accept the
-                # check_hostname keyword argument.
-                #
-                # Note that even older Python versions would also
-                # croak on the context keyword argument.  But these
-                # old versions do not have SSLContext either, so we
-                # will not end up here in the first place.
-                handlers.append(HTTPSHandler(context=self.ssl_context))
-        return handlers
+class _LazyModule(types.ModuleType):
+    # HTTPSTransport moved to r1soft.transport so importing this module
+    # doesn't pull in suds, it's still importable from here
+    def __getattr__(self, name):
+        if name == 'HTTPSTransport':
+            from .transport import HTTPSTransport
+            return HTTPSTransport
+        raise AttributeError('\'module\' object has no attribute \'%s\'' % name)
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+# keep the original module alive, its globals get wiped if it's collected
+_module._module = sys.modules[__name__]
+sys.modules[__name__] = _module
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import contextlib
+import logging
+import socket
+import threading
+import time
+
+logger = logging.getLogger('r1soft.timeouts')
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT    = 90
+
+class CDPTimeoutError(socket.timeout):
+    """A CDP server didn't respond in time
+    """
+
+class ConnectTimeout(CDPTimeoutError):
+    """Couldn't connect to the server within the connect timeout
+    """
+
+class ReadTimeout(CDPTimeoutError):
+    """Connected but the server didn't send anything within the read timeout
+    """
+
+class CallTimeout(CDPTimeoutError):
+    """The call (including any retries) ran past its deadline
+    """
+
+_local = threading.local()
+
+def get_deadline():
+    """Get the deadline (a timestamp) for calls made from this thread, or None
+    """
+
+    return getattr(_local, 'deadline', None)
+
+@contextlib.contextmanager
+def deadline_at(deadline):
+    """Make calls from this thread inside the block give up at deadline (a
+    timestamp), an already set earlier deadline still applies
+    """
+
+    previous = get_deadline()
+    if deadline is None or (previous is not None and previous <= deadline):
+        yield previous
+        return
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = previous
+
+def deadline(seconds):
+    """Like deadline_at() but seconds from now
+    """
+
+    return deadline_at(None if seconds is None else time.time() + seconds)
+
+def with_deadline(func, deadline):
+    """Wrap func so it runs under deadline_at(deadline), for carrying the
+    caller's deadline over to worker threads
+    """
+
+    if deadline is None:
+        return func
+    def deadline_wrapper(*args, **kwargs):
+        with deadline_at(deadline):
+            return func(*args, **kwargs)
+    return deadline_wrapper
+
+def effective_timeout(timeout):
+    """Get the socket timeout to use right now: timeout, but no more than
+    what's left before this thread's deadline
+
+    Raises CallTimeout if the deadline has already passed.
+    """
+
+    deadline = get_deadline()
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise CallTimeout('Call deadline passed')
+    return remaining if timeout is None else min(timeout, remaining)
+
+def connect(conn, connect_timeout=None, read_timeout=None):
+    """Open an httplib connection giving up after connect_timeout, then switch
+    the socket over to read_timeout
+    """
+
+    conn.timeout = effective_timeout(connect_timeout)
+    try:
+        conn.connect()
+    except socket.timeout:
+        conn.close()
+        raise ConnectTimeout('Timed out connecting to %s:%s after %ss' % (
+            conn.host, conn.port, conn.timeout))
+    set_read_timeout(conn, read_timeout)
+
+def set_read_timeout(conn, read_timeout=None):
+    """Set the timeout for the next request on an open httplib connection
+    """
+
+    conn.timeout = effective_timeout(read_timeout)
+    if conn.sock is not None:
+        conn.sock.settimeout(conn.timeout)
+
+def read_timeout_error(err, host, timeout):
+    """Turn a socket.timeout from a request to host into the typed error
+    """
+
+    if isinstance(err, CDPTimeoutError):
+        return err
+    deadline = get_deadline()
+    if deadline is not None and time.time() >= deadline:
+        return CallTimeout('Call deadline passed waiting on %s' % host)
+    return ReadTimeout('Timed out reading from %s after %ss' % (host, timeout))
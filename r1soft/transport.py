@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import base64
+import Cookie
+import errno
+import httplib
+import logging
+import socket
+import ssl
+import threading
+import time
+import urlparse
+from cStringIO import StringIO
+from urllib2 import HTTPSHandler
+
+import suds.transport
+import suds.transport.https
+from suds.properties import Unskin
+
+from . import instrument
+from . import timeouts
+
+logger = logging.getLogger('r1soft.transport')
+
+DEFAULT_POOL_SIZE       = 4
+DEFAULT_IDLE_TIMEOUT    = 30
+
+# errors that mean a kept-alive connection was closed by the server while it
+# was sitting in the pool, the request is safe to retry on a new connection
+STALE_CONNECTION_ERRORS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+class ConnectionPool(object):
+    """Thread-safe pool of persistent HTTP(S) connections
+
+    Connections are kept per (scheme, host, port), at most max_size of them
+    can be in use at once for each (further requests wait for one to be
+    returned) and connections left idle for longer than idle_timeout are
+    closed instead of reused.
+    """
+
+    def __init__(self, max_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+            ssl_context=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    def _slot(self, key):
+        with self._lock:
+            slot = self._slots.get(key, None)
+            if slot is None:
+                slot = self._slots[key] = threading.BoundedSemaphore(self.max_size)
+            return slot
+
+    def _connect(self, key, connect_timeout, read_timeout):
+        scheme, host, port = key
+        logger.debug('Opening new connection to %s://%s:%s', scheme, host, port)
+        if scheme == 'https':
+            if self.ssl_context is not None:
+                conn = httplib.HTTPSConnection(host, port,
+                    context=self.ssl_context)
+            else:
+                conn = httplib.HTTPSConnection(host, port)
+        else:
+            conn = httplib.HTTPConnection(host, port)
+        timeouts.connect(conn, connect_timeout, read_timeout)
+        return conn
+
+    def _get_idle(self, key):
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn
+                conn.close()
+        return None
+
+    def get(self, key, connect_timeout=None, read_timeout=None):
+        """Get a connection for key, returns (connection, reused)
+
+        New connections give up connecting after connect_timeout, either way
+        the connection's socket is set to time out reads after read_timeout.
+        """
+
+        self._slot(key).acquire()
+        try:
+            conn = self._get_idle(key)
+            if conn is not None:
+                try:
+                    timeouts.set_read_timeout(conn, read_timeout)
+                except Exception:
+                    conn.close()
+                    raise
+                return (conn, True)
+            return (self._connect(key, connect_timeout, read_timeout), False)
+        except Exception:
+            self._slot(key).release()
+            raise
+
+    def put(self, key, conn, reusable=True):
+        """Hand a connection from get() back to the pool
+        """
+
+        if reusable:
+            with self._lock:
+                self._idle.setdefault(key, []).append((conn, time.time()))
+        else:
+            conn.close()
+        self._slot(key).release()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.itervalues():
+                for conn, last_used in idle:
+                    conn.close()
+            self._idle.clear()
+
+class PooledHTTPTransport(suds.transport.Transport):
+    """suds transport sending requests over persistent connections from a
+    (possibly shared) ConnectionPool
+
+    A drop-in for sslcontext.HTTPSTransport, credentials are sent with every
+    request like suds' HttpAuthenticated does. Connecting gives up after
+    connect_timeout and waiting on a response after read_timeout (suds'
+    timeout option if not given), raising a timeouts.CDPTimeoutError.
+    """
+
+    def __init__(self, pool=None, context=None, connect_timeout=None,
+            read_timeout=None, **kwargs):
+        suds.transport.Transport.__init__(self)
+        Unskin(self.options).update(kwargs)
+        if pool is None:
+            pool = ConnectionPool(ssl_context=context)
+        self.pool = pool
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.cookies = Cookie.SimpleCookie()
+
+    def __deepcopy__(self, memo={}):
+        clone = self.__class__(pool=self.pool,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout)
+        Unskin(clone.options).update(Unskin(self.options))
+        return clone
+
+    def _headers(self, headers=None):
+        result = dict(self.options.headers)
+        if headers:
+            result.update(headers)
+        if not (None in (self.options.username, self.options.password)):
+            result['Authorization'] = 'Basic %s' % base64.b64encode(
+                '%s:%s' % (self.options.username, self.options.password))
+        cookies = '; '.join('%s=%s' % (morsel.key, morsel.coded_value) \
+            for morsel in self.cookies.itervalues())
+        if cookies:
+            result['Cookie'] = cookies
+        return result
+
+    def _request(self, method, url, body=None, headers=None):
+        parts = urlparse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = self._headers(headers)
+        read_timeout = self.read_timeout
+        if read_timeout is None:
+            read_timeout = self.options.timeout
+
+        while True:
+            conn, reused = self.pool.get(key, self.connect_timeout, read_timeout)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except socket.timeout as err:
+                self.pool.put(key, conn, False)
+                raise timeouts.read_timeout_error(err,
+                    '%s:%s' % (conn.host, conn.port), conn.timeout)
+            except (httplib.BadStatusLine, socket.error) as err:
+                self.pool.put(key, conn, False)
+                if reused and (isinstance(err, httplib.BadStatusLine) or \
+                        getattr(err, 'errno', None) in STALE_CONNECTION_ERRORS):
+                    logger.debug('Pooled connection went stale, retrying: %s', err)
+                    continue
+                raise
+            except Exception:
+                self.pool.put(key, conn, False)
+                raise
+            self.pool.put(key, conn, not response.will_close)
+            break
+
+        for cookie in response.msg.getheaders('set-cookie'):
+            self.cookies.load(cookie)
+        return (response, data)
+
+    def open(self, request):
+        logger.debug('Opening: %s', request.url)
+        response, data = self._request('GET', request.url, headers=request.headers)
+        if response.status >= 300:
+            raise suds.transport.TransportError(response.reason,
+                response.status, StringIO(data))
+        return StringIO(data)
+
+    def send(self, request):
+        logger.debug('Sending to: %s', request.url)
+        response, data = self._request('POST', request.url, request.message,
+            request.headers)
+        instrument.record_bytes(len(request.message or ''), len(data))
+        if response.status in (202, 204):
+            return None
+        if response.status >= 300:
+            raise suds.transport.TransportError(response.reason,
+                response.status, StringIO(data))
+        return suds.transport.Reply(response.status,
+            dict(response.getheaders()), data)
+
+class OfflineTransport(suds.transport.Transport):
+    """suds transport failing every request, for loading WSDLs only if they
+    are already in the cache
+    """
+
+    def open(self, request):
+        raise suds.transport.TransportError('Offline, not fetching: %s' % \
+            request.url, None)
+
+    def send(self, request):
+        raise suds.transport.TransportError('Offline, not sending to: %s' % \
+            request.url, None)
+
+class RecordingTransport(suds.transport.Transport):
+    """suds transport passing requests on to another transport and recording
+    them with a replay.Recorder
+    """
+
+    def __init__(self, transport, recorder):
+        suds.transport.Transport.__init__(self)
+        self.transport = transport
+        self.recorder = recorder
+        # share the real transport's options so the client's settings
+        # (credentials, timeout) still reach it
+        self.options = transport.options
+
+    def _run(self, method, request, func):
+        start = time.time()
+        try:
+            result = func(request)
+        except suds.transport.TransportError as err:
+            body = err.fp.read() if err.fp is not None else ''
+            self.recorder.record(method, request.url, request.message, start,
+                time.time() - start, status=err.httpcode, body=body)
+            raise suds.transport.TransportError(err.args[0], err.httpcode,
+                StringIO(body))
+        except Exception as err:
+            self.recorder.record(method, request.url, request.message, start,
+                time.time() - start, error=err)
+            raise
+        return start, result
+
+    def open(self, request):
+        start, result = self._run('GET', request, self.transport.open)
+        data = result.read()
+        self.recorder.record('GET', request.url, None, start,
+            time.time() - start, status=200, body=data)
+        return StringIO(data)
+
+    def send(self, request):
+        start, reply = self._run('POST', request, self.transport.send)
+        if reply is None:
+            self.recorder.record('POST', request.url, request.message, start,
+                time.time() - start, status=204)
+        else:
+            self.recorder.record('POST', request.url, request.message, start,
+                time.time() - start, status=reply.code, body=reply.message)
+        return reply
+
+class ReplayTransport(suds.transport.Transport):
+    """suds transport answering requests from a replay.Player
+    """
+
+    def __init__(self, player):
+        suds.transport.Transport.__init__(self)
+        self.player = player
+
+    def open(self, request):
+        logger.debug('Replaying: %s', request.url)
+        status, data = self.player.lookup('GET', request.url)
+        if status >= 300:
+            raise suds.transport.TransportError('Replayed HTTP error', status,
+                StringIO(data or ''))
+        return StringIO(data)
+
+    def send(self, request):
+        logger.debug('Replaying request to: %s', request.url)
+        status, data = self.player.lookup('POST', request.url, request.message)
+        instrument.record_bytes(len(request.message or ''), len(data or ''))
+        if status in (202, 204):
+            return None
+        if status >= 300:
+            raise suds.transport.TransportError('Replayed HTTP error', status,
+                StringIO(data or ''))
+        return suds.transport.Reply(status, {}, data)
+
+class CountingHttpTransport(suds.transport.https.HttpAuthenticated):
+    """suds' (urllib2 based) HttpAuthenticated transport, recording the
+    payload sizes with r1soft.instrument like PooledHTTPTransport does
+    """
+
+    def send(self, request):
+        instrument.record_bytes(sent=len(request.message or ''))
+        reply = suds.transport.https.HttpAuthenticated.send(self, request)
+        if reply is not None:
+            instrument.record_bytes(received=len(reply.message or ''))
+        return reply
+
+# moved here from sslcontext so that module doesn't need suds
+class HTTPSTransport(CountingHttpTransport):
+    """A modified HttpTransport using an explicit SSL context.
+    """
+
+    def __init__(self, context, **kwargs):
+        """Initialize the HTTPSTransport instance.
+
+        :param context: The SSL context to use.
+        :type context: :class:`ssl.SSLContext`
+        :param kwargs: keyword arguments.
+        :see: :class:`suds.transport.http.HttpTransport` for the
+            keyword arguments.
+        """
+        CountingHttpTransport.__init__(self, **kwargs)
+        self.ssl_context = context
+        self.verify = (context and context.verify_mode != ssl.CERT_NONE)
+
+    def u2handlers(self):
+        """Get a collection of urllib handlers.
+        """
+        handlers = CountingHttpTransport.u2handlers(self)
+        if self.ssl_context:
+            try:
+                handlers.append(HTTPSHandler(context=self.ssl_context,
+                                             check_hostname=self.verify))
+            except TypeError:
+                # Python 2.7.9 HTTPSHandler does not accept the
+                # check_hostname keyword argument.
+                #
+                # Note that even older Python versions would also
+                # croak on the context keyword argument.  But these
+                # old versions do not have SSLContext either, so we
+                # will not end up here in the first place.
+                handlers.append(HTTPSHandler(context=self.ssl_context))
+        return handlers
@@ -17,9 +17,15 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import cPickle as pickle
+import logging
 import optparse
 import os
+import Queue
+import sys
+import threading
 import time
+import traceback
 
 try:
     import multiprocessing
@@ -27,8 +33,15 @@ try:
 except ImportError:
     multiprocessing = None
 
-from .cdp2 import CDP2Client
-from .cdp3 import CDP3Client
+from . import instrument
+from . import replay
+from . import timeouts
+
+logger = logging.getLogger('r1soft.util')
+
+# how long past a server's timeout to wait on its handler before giving up on
+# it, the handler's own API calls should already have timed out by then
+DISPATCH_TIMEOUT_GRACE = 5
 
 def build_option_parser(parser=None):
     if parser is None:
@@ -43,13 +56,36 @@ def build_option_parser(parser=None):
         default=os.environ.get('R1SOFT_PASSWORD', ''))
     return parser
 
+def _parse_config_value(value):
+    for value_type in (int, float):
+        try:
+            return value_type(value)
+        except ValueError:
+            pass
+    return value
+
 def read_config(config_filename):
+    """Read the server list config file
+
+    Each line is version:hostname:port:ssl:username:password, optionally
+    followed by more :key=value fields for per-server settings, for example
+    rate_limit=10:rate_burst=20 or connect_timeout=5:read_timeout=60 (plus
+    call_deadline, seconds allowed for a whole API call including retries)
+    """
+
     with open(config_filename) as f:
         config_raw = f.read().strip()
     keys = ['version', 'hostname', 'port', 'ssl', 'username', 'password']
-    config = [dict(zip(keys, (field.strip() for field in line.strip().split(':')))) \
-            for line in config_raw.split('\n') \
-        if line.strip() and not line.startswith('#')]
+    config = []
+    for line in config_raw.split('\n'):
+        if not line.strip() or line.startswith('#'):
+            continue
+        fields = [field.strip() for field in line.strip().split(':')]
+        server = dict(zip(keys, fields))
+        for option in fields[len(keys):]:
+            key, _, value = option.partition('=')
+            server[key.strip()] = _parse_config_value(value.strip())
+        config.append(server)
     int_keys = ['version', 'port', 'ssl']
     for server in config:
         for key in int_keys:
@@ -67,27 +103,725 @@ def dispatch_handlers(config, server_handler):
     for server in config:
         yield (server, server_handler(server))
 
-def dispatch_handlers_mp(config, server_handler, workers=None):
+_handlers = {}
+
+def register_handler(name, versions=(None,)):
+    """Decorator registering a server handler under name for the given CDP
+    versions (None makes it the default for any version), so it can be
+    referenced by name with a NamedHandler
+    """
+
+    def decorator(func):
+        for version in versions:
+            _handlers[(name, version)] = func
+        return func
+    return decorator
+
+def get_handler(name, version=None):
+    handler = _handlers.get((name, version), None)
+    if handler is None:
+        handler = _handlers.get((name, None), None)
+    if handler is None:
+        raise KeyError('No handler registered for %s (CDP%s)' % (name, version))
+    return handler
+
+class NamedHandler(object):
+    """Picklable reference to a registered handler, picking the one for the
+    server's version and calling it with the server and any extra args
+    """
+
+    def __init__(self, name, *args):
+        self.name = name
+        self.args = args
+
+    def __call__(self, server):
+        return get_handler(self.name, server['version'])(server, *self.args)
+
+def dispatch_handlers_mp(config, server_handler, workers=None, timeout=None,
+        namespaces=None):
+    """Run server handlers in a process pool, yielding (server, result) as each
+    one finishes (see dispatch_handlers_stream())
+
+    server_handler can be the name of a registered handler (or anything else
+    picklable, like a NamedHandler). Handlers get this worker's clients with
+    get_cdp3_factory() and get_cdp2_client(), built once per worker. Each
+    worker starts by loading any cached WSDLs for namespaces (see
+    init_worker()).
+    """
+
+    if isinstance(server_handler, basestring):
+        server_handler = NamedHandler(server_handler)
     if multiprocessing is None:
-        return dispatch_handlers(config, server_handler)
-    else:
-        pool = multiprocessing.Pool(workers)
-        return pool.map(server_handler, config)
+        return dispatch_handlers_stream(config, server_handler, timeout=timeout)
+    config = list(config)
+    return dispatch_handlers_stream(config, server_handler,
+        workers or multiprocessing.cpu_count(), timeout, processes=True,
+        initializer=init_worker, initargs=(config, namespaces or ()))
+
+def _server_deadline(server_handler, timeout):
+    """Run each server's handler under a deadline of timeout seconds (or the
+    server's own server_timeout setting), once it passes API calls from the
+    handler fail with a timeouts.CallTimeout
+    """
 
-def dispatch_handlers_t(config, server_handler, workers=None):
+    def deadline_wrapper(server):
+        try:
+            with timeouts.deadline(server.get('server_timeout', timeout)):
+                return server_handler(server)
+        finally:
+            close_shared_clients(server)
+    return deadline_wrapper
+
+def dispatch_handlers_t(config, server_handler, workers=None, limiter=None,
+        timeout=None):
+    server_handler = _server_deadline(server_handler, timeout)
     if multiprocessing is None:
         return dispatch_handlers(config, server_handler)
+    elif limiter is not None:
+        return adaptive_map(server_handler, config, limiter)
     else:
         pool = multiprocessing.pool.ThreadPool(workers)
-        return pool.map(server_handler, config)
+        try:
+            return pool.map(server_handler, config)
+        finally:
+            pool.close()
+            pool.join()
+
+class DispatchTimeout(timeouts.CallTimeout):
+    """A server's handler didn't finish within its timeout
+    """
+
+class HandlerError(Exception):
+    """An exception raised by a handler in a worker process, passed back as
+    its class name, message and formatted traceback since the original might
+    not survive pickling
+    """
+
+    def __init__(self, name, message, traceback_text):
+        Exception.__init__(self, name, message, traceback_text)
+        self.name = name
+        self.message = message
+        self.traceback_text = traceback_text
+
+    def __str__(self):
+        return '%s: %s' % (self.name, self.message)
+
+    @classmethod
+    def from_exception(cls, err):
+        return cls(type(err).__name__, str(err), traceback.format_exc())
+
+def _run_server_handler(server_handler, index, server, timeout,
+        processes=False):
+    # module level (and never raising) so it also works in a process pool
+    try:
+        try:
+            with timeouts.deadline(timeout):
+                result = server_handler(server)
+        finally:
+            close_shared_clients(server)
+    except Exception as err:
+        if not processes:
+            return (index, err)
+        result = HandlerError.from_exception(err)
+    if processes:
+        # anything that can't make it back through the pool's result queue
+        # would leave the dispatcher waiting on it forever
+        try:
+            pickle.loads(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        except Exception as err:
+            logger.warn('Couldn\'t pass back result for %s: %s',
+                server.get('hostname'), err)
+            result = HandlerError.from_exception(err)
+    return (index, result)
+
+def dispatch_handlers_stream(config, server_handler, workers=4, timeout=None,
+        processes=False, pool=None, initializer=None, initargs=()):
+    """Run server_handler for each server in parallel, yielding
+    (server, result) as each one finishes
+
+    If the handler raises, the exception is yielded as the result (as a
+    HandlerError with processes=True, as are results that can't be pickled).
+    A server gets timeout seconds (or its own server_timeout setting) before
+    API calls from its handler start failing with a timeouts.CallTimeout, if
+    it still hasn't finished shortly after that a DispatchTimeout is yielded
+    for it instead. Only workers servers are in flight at once, a handler
+    that was given up on keeps its worker busy until it does finish. If the
+    workers are all stuck like that for as long as the next server would
+    have been given, a DispatchTimeout is yielded for each server that
+    couldn't be started. Closing the generator early (e.g. breaking out of
+    the loop) cancels the rest. With
+    processes=True a process pool is used, server_handler has to be picklable
+    then (see dispatch_handlers_mp()). An existing pool (e.g. a Scheduler) can
+    be given to run on instead.
+    """
+
+    if multiprocessing is None and pool is None:
+        for server in config:
+            yield (server, _run_server_handler(server_handler, None, server,
+                server.get('server_timeout', timeout))[1])
+        return
+    own_pool = pool is None
+    if own_pool:
+        if processes:
+            # set up any recording / replay before forking so the workers
+            # share it (and write to the one recording)
+            replay.active()
+            pool = multiprocessing.Pool(workers, initializer, initargs)
+        else:
+            pool = multiprocessing.pool.ThreadPool(workers, initializer, initargs)
+    done = Queue.Queue()
+    servers = enumerate(config)
+    pending = {}
+    running = [0]
+    # the next server to start once a worker frees up, when every worker is
+    # stuck on a handler that was given up on: [(index, server, give_up)]
+    waiting = []
+
+    def give_up_time(server):
+        server_timeout = server.get('server_timeout', timeout)
+        if server_timeout is None:
+            return None
+        return time.time() + server_timeout + DISPATCH_TIMEOUT_GRACE
+
+    def submit():
+        if waiting:
+            index, server, give_up = waiting.pop()
+        else:
+            for index, server in servers:
+                break
+            else:
+                return False
+        pending[index] = (server, give_up_time(server))
+        running[0] += 1
+        pool.apply_async(_run_server_handler,
+            (server_handler, index, server,
+                server.get('server_timeout', timeout), processes),
+            callback=done.put)
+        return True
+
+    def wait_for_worker():
+        if not waiting:
+            for index, server in servers:
+                waiting.append((index, server, give_up_time(server)))
+                break
+        return bool(waiting)
+
+    try:
+        while running[0] < workers and submit():
+            pass
+        while pending or wait_for_worker():
+            give_ups = [g for s, g in pending.itervalues() if g is not None]
+            give_ups.extend(g for i, s, g in waiting if g is not None)
+            wait = max(0, min(give_ups) - time.time()) if give_ups else None
+            try:
+                # a timeout on get() keeps the wait interruptible
+                index, result = done.get(True, 1 if wait is None else min(wait, 1))
+            except Queue.Empty:
+                now = time.time()
+                for index, (server, give_up) in pending.items():
+                    if give_up is not None and give_up <= now:
+                        logger.warn('Gave up waiting on %s', server.get('hostname'))
+                        del pending[index]
+                        yield (server, DispatchTimeout(
+                            'Handler for %s timed out' % server.get('hostname')))
+                if waiting and waiting[0][2] is not None and waiting[0][2] <= now:
+                    # still no worker free, so none of the rest will start
+                    unstarted = [waiting.pop()[1]]
+                    unstarted.extend(server for index, server in servers)
+                    for server in unstarted:
+                        logger.warn('No worker free to start %s',
+                            server.get('hostname'))
+                        yield (server, DispatchTimeout(
+                            'Handler for %s couldn\'t be started' % \
+                                server.get('hostname')))
+                continue
+            # an abandoned handler finishing late still frees up its worker
+            running[0] -= 1
+            submit()
+            if index in pending:
+                server, give_up = pending.pop(index)
+                yield (server, result)
+    finally:
+        # drops anything not started yet, threads that are still running
+        # can't be killed but are left to finish (or time out) on their own
+        if own_pool:
+            pool.terminate()
+
+class AdaptiveLimiter(object):
+    """AIMD concurrency limiter driven by observed latency and error rate
+
+    Every window completed calls the limit is raised by increase if the p95
+    latency and error rate were healthy, or multiplied by backoff if they
+    weren't. Latency is healthy when the p95 is under latency_target, or if
+    no target is given, under tolerance times the baseline: an exponentially
+    weighted average of healthy windows' p95s (weighted by baseline_decay)
+    that drops straight to any lower p95.
+
+    By default the samples are how long each call() took. After
+    observe_requests(host) they're the individual API requests to that
+    host made while the limiter is in use instead (a call() can make any
+    number of requests, or none), call() then only limits concurrency.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=32, latency_target=None,
+            tolerance=2.0, error_threshold=0.1, window=20, increase=1, backoff=0.5,
+            baseline_decay=0.1):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.tolerance = tolerance
+        self.error_threshold = error_threshold
+        self.window = window
+        self.increase = increase
+        self.backoff = backoff
+        self.baseline_decay = baseline_decay
+        self._limit = float(max(min_limit, min(max_limit, initial)))
+        self._in_flight = 0
+        self._samples = []
+        self._baseline = None
+        self._last_p95 = None
+        self._last_error_rate = None
+        self._cond = threading.Condition()
+        self._request_hook = None
+
+    @property
+    def limit(self):
+        """The current concurrency limit
+        """
+
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def stats(self):
+        with self._cond:
+            return {
+                'limit': int(self._limit),
+                'in_flight': self._in_flight,
+                'p95': self._last_p95,
+                'error_rate': self._last_error_rate,
+                'baseline': self._baseline,
+            }
+
+    def observe_requests(self, host):
+        """Take samples from the API requests made to host (see
+        r1soft.instrument) instead of from call()
+        """
+
+        with self._cond:
+            if self._request_hook is None:
+                self._request_hook = instrument.add_hook(
+                    _LimiterRequestHook(self, host))
+
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= int(self._limit):
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, latency=None, error=False):
+        with self._cond:
+            self._in_flight -= 1
+            if latency is not None:
+                self._add_sample(latency, error)
+            self._cond.notify_all()
+
+    def record(self, latency, error=False):
+        """Add a latency sample without taking a slot
+        """
+
+        with self._cond:
+            self._add_sample(latency, error)
+            self._cond.notify_all()
+
+    def _add_sample(self, latency, error):
+        self._samples.append((latency, error))
+        if len(self._samples) >= self.window:
+            self._adjust()
+
+    def _adjust(self):
+        latencies = sorted(latency for latency, error in self._samples)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        error_rate = sum(1 for latency, error in self._samples if error) \
+            / float(len(self._samples))
+        self._samples = []
+        self._last_p95 = p95
+        self._last_error_rate = error_rate
+
+        if self.latency_target is not None:
+            latency_ok = p95 <= self.latency_target
+        else:
+            latency_ok = self._baseline is None or \
+                p95 <= self._baseline * self.tolerance
+            if error_rate <= self.error_threshold:
+                if self._baseline is None or p95 < self._baseline:
+                    self._baseline = p95
+                else:
+                    # follow the server's normal latency back up (slowly, so
+                    # a run of bad windows can't drag it along)
+                    self._baseline += self.baseline_decay * (p95 - self._baseline)
+        prev = int(self._limit)
+        if latency_ok and error_rate <= self.error_threshold:
+            self._limit = min(self.max_limit, self._limit + self.increase)
+        else:
+            self._limit = max(self.min_limit, self._limit * self.backoff)
+        if int(self._limit) != prev:
+            logger.debug('Adjusted concurrency limit %d -> %d (p95=%0.3fs, ' \
+                'errors=%0.1f%%)', prev, int(self._limit), p95, error_rate * 100)
+
+    def call(self, func, *args, **kwargs):
+        """Run func once there's room under the limit, recording its latency
+        and whether it raised (unless observing requests)
+        """
+
+        self.acquire()
+        start = time.time()
+        error = True
+        try:
+            result = func(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            if self._request_hook is None:
+                self.release(time.time() - start, error)
+            else:
+                self.release()
+
+class _LimiterRequestHook(instrument.Hook):
+    # feeds an AdaptiveLimiter the latency of each request to its host,
+    # faults are the server answering so only count as healthy samples
+
+    def __init__(self, limiter, host):
+        self.limiter = limiter
+        self.host = host
+
+    def post_call(self, call):
+        if call.server is None or call.server.rpartition(':')[0] != self.host:
+            return
+        self.limiter.record(call.duration, call.outcome in (
+            instrument.OUTCOME_TIMEOUT, instrument.OUTCOME_ERROR))
+
+_adaptive_limiters = {}
+_adaptive_limiters_lock = threading.Lock()
+
+def get_adaptive_limiter(key, host=None, **kwargs):
+    """Get the shared AdaptiveLimiter for key (e.g. a server's hostname),
+    sampling the requests made to host if given
+    """
+
+    with _adaptive_limiters_lock:
+        limiter = _adaptive_limiters.get(key, None)
+        if limiter is None:
+            limiter = _adaptive_limiters[key] = AdaptiveLimiter(**kwargs)
+            if host is not None:
+                limiter.observe_requests(host)
+        return limiter
+
+def adaptive_map(func, iterable, limiter):
+    """Like ThreadPool.map() but with the number of calls running at once
+    controlled by an AdaptiveLimiter
+    """
+
+    items = list(iterable)
+    # calls from the workers keep to the caller's deadline
+    func = timeouts.with_deadline(func, timeouts.get_deadline())
+    pool = multiprocessing.pool.ThreadPool(max(1, min(limiter.max_limit, len(items))))
+    try:
+        return pool.map(lambda item: limiter.call(func, item), items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def _timeout_args(server):
+    return dict(
+        connect_timeout=server.get('connect_timeout',
+            timeouts.DEFAULT_CONNECT_TIMEOUT),
+        read_timeout=server.get('read_timeout', timeouts.DEFAULT_READ_TIMEOUT),
+        call_deadline=server.get('call_deadline', None),
+    )
+
+_scheduler_local = threading.local()
+
+def current_scheduler():
+    """Get the Scheduler running the current thread's job, or None
+    """
+
+    return getattr(_scheduler_local, 'scheduler', None)
+
+class Scheduler(object):
+    """One pool of worker threads shared by nested jobs: servers, then the
+    policies or agents on each server
+
+    At most workers threads run in total, at most servers server jobs run at
+    once (workers / per_server by default) and at most per_server threads
+    (counting the server job's own) work on a single server's items. A job
+    waiting on map() runs items itself as well, so nested jobs can't
+    deadlock the pool however small it is. Use it as a context manager, or
+    call close() when done, to stop the worker threads.
+    """
+
+    def __init__(self, workers=8, per_server=4, servers=None):
+        self.workers = workers
+        self.per_server = per_server
+        self.servers = servers or max(1, workers // per_server)
+        self._tasks = Queue.Queue()
+        self._lock = threading.Lock()
+        self._helpers = {}
+        self._threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._worker,
+                name='scheduler-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _worker(self):
+        _scheduler_local.scheduler = self
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            func, args, kwargs, callback = task
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:
+                logger.exception(err)
+                continue
+            if callback is not None:
+                callback(result)
+
+    def apply_async(self, func, args=(), kwds={}, callback=None):
+        """Queue func(*args, **kwds) to run on a worker, callback gets the
+        result (like ThreadPool.apply_async() but with no AsyncResult)
+        """
+
+        func = timeouts.with_deadline(func, timeouts.get_deadline())
+        self._tasks.put((func, args, kwds, callback))
+
+    def _take_helper_slot(self, key, limit):
+        with self._lock:
+            helpers = self._helpers.get(key, 0)
+            if helpers >= limit:
+                return False
+            self._helpers[key] = helpers + 1
+            return True
+
+    def _release_helper_slot(self, key):
+        with self._lock:
+            self._helpers[key] -= 1
+
+    def map(self, key, func, iterable, limiter=None):
+        """Run func on each item using this server's (key's) share of the
+        workers, returns the results in order
+
+        Items are run through limiter.call() when given an AdaptiveLimiter,
+        the number of threads working on them then follows the limiter's
+        current limit instead of per_server. If any of them raise, items that
+        haven't started are skipped and the first error is raised once the
+        rest have finished.
+        """
+
+        items = list(iterable)
+        results = [None] * len(items)
+        errors = []
+        state = {'next': 0, 'running': 0, 'threads': 1, 'queued': 0}
+        cond = threading.Condition()
+        if limiter is not None:
+            run = lambda item: limiter.call(func, item)
+            max_threads = limiter.max_limit
+            threads_wanted = lambda: limiter.limit
+        else:
+            run = func
+            max_threads = self.per_server
+            threads_wanted = lambda: self.per_server
+        run = timeouts.with_deadline(run, timeouts.get_deadline())
+
+        def add_helpers():
+            # called with cond held
+            wanted = min(threads_wanted(), len(items) - state['next'] +
+                state['running'])
+            while state['threads'] + state['queued'] < wanted:
+                state['queued'] += 1
+                self._tasks.put((helper, (), {}, None))
+
+        def work(helping):
+            while True:
+                with cond:
+                    if errors or state['next'] >= len(items):
+                        return
+                    if helping and state['threads'] > threads_wanted():
+                        # the limit went down, give the thread back
+                        return
+                    index = state['next']
+                    state['next'] += 1
+                    state['running'] += 1
+                try:
+                    results[index] = run(items[index])
+                except Exception:
+                    errors.append(sys.exc_info())
+                finally:
+                    with cond:
+                        state['running'] -= 1
+                        if limiter is not None and not errors:
+                            add_helpers()
+                        cond.notify_all()
+
+        def helper():
+            # helpers queued after the items ran out (or while the server
+            # already has its share of threads) just return
+            with cond:
+                state['queued'] -= 1
+            if not self._take_helper_slot(key, max_threads - 1):
+                return
+            with cond:
+                state['threads'] += 1
+            try:
+                work(True)
+            finally:
+                with cond:
+                    state['threads'] -= 1
+                self._release_helper_slot(key)
+
+        with cond:
+            add_helpers()
+        work(False)
+        with cond:
+            while state['running']:
+                cond.wait()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    def dispatch(self, config, server_handler, timeout=None):
+        """Run server_handler for each server, yielding (server, result) as
+        they finish (see dispatch_handlers_stream())
+        """
+
+        return dispatch_handlers_stream(config, server_handler, self.servers,
+            timeout, pool=self)
+
+    def close(self):
+        """Stop the worker threads once the queued jobs are done
+        """
+
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._threads = []
+
+def scheduled_map(key, func, iterable, limiter=None):
+    """Scheduler.map() on the current thread's Scheduler, falling back to
+    adaptive_map() (or a plain loop without a limiter) outside of one
+    """
+
+    scheduler = current_scheduler()
+    if scheduler is not None:
+        return scheduler.map(key, func, iterable, limiter)
+    if limiter is not None and multiprocessing is not None:
+        return adaptive_map(func, iterable, limiter)
+    return [func(item) for item in iterable]
+
+# the client modules are only imported when a client is built, so scripts that
+# only talk to CDP2 servers never load suds
 
 def build_cdp2_client(server):
+    from .cdp2 import CDP2Client
     return CDP2Client(server['hostname'], server['username'],
-        server['password'], server['port'], server['ssl'])
+        server['password'], server['port'], server['ssl'],
+        **_timeout_args(server))
+
+def _cdp3_client_args(server):
+    return dict(_timeout_args(server),
+        version=server['version'],
+        rate_limit=server.get('rate_limit', None),
+        rate_burst=server.get('rate_burst', None),
+    )
 
 def build_cdp3_client(server):
+    from .cdp3 import CDP3Client
     return CDP3Client(server['hostname'], server['username'],
-        server['password'], server['port'], server['ssl'])
+        server['password'], server['port'], server['ssl'],
+        **_cdp3_client_args(server))
+
+def build_async_cdp3_client(server, pool=None):
+    from .cdp3 import AsyncCDP3Client
+    return AsyncCDP3Client(server['hostname'], server['username'],
+        server['password'], server['port'], server['ssl'],
+        pool=pool, **_cdp3_client_args(server))
+
+def build_cdp3_factory(server):
+    from .cdp3 import CDP3ClientFactory
+    return CDP3ClientFactory(server['hostname'], server['username'],
+        server['password'], server['port'], server['ssl'],
+        **_cdp3_client_args(server))
+
+# clients shared by everything in this process (a pool worker process gets
+# its own copy), keyed on the server
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+
+def _get_shared_client(server, builder):
+    key = (builder, server['hostname'], server['port'], server['version'])
+    with _shared_clients_lock:
+        client = _shared_clients.get(key, None)
+        if client is None:
+            client = _shared_clients[key] = builder(server)
+        return client
+
+def close_shared_clients(server):
+    """Close the kept-alive connections of this process's shared
+    CDP3ClientFactory for server, done when its handler finishes so idle
+    sockets don't pile up across a whole fleet
+    """
+
+    key = (build_cdp3_factory, server['hostname'], server['port'],
+        server['version'])
+    with _shared_clients_lock:
+        factory = _shared_clients.get(key, None)
+    if factory is not None:
+        factory.close()
+
+def get_cdp3_factory(server):
+    """Get this process's CDP3ClientFactory for server, so the WSDLs are only
+    loaded once per process
+    """
+
+    return _get_shared_client(server, build_cdp3_factory)
+
+def get_cdp2_client(server):
+    """Get this process's CDP2Client for server
+    """
+
+    return _get_shared_client(server, build_cdp2_client)
+
+def init_worker(config, namespaces):
+    """Pool initializer building this process's CDP3ClientFactory for every
+    CDP3+ server in config and loading the templates for namespaces from the
+    on-disk WSDL cache (without any requests, so an unreachable server can't
+    hold up the worker), anything not cached is loaded on first use
+    """
+
+    if replay.active() is not None:
+        # WSDLs have to go through the recording / replay
+        return
+    for server in config:
+        if server['version'] == 2:
+            continue
+        try:
+            get_cdp3_factory(server).preload(namespaces)
+        except Exception as err:
+            logger.debug('Couldn\'t preload WSDLs for %s: %s',
+                server['hostname'], err)
 
 def rate_limit(limit, iterator):
     hz = 1.0 / (limit * 1.0)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Shared setup for the tests, which run against the mock CDP servers from
+benchmarks/mockcdp.py:
+
+    python -m unittest discover -s tests
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import mockcdp
+import r1soft
+
+logging.getLogger('r1soft').setLevel(logging.CRITICAL)
+logging.getLogger('suds').addHandler(logging.NullHandler())
+
+class MockServerTestCase(unittest.TestCase):
+    """Runs each test with its own on-disk cache directory, mock servers
+    started with start_server() are stopped afterwards
+    """
+
+    def setUp(self):
+        self._servers = []
+        self._cache_dir = tempfile.mkdtemp(prefix='r1soft-test-')
+        self._old_cache_dir = os.environ.get('R1SOFT_CACHE_DIR', None)
+        os.environ['R1SOFT_CACHE_DIR'] = self._cache_dir
+
+    def tearDown(self):
+        for server in self._servers:
+            server.stop()
+        if self._old_cache_dir is None:
+            del os.environ['R1SOFT_CACHE_DIR']
+        else:
+            os.environ['R1SOFT_CACHE_DIR'] = self._old_cache_dir
+        shutil.rmtree(self._cache_dir, ignore_errors=True)
+
+    def start_server(self, hosts=5, tasks_per_agent=3, **kwargs):
+        kwargs.setdefault('disabled_ratio', 0)
+        server = mockcdp.MockCDP3Server(mockcdp.MockCDP3Data(hosts,
+            tasks_per_agent, **kwargs))
+        self._servers.append(server)
+        return server
+
+    def client(self, server, **kwargs):
+        return r1soft.cdp3.CDP3Client(server.host, 'admin', 'secret',
+            server.port, False, **kwargs)
+
+    def factory(self, server, **kwargs):
+        return r1soft.cdp3.CDP3ClientFactory(server.host, 'admin', 'secret',
+            server.port, False, **kwargs)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import random
+import unittest
+
+import suds
+
+from support import mockcdp, r1soft, MockServerTestCase
+
+class TaskHistoryReaderTest(MockServerTestCase):
+    def setUp(self):
+        super(TaskHistoryReaderTest, self).setUp()
+        self.server = self.start_server(hosts=1, tasks_per_agent=40,
+            running_ratio=0)
+        self.agent_id = self.server.data.agents.keys()[0]
+        self.fetched = []
+        get_task = self.server.data.getTaskExecutionContextByID
+        def counting_get_task(id):
+            self.fetched.append(id)
+            return get_task(id)
+        self.server.data.getTaskExecutionContextByID = counting_get_task
+        self.reader = r1soft.cdp3.TaskHistoryReader(self.client(self.server),
+            batch_size=5)
+
+    def tearDown(self):
+        self.reader.close()
+        super(TaskHistoryReaderTest, self).tearDown()
+
+    def expected(self, limit):
+        tasks = [self.server.data.tasks[task_id] for task_id \
+            in self.server.data.tasks_by_agent[self.agent_id]]
+        tasks.sort(key=lambda task: task['executionTime'], reverse=True)
+        return [task['id'] for task in tasks[:limit]]
+
+    def get_newest(self, limit=3):
+        return [task.id for task in self.reader.get_tasks(self.agent_id,
+            limit=limit)]
+
+    def test_oldest_first_ids(self):
+        self.assertEqual(self.get_newest(), self.expected(3))
+        self.assertTrue(self.reader._ids_ordered)
+        self.assertTrue(len(self.fetched) < 40)
+
+    def test_newest_first_ids(self):
+        self.server.data.tasks_by_agent[self.agent_id].reverse()
+        self.assertEqual(self.get_newest(), self.expected(3))
+        self.assertTrue(self.reader._ids_ordered)
+        self.assertTrue(len(self.fetched) < 40)
+
+    def test_shuffled_ids(self):
+        random.Random(1).shuffle(self.server.data.tasks_by_agent[self.agent_id])
+        self.assertEqual(self.get_newest(), self.expected(3))
+        self.assertFalse(self.reader._ids_ordered)
+        # every task is still only fetched once
+        self.assertEqual(len(self.fetched), len(set(self.fetched)))
+
+    def test_out_of_order_batch(self):
+        # both ends say oldest first, but the middle is shuffled
+        task_ids = self.server.data.tasks_by_agent[self.agent_id]
+        middle = task_ids[1:-1]
+        random.Random(2).shuffle(middle)
+        task_ids[1:-1] = middle
+        self.assertEqual(self.get_newest(10), self.expected(10))
+        self.assertFalse(self.reader._ids_ordered)
+
+    def test_filters(self):
+        tasks = self.reader.get_tasks(self.agent_id,
+            task_types=(mockcdp.POLICY_TASK_TYPE,), limit=5)
+        self.assertEqual(len(tasks), 5)
+        self.assertTrue(all(task.taskType == mockcdp.POLICY_TASK_TYPE \
+            for task in tasks))
+        times = [task.executionTime for task in tasks]
+        self.assertEqual(times, sorted(times, reverse=True))
+
+class StaleWsdlTest(MockServerTestCase):
+    def setUp(self):
+        super(StaleWsdlTest, self).setUp()
+        self.server = self.start_server()
+        self.agent_id = sorted(self.server.data.agents)[0]
+        self._agent_service = mockcdp.SERVICES['Agent']
+
+    def tearDown(self):
+        mockcdp.SERVICES['Agent'] = self._agent_service
+        super(StaleWsdlTest, self).tearDown()
+
+    def serve_old_wsdl(self, old=True):
+        if old:
+            mockcdp.SERVICES['Agent'] = [op for op in self._agent_service \
+                if op[0] != 'getAgentByID']
+        else:
+            mockcdp.SERVICES['Agent'] = self._agent_service
+        self.server._wsdls.clear()
+
+    def test_client_reloads_cached_wsdl(self):
+        self.serve_old_wsdl()
+        client = self.client(self.server)
+        client.Agent.service.getAgents()
+        client.close()
+
+        # the server is upgraded, but the old WSDL is still in the cache
+        self.serve_old_wsdl(False)
+        client = self.client(self.server)
+        try:
+            self.assertEqual(
+                client.Agent.service.getAgentByID(id=self.agent_id).id,
+                self.agent_id)
+        finally:
+            client.close()
+
+    def test_factory_reloads_template_once(self):
+        self.serve_old_wsdl()
+        factory = self.factory(self.server)
+        clients = [factory.client(), factory.client()]
+        for client in clients:
+            client.Agent.service.getAgents()
+
+        self.serve_old_wsdl(False)
+        for client in clients:
+            self.assertEqual(
+                client.Agent.service.getAgentByID(id=self.agent_id).id,
+                self.agent_id)
+        self.assertEqual(factory._reloaded, set(['Agent']))
+        for client in clients:
+            client.close()
+
+    def test_missing_method_still_raises(self):
+        client = self.client(self.server)
+        try:
+            self.assertRaises(suds.MethodNotFound,
+                lambda: client.Agent.service.noSuchMethod)
+            self.assertRaises(suds.TypeNotFound,
+                client.Agent.factory.create, 'noSuchType')
+        finally:
+            client.close()
+
+class RetryTest(MockServerTestCase):
+    def setUp(self):
+        super(RetryTest, self).setUp()
+        self.server = self.start_server()
+        self.calls = 0
+
+    def fail_calls(self, method, message, times):
+        real = getattr(self.server.data, method)
+        def failing(*args, **kwargs):
+            self.calls += 1
+            if self.calls <= times:
+                raise mockcdp.SoapFault(message)
+            return real(*args, **kwargs)
+        setattr(self.server.data, method, failing)
+
+    def call(self, func):
+        client = self.client(self.server, retries=3, backoff=0)
+        try:
+            return func(client)
+        finally:
+            client.close()
+
+    def get_agents(self):
+        return self.call(lambda client: client.Agent.service.getAgents())
+
+    def test_busy_fault_retried(self):
+        self.fail_calls('getAgents', 'Server is busy, try again later', 2)
+        self.assertEqual(len(self.get_agents()), 5)
+        self.assertEqual(self.calls, 3)
+
+    def test_other_fault_not_retried(self):
+        self.fail_calls('getAgents', 'No agent found with ID foo', 2)
+        self.assertRaises(suds.WebFault, self.get_agents)
+        self.assertEqual(self.calls, 1)
+
+    def test_write_not_retried(self):
+        policy_id = sorted(self.server.data.policies)[0]
+        self.fail_calls('disablePolicy', 'Server is busy, try again later', 1)
+        def disable_policy(client):
+            policy = client.Policy2.service.getPolicyById(policy_id)
+            client.Policy2.service.disablePolicy(policy)
+        self.assertRaises(suds.WebFault, self.call, disable_policy)
+        self.assertEqual(self.calls, 1)
+
+    def test_timeouts(self):
+        for err in (r1soft.timeouts.CallTimeout('deadline'),
+                r1soft.cdp3.DeadlineExceeded('deadline')):
+            self.assertFalse(r1soft.cdp3.is_retryable_error(err))
+            self.assertTrue(r1soft.cdp3.is_server_failure(err))
+
+if __name__ == '__main__':
+    unittest.main()
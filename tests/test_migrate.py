@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Nexcess.net python-r1soft
+# Copyright (C) 2013  Nexcess.net L.L.C.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import collections
+import os
+import unittest
+
+from support import r1soft, MockServerTestCase
+
+HOSTS = 4
+
+class MigrationTest(MockServerTestCase):
+    def setUp(self):
+        super(MigrationTest, self).setUp()
+        self.src = self.start_server(hosts=HOSTS, name='src')
+        self.dest = self.start_server(hosts=0, name='dest')
+        self.journal_file = os.path.join(self._cache_dir, 'journal')
+        # the first source host, as its (policy, disksafe, agent)
+        policy = sorted(self.src.data.policies.values(),
+            key=lambda p: p['id'])[0]
+        disksafe = self.src.data.disksafes[policy['diskSafeID']]
+        self.host = (policy, disksafe, self.src.data.agents[disksafe['agentID']])
+
+    def run_migration(self, journal=False, **kwargs):
+        engine = r1soft.migrate.MigrationEngine(self.factory(self.src),
+            self.factory(self.dest), workers=1,
+            journal=r1soft.migrate.MigrationJournal(self.journal_file) \
+                if journal else None)
+        try:
+            return engine.run(**kwargs)
+        finally:
+            if engine._journal is not None:
+                engine._journal.close()
+
+    def add_to_dest(self, collection, record, **changes):
+        record = dict(record, id='pre-%s' % record['id'], **changes)
+        collection[record['id']] = record
+        return record
+
+    def counts(self):
+        data = self.dest.data
+        return (len(data.agents), len(data.disksafes), len(data.policies))
+
+    def disksafes_per_agent(self):
+        return collections.Counter(ds['agentID'] \
+            for ds in self.dest.data.disksafes.itervalues())
+
+    def test_copy(self):
+        results = self.run_migration()
+        self.assertEqual(len(results), HOSTS)
+        self.assertEqual(self.counts(), (HOSTS, HOSTS, HOSTS))
+        self.assertFalse(any(policy['enabled'] \
+            for policy in self.src.data.policies.itervalues()))
+
+    def test_existing_host_skipped(self):
+        self.add_to_dest(self.dest.data.agents, self.host[2])
+        self.assertEqual(len(self.run_migration()), HOSTS - 1)
+        self.assertEqual(self.counts(), (HOSTS, HOSTS - 1, HOSTS - 1))
+        self.assertTrue(self.src.data.policies[self.host[0]['id']]['enabled'])
+
+    def test_adopt_existing(self):
+        agent = self.add_to_dest(self.dest.data.agents, self.host[2])
+        self.add_to_dest(self.dest.data.disksafes, self.host[1],
+            agentID=agent['id'])
+        self.assertEqual(len(self.run_migration(adopt_existing=True)), HOSTS)
+        self.assertEqual(self.counts(), (HOSTS, HOSTS, HOSTS))
+        self.assertEqual(max(self.disksafes_per_agent().values()), 1)
+
+    def test_adopt_existing_needs_matching_disksafe(self):
+        agent = self.add_to_dest(self.dest.data.agents, self.host[2])
+        self.add_to_dest(self.dest.data.disksafes, self.host[1],
+            agentID=agent['id'], description='something else')
+        self.run_migration(adopt_existing=True)
+        self.assertEqual(self.counts(), (HOSTS, HOSTS + 1, HOSTS))
+        self.assertEqual(self.disksafes_per_agent()[agent['id']], 2)
+
+    def test_adopt_existing_skips_finished_host(self):
+        agent = self.add_to_dest(self.dest.data.agents, self.host[2])
+        disksafe = self.add_to_dest(self.dest.data.disksafes, self.host[1],
+            agentID=agent['id'])
+        self.add_to_dest(self.dest.data.policies, self.host[0],
+            diskSafeID=disksafe['id'])
+        self.assertEqual(len(self.run_migration(adopt_existing=True)),
+            HOSTS - 1)
+        self.assertEqual(self.counts(), (HOSTS, HOSTS, HOSTS))
+
+    def test_resume_after_crash(self):
+        copy_disksafe = r1soft.migrate.copy_disksafe
+        def crashing_copy_disksafe(*args, **kwargs):
+            # the disksafe is created but never makes it into the journal
+            copy_disksafe(*args, **kwargs)
+            raise RuntimeError('crashed')
+        r1soft.migrate.copy_disksafe = crashing_copy_disksafe
+        try:
+            results = self.run_migration(journal=True)
+        finally:
+            r1soft.migrate.copy_disksafe = copy_disksafe
+        self.assertTrue(all(isinstance(result, RuntimeError) \
+            for policy_id, result in results))
+        self.assertEqual(self.counts(), (HOSTS, HOSTS, 0))
+
+        results = self.run_migration(journal=True)
+        self.assertEqual(len(results), HOSTS)
+        self.assertFalse(any(isinstance(result, Exception) \
+            for policy_id, result in results))
+        self.assertEqual(self.counts(), (HOSTS, HOSTS, HOSTS))
+        self.assertEqual(max(self.disksafes_per_agent().values()), 1)
+        # and nothing left to do
+        self.assertEqual(self.run_migration(journal=True), [])
+
+if __name__ == '__main__':
+    unittest.main()